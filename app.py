@@ -1,24 +1,47 @@
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, request, jsonify, send_file, Response, stream_with_context, g, has_request_context
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, inspect, or_, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import load_only, undefer
 from flask_cors import CORS
 from flask_jwt_extended import JWTManager, jwt_required, create_access_token, get_jwt_identity
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
 import os
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 import json
+import re
 from dotenv import load_dotenv
 import base64
 import mimetypes
+import hashlib
+import sqlite3
+import time
+import random
+import threading
+import uuid
+import atexit
+import html
+import zlib
+import gzip
+import shutil
+from contextlib import closing
+from itertools import islice
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
 
 # AI相关导入
-from openai import OpenAI
+from openai import (OpenAI, DefaultHttpxClient, Timeout, RateLimitError, APITimeoutError,
+                    APIConnectionError, InternalServerError)
+import httpx
 import PyPDF2
 import docx
 from pptx import Presentation
 import requests
 from io import BytesIO
-from PIL import Image
+from PIL import Image, ImageOps
 from pathlib import Path
 
 # 加载环境变量
@@ -28,12 +51,189 @@ app = Flask(__name__)
 app.config['SECRET_KEY'] = os.getenv('FLASK_SECRET_KEY', 'your-secret-key')
 app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URL', 'sqlite:///learning_assistant.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+
+# 数据库连接配置（SQLite时自动启用WAL等参数，读请求不再被写入阻塞，并发写入时等待而不是报 database is locked）
+app.config['SQLITE_JOURNAL_MODE'] = os.getenv('SQLITE_JOURNAL_MODE', 'WAL')
+app.config['SQLITE_SYNCHRONOUS'] = os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL')
+app.config['SQLITE_BUSY_TIMEOUT'] = int(os.getenv('SQLITE_BUSY_TIMEOUT', 15000))  # 毫秒
+app.config['SQLITE_MMAP_SIZE'] = int(os.getenv('SQLITE_MMAP_SIZE', 256 * 1024 * 1024))  # 字节，0表示不使用mmap
+app.config['SQLITE_CACHE_SIZE'] = int(os.getenv('SQLITE_CACHE_SIZE', -64000))  # 负数表示KiB，即每个连接约64MB
+app.config['DB_POOL_SIZE'] = int(os.getenv('DB_POOL_SIZE', 5))
+app.config['DB_MAX_OVERFLOW'] = int(os.getenv('DB_MAX_OVERFLOW', 10))
+app.config['DB_POOL_TIMEOUT'] = int(os.getenv('DB_POOL_TIMEOUT', 30))  # 秒
+app.config['DB_POOL_RECYCLE'] = int(os.getenv('DB_POOL_RECYCLE', 3600))  # 秒，仅对非SQLite数据库生效
+
+def database_engine_options(uri):
+    """根据数据库类型生成 SQLAlchemy 引擎参数"""
+    if not uri.startswith('sqlite'):
+        return {
+            'pool_size': app.config['DB_POOL_SIZE'],
+            'max_overflow': app.config['DB_MAX_OVERFLOW'],
+            'pool_timeout': app.config['DB_POOL_TIMEOUT'],
+            'pool_recycle': app.config['DB_POOL_RECYCLE'],
+            'pool_pre_ping': True
+        }
+    # 内存数据库使用单连接池，不接受连接池参数
+    if ':memory:' in uri or uri in ('sqlite://', 'sqlite:///'):
+        return {}
+    return {
+        'pool_size': app.config['DB_POOL_SIZE'],
+        'max_overflow': app.config['DB_MAX_OVERFLOW'],
+        'pool_timeout': app.config['DB_POOL_TIMEOUT'],
+        'connect_args': {'timeout': app.config['SQLITE_BUSY_TIMEOUT'] / 1000}
+    }
+
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = database_engine_options(app.config['SQLALCHEMY_DATABASE_URI'])
+
+@event.listens_for(Engine, 'connect')
+def apply_sqlite_pragmas(dbapi_connection, connection_record):
+    """SQLAlchemy每新建一个SQLite连接时设置PRAGMA（其他数据库不处理）"""
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    if app.config['SQLITE_JOURNAL_MODE']:
+        cursor.execute(f"PRAGMA journal_mode={app.config['SQLITE_JOURNAL_MODE']}")
+    if app.config['SQLITE_SYNCHRONOUS']:
+        cursor.execute(f"PRAGMA synchronous={app.config['SQLITE_SYNCHRONOUS']}")
+    cursor.execute(f"PRAGMA busy_timeout={int(app.config['SQLITE_BUSY_TIMEOUT'])}")
+    cursor.execute(f"PRAGMA mmap_size={int(app.config['SQLITE_MMAP_SIZE'])}")
+    cursor.execute(f"PRAGMA cache_size={int(app.config['SQLITE_CACHE_SIZE'])}")
+    cursor.close()
 app.config['JWT_SECRET_KEY'] = os.getenv('JWT_SECRET_KEY', 'jwt-secret-string')
 app.config['JWT_ACCESS_TOKEN_EXPIRES'] = timedelta(days=7)
 app.config['UPLOAD_FOLDER'] = 'uploads'
+app.config['UPLOAD_BLOB_DIR'] = os.getenv('UPLOAD_BLOB_DIR', os.path.join(app.config['UPLOAD_FOLDER'], 'blobs'))
+app.config['UPLOAD_CHUNK_SIZE'] = int(os.getenv('UPLOAD_CHUNK_SIZE', 1024 * 1024))  # 流式写盘时每次读取的字节数
+app.config['MAX_CONTENT_LENGTH'] = int(os.getenv('MAX_CONTENT_LENGTH', 200 * 1024 * 1024))  # 单个上传文件（含分块上传的总大小）上限
+app.config['UPLOAD_SESSION_TTL'] = int(os.getenv('UPLOAD_SESSION_TTL', 24 * 3600))  # 秒，超过该时长没有新分块的上传会话及临时文件被清理
+
+# 文档提取配置（页数/字符数上限，避免超大教材拖垮worker）
+app.config['EXTRACT_MAX_PAGES'] = int(os.getenv('EXTRACT_MAX_PAGES', 300))
+app.config['EXTRACT_MAX_CHARS'] = int(os.getenv('EXTRACT_MAX_CHARS', 300000))
+app.config['EXTRACT_PROCESSES'] = int(os.getenv('EXTRACT_PROCESSES', min(4, os.cpu_count() or 1)))
+app.config['EXTRACT_PARALLEL_MIN_PAGES'] = int(os.getenv('EXTRACT_PARALLEL_MIN_PAGES', 40))
+
+# 文件提取结果缓存配置
+app.config['EXTRACT_CACHE_ENABLED'] = os.getenv('EXTRACT_CACHE_ENABLED', 'true').lower() == 'true'
+app.config['EXTRACT_CACHE_PATH'] = os.getenv('EXTRACT_CACHE_PATH', os.path.join(app.instance_path, 'extract_cache.db'))
+app.config['EXTRACT_CACHE_MAX_ENTRIES'] = int(os.getenv('EXTRACT_CACHE_MAX_ENTRIES', 2000))
+app.config['EXTRACT_CACHE_MAX_BYTES'] = int(os.getenv('EXTRACT_CACHE_MAX_BYTES', 512 * 1024 * 1024))
+
+# 视觉调用前的图片预处理配置
+app.config['IMAGE_PREPROCESS_ENABLED'] = os.getenv('IMAGE_PREPROCESS_ENABLED', 'true').lower() == 'true'
+app.config['IMAGE_MAX_EDGE'] = int(os.getenv('IMAGE_MAX_EDGE', 2048))  # 最长边像素
+app.config['IMAGE_FORMAT'] = os.getenv('IMAGE_FORMAT', 'JPEG').upper()  # JPEG 或 WEBP
+app.config['IMAGE_QUALITY'] = int(os.getenv('IMAGE_QUALITY', 85))
+app.config['IMAGE_GRAYSCALE'] = os.getenv('IMAGE_GRAYSCALE', 'false').lower() == 'true'  # 文字为主的照片可转灰度
+
+# 长文档分块处理配置（超过阈值的笔记/英语文章按块并发生成后合并）
+app.config['LONG_DOC_ENABLED'] = os.getenv('LONG_DOC_ENABLED', 'true').lower() == 'true'
+app.config['LONG_DOC_THRESHOLD_TOKENS'] = int(os.getenv('LONG_DOC_THRESHOLD_TOKENS', 6000))
+app.config['LONG_DOC_CHUNK_TOKENS'] = int(os.getenv('LONG_DOC_CHUNK_TOKENS', 3000))
+app.config['LONG_DOC_CONCURRENCY'] = int(os.getenv('LONG_DOC_CONCURRENCY', 4))
+
+# 批量笔记补全
+app.config['BATCH_MAX_ITEMS'] = int(os.getenv('BATCH_MAX_ITEMS', 50))
+app.config['BATCH_CONCURRENCY'] = int(os.getenv('BATCH_CONCURRENCY', 4))
+app.config['BATCH_SYNC_MAX_ITEMS'] = int(os.getenv('BATCH_SYNC_MAX_ITEMS', 4))  # 超过该条数的批量请求改为逐条入队异步执行
+
+# 优化内容正文存储：db | filesystem | object，压缩：none | gzip | zstd（zstd需安装zstandard）
+app.config['CONTENT_STORE'] = os.getenv('CONTENT_STORE', 'db')
+app.config['CONTENT_COMPRESSION'] = os.getenv('CONTENT_COMPRESSION', 'gzip')
+app.config['CONTENT_COMPRESS_MIN_BYTES'] = int(os.getenv('CONTENT_COMPRESS_MIN_BYTES', 8192))
+app.config['CONTENT_FILE_DIR'] = os.getenv('CONTENT_FILE_DIR', 'enhanced_content')
+app.config['CONTENT_OBJECT_DIR'] = os.getenv('CONTENT_OBJECT_DIR', os.path.join(app.instance_path, 'content_objects'))
+
+# 列表分页（未传 limit 时默认每页条数，0 表示不分页）
+app.config['PAGE_DEFAULT_LIMIT'] = int(os.getenv('PAGE_DEFAULT_LIMIT', 50))
+app.config['PAGE_MAX_LIMIT'] = int(os.getenv('PAGE_MAX_LIMIT', 200))
+
+# Token预算配置（超过上限的prompt按策略截断或拒绝）
+app.config['AI_MAX_PROMPT_TOKENS'] = int(os.getenv('AI_MAX_PROMPT_TOKENS', 32000))
+app.config['AI_BUDGET_POLICY'] = os.getenv('AI_BUDGET_POLICY', 'trim')  # trim | reject
+app.config['AI_IMAGE_TOKENS'] = int(os.getenv('AI_IMAGE_TOKENS', 1500))  # 每张图片按固定token数估算
+app.config['TOKENIZER_ENCODING'] = os.getenv('TOKENIZER_ENCODING', 'cl100k_base')  # 安装tiktoken时使用的编码
+
+# AI响应缓存配置
+app.config['AI_CACHE_ENABLED'] = os.getenv('AI_CACHE_ENABLED', 'true').lower() == 'true'
+app.config['AI_CACHE_PATH'] = os.getenv('AI_CACHE_PATH', os.path.join(app.instance_path, 'ai_cache.db'))
+app.config['AI_CACHE_TTL'] = int(os.getenv('AI_CACHE_TTL', 7 * 24 * 3600))  # 秒
+app.config['AI_CACHE_MAX_ENTRIES'] = int(os.getenv('AI_CACHE_MAX_ENTRIES', 5000))
+
+# AI HTTP客户端连接池与超时配置（配合gevent worker可在单进程内并发上百个模型调用）
+app.config['AI_HTTP_MAX_CONNECTIONS'] = int(os.getenv('AI_HTTP_MAX_CONNECTIONS', 200))
+app.config['AI_HTTP_MAX_KEEPALIVE'] = int(os.getenv('AI_HTTP_MAX_KEEPALIVE', 50))
+app.config['AI_HTTP_KEEPALIVE_EXPIRY'] = float(os.getenv('AI_HTTP_KEEPALIVE_EXPIRY', 30))  # 秒
+app.config['AI_CONNECT_TIMEOUT'] = float(os.getenv('AI_CONNECT_TIMEOUT', 10))  # 秒
+app.config['AI_REQUEST_TIMEOUT'] = float(os.getenv('AI_REQUEST_TIMEOUT', 110))  # 秒，单次调用的读取超时上限，实际不超过 AI_CALL_DEADLINE 的剩余时间
+app.config['AI_CALL_DEADLINE'] = float(os.getenv('AI_CALL_DEADLINE', 100))  # 秒，一次HTTP请求内模型调用（含重试、限流排队）的总时限，需小于gunicorn的timeout
+
+# 重试、熔断与备用模型配置
+app.config['AI_FALLBACK_MODEL_ID'] = os.getenv('ARK_FALLBACK_MODEL_ID')  # 主模型限流或熔断时使用的备用模型
+app.config['AI_MAX_RETRIES'] = int(os.getenv('AI_MAX_RETRIES', 2))
+app.config['AI_RETRY_BASE_DELAY'] = float(os.getenv('AI_RETRY_BASE_DELAY', 0.5))  # 秒
+app.config['AI_RETRY_MAX_DELAY'] = float(os.getenv('AI_RETRY_MAX_DELAY', 8))  # 秒
+app.config['AI_BREAKER_THRESHOLD'] = int(os.getenv('AI_BREAKER_THRESHOLD', 5))  # 连续失败次数
+app.config['AI_BREAKER_COOLDOWN'] = float(os.getenv('AI_BREAKER_COOLDOWN', 30))  # 熔断持续秒数
+
+# 相同请求合并（single-flight）配置
+app.config['AI_SINGLEFLIGHT_ENABLED'] = os.getenv('AI_SINGLEFLIGHT_ENABLED', 'true').lower() == 'true'
+app.config['AI_SINGLEFLIGHT_WAIT'] = float(os.getenv('AI_SINGLEFLIGHT_WAIT', app.config['AI_CALL_DEADLINE']))  # 秒，同时不超过等待者自身的调用截止时间
+app.config['AI_SINGLEFLIGHT_POLL_INTERVAL'] = float(os.getenv('AI_SINGLEFLIGHT_POLL_INTERVAL', 0.2))  # 秒
+app.config['AI_SINGLEFLIGHT_LINGER'] = float(os.getenv('AI_SINGLEFLIGHT_LINGER', 10))  # 结果保留秒数，供稍晚到达的等待者读取
+
+# 客户端限流（按上游账号配额排队，跨worker共享令牌桶；配额为0表示不限制）
+app.config['AI_RATE_LIMIT_RPM'] = int(os.getenv('AI_RATE_LIMIT_RPM', 0))  # 每分钟请求数
+app.config['AI_RATE_LIMIT_TPM'] = int(os.getenv('AI_RATE_LIMIT_TPM', 0))  # 每分钟token数
+app.config['AI_RATE_COMPLETION_RESERVE'] = int(os.getenv('AI_RATE_COMPLETION_RESERVE', 1000))  # 为输出预留的token，响应后按实际用量多退少补
+app.config['AI_RATE_SHORT_TOKENS'] = int(os.getenv('AI_RATE_SHORT_TOKENS', 2000))  # 不超过该值的请求走优先车道
+app.config['AI_RATE_MAX_WAIT'] = float(os.getenv('AI_RATE_MAX_WAIT', 60))  # 排队超过该秒数放弃本次调用
+app.config['AI_RATE_LANE_AGING'] = float(os.getenv('AI_RATE_LANE_AGING', 10))  # 长请求排队超过该秒数后与短请求按先后轮流，不会一直被插队
+
+# AI异步任务队列配置
+app.config['JOB_EMBEDDED_WORKERS'] = os.getenv('JOB_EMBEDDED_WORKERS', 'true').lower() == 'true'
+app.config['JOB_WORKER_CONCURRENCY'] = int(os.getenv('JOB_WORKER_CONCURRENCY', 2))
+app.config['JOB_POLL_INTERVAL'] = float(os.getenv('JOB_POLL_INTERVAL', 1.0))  # 秒
+app.config['JOB_HEARTBEAT_INTERVAL'] = float(os.getenv('JOB_HEARTBEAT_INTERVAL', 30))  # 秒，执行中的任务定期写入心跳
+app.config['JOB_STALE_SECONDS'] = int(os.getenv('JOB_STALE_SECONDS', 120))  # 超过该时长没有心跳视为worker已崩溃，重新排队
+app.config['JOB_REQUEUE_INTERVAL'] = float(os.getenv('JOB_REQUEUE_INTERVAL', 30))  # 秒，每个进程检查心跳超时任务的间隔
+
+# 上传文件后台处理（上传接口立即返回 processing 状态的笔记，提取等步骤由任务worker执行；请求可用 async/auto_enhance/extract_keywords 覆盖）
+app.config['UPLOAD_BACKGROUND'] = os.getenv('UPLOAD_BACKGROUND', 'true').lower() == 'true'
+app.config['UPLOAD_AUTO_ENHANCE'] = os.getenv('UPLOAD_AUTO_ENHANCE', 'false').lower() == 'true'
+app.config['UPLOAD_EXTRACT_KEYWORDS'] = os.getenv('UPLOAD_EXTRACT_KEYWORDS', 'false').lower() == 'true'
+app.config['NOTE_KEYWORDS_MAX'] = int(os.getenv('NOTE_KEYWORDS_MAX', 8))
+app.config['NOTE_KEYWORDS_SOURCE_CHARS'] = int(os.getenv('NOTE_KEYWORDS_SOURCE_CHARS', 6000))  # 只把开头这么多字符交给模型提取关键词
+app.config['NOTE_EVENTS_MAX_SECONDS'] = int(os.getenv('NOTE_EVENTS_MAX_SECONDS', 25))  # 单个SSE连接最长保持秒数，之后由EventSource自动重连，需远小于gunicorn的timeout
+
+# 笔记访问计数写回缓冲（关闭后每次访问直接写库）
+app.config['ACCESS_BUFFER_ENABLED'] = os.getenv('ACCESS_BUFFER_ENABLED', 'true').lower() == 'true'
+app.config['ACCESS_FLUSH_INTERVAL'] = float(os.getenv('ACCESS_FLUSH_INTERVAL', 5))  # 秒
+app.config['ACCESS_FLUSH_THRESHOLD'] = int(os.getenv('ACCESS_FLUSH_THRESHOLD', 500))  # 缓冲的 (用户, 笔记) 数达到该值时立即写库
+
+# 学习统计接口的进程内缓存秒数（0表示不缓存）
+app.config['STATS_CACHE_TTL'] = float(os.getenv('STATS_CACHE_TTL', 0))
+
+# 生词批量同步单次最多单词数
+app.config['VOCABULARY_BULK_MAX'] = int(os.getenv('VOCABULARY_BULK_MAX', 1000))
+
+# 全文搜索
+app.config['SEARCH_PAGE_SIZE'] = int(os.getenv('SEARCH_PAGE_SIZE', 20))
+app.config['SEARCH_MAX_PAGE_SIZE'] = int(os.getenv('SEARCH_MAX_PAGE_SIZE', 50))
+app.config['SEARCH_SNIPPET_CHARS'] = int(os.getenv('SEARCH_SNIPPET_CHARS', 160))
+
+# 相似内容复用（默认关闭；需要安装numpy；修改 SIMILAR_DIM 后需运行 python rebuild_similar_index.py）
+# 字符n-gram向量分辨不出只差数字或符号的文本，题目解析因此只复用规范化后完全相同的原文
+app.config['SIMILAR_ENABLED'] = os.getenv('SIMILAR_ENABLED', 'false').lower() == 'true'
+app.config['SIMILAR_THRESHOLD'] = float(os.getenv('SIMILAR_THRESHOLD', 0.95))  # 余弦相似度达到该值时直接复用历史结果
+app.config['SIMILAR_CROSS_USER'] = os.getenv('SIMILAR_CROSS_USER', 'false').lower() == 'true'  # 是否复用其他用户的结果
+app.config['SIMILAR_DIM'] = int(os.getenv('SIMILAR_DIM', 512))
+app.config['SIMILAR_MAX_CHARS'] = int(os.getenv('SIMILAR_MAX_CHARS', 20000))  # 只用前N个字符计算向量
+app.config['SIMILAR_INDEX_DIR'] = os.getenv('SIMILAR_INDEX_DIR', os.path.join(app.instance_path, 'similar_index'))
 
 # 确保上传文件夹存在
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+os.makedirs(app.instance_path, exist_ok=True)
 
 db = SQLAlchemy(app)
 cors = CORS(
@@ -50,18 +250,50 @@ cors = CORS(
                 "*"
             ],
             "supports_credentials": True,
-            "methods": ["GET", "POST", "PUT", "DELETE", "OPTIONS"]
+            "methods": ["GET", "POST", "PUT", "DELETE", "OPTIONS"],
+            "expose_headers": ["ETag", "X-Next-Cursor"]
         }
     }
 )
 jwt = JWTManager(app)
 
-# 初始化AI客户端
+# 初始化AI客户端（显式连接池 + keep-alive，复用到方舟接口的连接）
+ai_http_client = DefaultHttpxClient(
+    limits=httpx.Limits(
+        max_connections=app.config['AI_HTTP_MAX_CONNECTIONS'],
+        max_keepalive_connections=app.config['AI_HTTP_MAX_KEEPALIVE'],
+        keepalive_expiry=app.config['AI_HTTP_KEEPALIVE_EXPIRY']
+    ),
+    timeout=Timeout(app.config['AI_REQUEST_TIMEOUT'], connect=app.config['AI_CONNECT_TIMEOUT'])
+)
 ai_client = OpenAI(
     base_url=os.getenv('ARK_BASE_URL', 'https://ark.cn-beijing.volces.com/api/v3'),
-    api_key=os.getenv('ARK_API_KEY')
+    api_key=os.getenv('ARK_API_KEY'),
+    http_client=ai_http_client,
+    max_retries=0  # 重试由 call_with_resilience 统一处理
 )
 
+def ai_call_timeout(timeout=None, deadline=None):
+    """单次模型调用的超时设置（读取超时可按调用覆盖，且不超过截止时间前的剩余秒数）"""
+    read = timeout or app.config['AI_REQUEST_TIMEOUT']
+    if deadline is not None:
+        read = max(min(read, deadline - time.time()), 1)
+    return Timeout(read, connect=min(app.config['AI_CONNECT_TIMEOUT'], read))
+
+class AIDeadlineExceeded(Exception):
+    pass
+
+@app.before_request
+def _start_ai_deadline():
+    """一个HTTP请求内的所有模型调用共享同一个截止时间，保证在gunicorn杀掉worker之前返回"""
+    g.ai_deadline = time.time() + app.config['AI_CALL_DEADLINE']
+
+def ai_deadline():
+    """当前模型调用的截止时间：请求中取请求级截止时间，后台任务中每次调用单独计时"""
+    if 'ai_deadline' in g:
+        return g.ai_deadline
+    return time.time() + app.config['AI_CALL_DEADLINE']
+
 # 数据库模型
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -81,10 +313,14 @@ class Note(db.Model):
     content = db.Column(db.Text)
     file_path = db.Column(db.String(500))
     file_type = db.Column(db.String(50))
+    content_hash = db.Column(db.String(64))  # 上传文件的SHA-256，对应 UploadBlob
+    status = db.Column(db.String(20), default='ready', nullable=False)  # processing | ready | failed
     category = db.Column(db.String(100))
     keywords = db.Column(db.Text)  # JSON格式存储关键词
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    __table_args__ = (db.Index('ix_note_user_created', 'user_id', 'created_at', 'id'),)
 
 class ProgressRecord(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -95,6 +331,11 @@ class ProgressRecord(db.Model):
     last_accessed = db.Column(db.DateTime, default=datetime.utcnow)
     
     note = db.relationship('Note', backref='progress_records')
+    
+    __table_args__ = (
+        db.Index('uq_progress_user_note', 'user_id', 'note_id', unique=True),
+        db.Index('ix_progress_user_accessed', 'user_id', 'last_accessed'),
+    )
 
 class VocabularyRecord(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -102,6 +343,8 @@ class VocabularyRecord(db.Model):
     word = db.Column(db.String(100), nullable=False)
     known = db.Column(db.Boolean, default=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (db.Index('uq_vocabulary_user_word', 'user_id', 'word', unique=True),)
 
 class EnhancedContent(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -110,55 +353,344 @@ class EnhancedContent(db.Model):
     enhanced_content = db.Column(db.Text)
     content_type = db.Column(db.String(50))  # 'note', 'problem', 'english'
     is_image = db.Column(db.Boolean, default=False)
-    file_path = db.Column(db.String(500))  # 保存优化内容的文件路径
+    file_path = db.Column(db.String(500))  # 旧版本写出的Markdown文件路径（新记录不再写文件）
+    content_ref = db.Column(db.String(300))  # 正文存放位置，为空时即 enhanced_content 列
+    content_blob = db.deferred(db.Column(db.LargeBinary))  # 数据库存储且压缩时的正文
+    edited_at = db.Column(db.DateTime)  # 用户编辑过时，正文即完整的Markdown文档
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
     user = db.relationship('User', backref='enhanced_contents')
+    
+    __table_args__ = (
+        db.Index('ix_enhanced_user_created', 'user_id', 'created_at', 'id'),
+        db.Index('ix_enhanced_user_type_created', 'user_id', 'content_type', 'created_at', 'id'),
+    )
 
-# 文件处理工具函数
-def extract_text_from_pdf(file_path):
-    text = ""
+class TokenUsage(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), index=True)
+    model_id = db.Column(db.String(100))
+    estimated_prompt_tokens = db.Column(db.Integer)  # 调用前本地估算值
+    prompt_tokens = db.Column(db.Integer, default=0)
+    completion_tokens = db.Column(db.Integer, default=0)
+    total_tokens = db.Column(db.Integer, default=0)
+    duration_ms = db.Column(db.Integer)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class UserStats(db.Model):
+    """每个用户一行的学习统计汇总，笔记创建和访问时增量更新"""
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    total_notes = db.Column(db.Integer, default=0, nullable=False)
+    total_access = db.Column(db.Integer, default=0, nullable=False)
+    progress_count = db.Column(db.Integer, default=0, nullable=False)  # 进度记录数，用于计算平均掌握度
+    mastery_sum = db.Column(db.Integer, default=0, nullable=False)
+    recent_notes = db.Column(db.Text)  # JSON格式存储最近访问的笔记
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class UploadSession(db.Model):
+    id = db.Column(db.String(32), primary_key=True)  # 断点续传上传ID
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    filename = db.Column(db.String(255), nullable=False)
+    title = db.Column(db.String(200))
+    category = db.Column(db.String(100))
+    total_size = db.Column(db.Integer)
+    received = db.Column(db.Integer, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class UploadBlob(db.Model):
+    """按内容哈希去重存储的上传文件，ref_count 为引用它的笔记数"""
+    content_hash = db.Column(db.String(64), primary_key=True)
+    size = db.Column(db.BigInteger)
+    ref_count = db.Column(db.Integer, default=0, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class AIJob(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    job_type = db.Column(db.String(50), nullable=False)  # 'note', 'problem', 'english', 'upload', 'note_batch'
+    payload = db.Column(db.Text)  # JSON格式存储任务参数
+    status = db.Column(db.String(20), default='queued', index=True)  # queued | running | done | failed
+    result = db.Column(db.Text)
+    save_id = db.Column(db.Integer)
+    progress = db.Column(db.String(20))  # 长文档分块进度，如 '3/8'
+    error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    heartbeat_at = db.Column(db.DateTime)  # 执行中的worker定期更新，据此判断worker是否已崩溃
+    finished_at = db.Column(db.DateTime)
+
+# 数据库迁移（create_all 不会给已存在的表补索引，按版本号依次执行未应用的迁移）
+SCHEMA_MIGRATIONS = [
+    (1, '热点查询索引，进度与生词记录去重后加唯一约束', [
+        'CREATE INDEX IF NOT EXISTS ix_note_user_created ON note (user_id, created_at, id)',
+        # 同一笔记的重复进度记录合并到最早的一条
+        'UPDATE progress_record SET '
+        'access_count = (SELECT SUM(p.access_count) FROM progress_record p '
+        'WHERE p.user_id = progress_record.user_id AND p.note_id = progress_record.note_id), '
+        'mastery_level = (SELECT MAX(p.mastery_level) FROM progress_record p '
+        'WHERE p.user_id = progress_record.user_id AND p.note_id = progress_record.note_id), '
+        'last_accessed = (SELECT MAX(p.last_accessed) FROM progress_record p '
+        'WHERE p.user_id = progress_record.user_id AND p.note_id = progress_record.note_id) '
+        'WHERE id IN (SELECT MIN(id) FROM progress_record GROUP BY user_id, note_id HAVING COUNT(*) > 1)',
+        'DELETE FROM progress_record WHERE id NOT IN (SELECT MIN(id) FROM progress_record GROUP BY user_id, note_id)',
+        'CREATE UNIQUE INDEX IF NOT EXISTS uq_progress_user_note ON progress_record (user_id, note_id)',
+        'CREATE INDEX IF NOT EXISTS ix_progress_user_accessed ON progress_record (user_id, last_accessed)',
+        # 重复的生词记录保留最新的一条
+        'DELETE FROM vocabulary_record WHERE id NOT IN (SELECT MAX(id) FROM vocabulary_record GROUP BY user_id, word)',
+        'CREATE UNIQUE INDEX IF NOT EXISTS uq_vocabulary_user_word ON vocabulary_record (user_id, word)',
+        'CREATE INDEX IF NOT EXISTS ix_enhanced_user_created ON enhanced_content (user_id, created_at, id)',
+        'CREATE INDEX IF NOT EXISTS ix_enhanced_user_type_created '
+        'ON enhanced_content (user_id, content_type, created_at, id)',
+    ]),
+    # 非字符串的迁移步骤以数据库连接为参数调用
+    (2, '笔记与优化内容的全文搜索索引', [lambda conn: rebuild_search_index(conn)]),
+    (3, '优化内容正文存储位置与编辑标记', [
+        lambda conn: add_missing_columns(conn, 'enhanced_content', {
+            'content_ref': 'VARCHAR(300)', 'content_blob': 'BLOB', 'edited_at': 'DATETIME'
+        }),
+        lambda conn: mark_legacy_edited_contents(conn),
+        lambda conn: rebuild_search_index(conn),
+    ]),
+    (4, '上传文件按内容哈希分片存储', [
+        lambda conn: add_missing_columns(conn, 'note', {'content_hash': 'VARCHAR(64)'}),
+        lambda conn: migrate_legacy_uploads(conn),
+    ]),
+    (5, '笔记处理状态', [
+        lambda conn: add_missing_columns(conn, 'note', {'status': "VARCHAR(20) NOT NULL DEFAULT 'ready'"}),
+    ]),
+    (6, '任务心跳时间', [
+        lambda conn: add_missing_columns(conn, 'ai_job', {'heartbeat_at': 'DATETIME'}),
+    ]),
+]
+
+def add_missing_columns(conn, table, columns):
+    """给已存在的表补充列（create_all 新建的表已包含这些列时跳过）"""
+    existing = {column['name'] for column in inspect(conn).get_columns(table)}
+    for name, column_type in columns.items():
+        if name not in existing:
+            conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {name} {column_type}"))
+
+def mark_legacy_edited_contents(conn):
+    """旧版本编辑内容时把同一份文本写入文件和数据库；文件与数据库一致的记录标记为已编辑"""
+    rows = conn.execute(text(
+        'SELECT id, file_path, enhanced_content, created_at FROM enhanced_content WHERE file_path IS NOT NULL'
+    )).all()
+    for item_id, file_path, enhanced_content, created_at in rows:
+        try:
+            with open(file_path, 'r', encoding='utf-8') as f:
+                edited = f.read() == (enhanced_content or '')
+        except OSError:
+            continue
+        if edited:
+            conn.execute(text('UPDATE enhanced_content SET edited_at = :t WHERE id = :id'),
+                         {'t': created_at, 'id': item_id})
+
+def migrate_legacy_uploads(conn):
+    """把旧版本平铺在 uploads/ 下的文件复制进分片存储并建立引用计数（原文件保留，确认无误后可手动删除）"""
+    rows = conn.execute(text(
+        'SELECT id, file_path FROM note WHERE file_path IS NOT NULL AND content_hash IS NULL'
+    )).all()
+    notes_by_path = {}
+    for note_id, file_path in rows:
+        notes_by_path.setdefault(file_path, []).append(note_id)
+    for file_path, note_ids in notes_by_path.items():
+        if not os.path.isfile(file_path):
+            continue
+        content_hash = file_sha256(file_path)
+        blob_path = upload_blob_path(content_hash)
+        if not os.path.exists(blob_path):
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            shutil.copyfile(file_path, blob_path)
+        stmt = upsert_insert(UploadBlob).values(
+            content_hash=content_hash, size=os.path.getsize(blob_path),
+            ref_count=len(note_ids), created_at=datetime.utcnow()
+        )
+        conn.execute(stmt.on_conflict_do_update(
+            index_elements=['content_hash'], set_={'ref_count': UploadBlob.ref_count + len(note_ids)}
+        ))
+        conn.execute(text('UPDATE note SET file_path = :path, content_hash = :hash WHERE id = :id'), [
+            {'path': blob_path, 'hash': content_hash, 'id': note_id} for note_id in note_ids
+        ])
+
+def run_migrations():
+    """执行尚未应用的迁移，返回本次应用的版本号列表"""
+    with db.engine.begin() as conn:
+        conn.execute(text(
+            'CREATE TABLE IF NOT EXISTS schema_migrations ('
+            'version INTEGER PRIMARY KEY, description VARCHAR(200), applied_at DATETIME)'
+        ))
+        applied = {row[0] for row in conn.execute(text('SELECT version FROM schema_migrations'))}
+    
+    newly_applied = []
+    for version, description, statements in SCHEMA_MIGRATIONS:
+        if version in applied:
+            continue
+        # 每个迁移在单独的事务中执行，失败时整体回滚
+        with db.engine.begin() as conn:
+            for statement in statements:
+                if callable(statement):
+                    statement(conn)
+                else:
+                    conn.execute(text(statement))
+            conn.execute(
+                text('INSERT INTO schema_migrations (version, description, applied_at) VALUES (:v, :d, :t)'),
+                {'v': version, 'd': description, 't': datetime.utcnow()}
+            )
+        print(f"[DB] 已应用迁移 {version}: {description}")
+        newly_applied.append(version)
+    return newly_applied
+
+def init_database():
+    """建表并执行迁移（需在应用上下文中调用）"""
+    db.create_all()
+    run_migrations()
+
+# 本地SQLite存储（缓存等需要在多个gunicorn worker间共享的状态）
+_sqlite_schemas_ready = set()
+
+def sqlite_connect(path, schema=()):
+    """打开一个本地SQLite连接（自动提交，WAL模式，便于多进程并发访问）；首次连接时建表"""
+    conn = sqlite3.connect(path, timeout=10, isolation_level=None)
+    conn.execute('PRAGMA journal_mode=WAL')
+    if path not in _sqlite_schemas_ready:
+        for statement in schema:
+            conn.execute(statement)
+        _sqlite_schemas_ready.add(path)
+    return conn
+
+# 文件处理工具函数（逐页产出文本，最后一次性拼接；大PDF按页码区间分给进程池并行提取）
+_extract_pool = None
+
+def get_extract_pool():
+    """按需创建文档提取进程池（每个gunicorn worker各自持有一个）"""
+    global _extract_pool
+    if _extract_pool is None:
+        _extract_pool = ProcessPoolExecutor(max_workers=app.config['EXTRACT_PROCESSES'])
+    return _extract_pool
+
+def join_text_limited(pieces, max_chars=None):
+    """拼接分段文本；达到字符上限时截断并停止继续提取"""
+    max_chars = max_chars or app.config['EXTRACT_MAX_CHARS']
+    parts, size = [], 0
+    for piece in pieces:
+        if size + len(piece) > max_chars:
+            parts.append(piece[:max_chars - size])
+            print(f"[FILE] 文本超过 {max_chars} 字符，已截断")
+            break
+        parts.append(piece)
+        size += len(piece)
+    return "".join(parts)
+
+def iter_pdf_pages(file_path, start=0, stop=None):
+    """逐页产出PDF文本"""
     with open(file_path, 'rb') as file:
         pdf_reader = PyPDF2.PdfReader(file)
-        for page in pdf_reader.pages:
-            text += page.extract_text()
-    return text
+        stop = min(len(pdf_reader.pages), stop if stop is not None else app.config['EXTRACT_MAX_PAGES'])
+        for index in range(start, stop):
+            yield (pdf_reader.pages[index].extract_text() or "") + "\n"
 
-def extract_text_from_docx(file_path):
+def _extract_pdf_range(file_path, start, stop):
+    return "".join(iter_pdf_pages(file_path, start, stop))
+
+def _iter_pdf_ranges_parallel(file_path, page_count):
+    processes = app.config['EXTRACT_PROCESSES']
+    step = -(-page_count // processes)
+    starts = list(range(0, page_count, step))
+    stops = [min(start + step, page_count) for start in starts]
+    print(f"[FILE] PDF共 {page_count} 页，分 {len(starts)} 段并行提取")
+    return get_extract_pool().map(_extract_pdf_range, [file_path] * len(starts), starts, stops)
+
+def extract_text_from_pdf(file_path):
+    global _extract_pool
+    with open(file_path, 'rb') as file:
+        page_count = min(len(PyPDF2.PdfReader(file).pages), app.config['EXTRACT_MAX_PAGES'])
+    
+    if app.config['EXTRACT_PROCESSES'] > 1 and page_count >= app.config['EXTRACT_PARALLEL_MIN_PAGES']:
+        try:
+            return join_text_limited(_iter_pdf_ranges_parallel(file_path, page_count))
+        except BrokenProcessPool as e:
+            print(f"[ERROR] 提取进程池异常，改为单进程提取: {e}")
+            _extract_pool = None
+    return join_text_limited(iter_pdf_pages(file_path, stop=page_count))
+
+def iter_docx_paragraphs(file_path):
+    """逐段产出Word文本"""
     doc = docx.Document(file_path)
-    text = ""
     for paragraph in doc.paragraphs:
-        text += paragraph.text + "\n"
-    return text
+        yield paragraph.text + "\n"
 
-def extract_text_from_pptx(file_path):
+def extract_text_from_docx(file_path):
+    return join_text_limited(iter_docx_paragraphs(file_path))
+
+def iter_pptx_slides(file_path, stop=None):
+    """逐页产出PPT幻灯片文本"""
     prs = Presentation(file_path)
-    text = ""
-    for slide in prs.slides:
-        for shape in slide.shapes:
-            if hasattr(shape, "text"):
-                text += shape.text + "\n"
-    return text
+    for slide in islice(prs.slides, stop or app.config['EXTRACT_MAX_PAGES']):
+        yield "".join(shape.text + "\n" for shape in slide.shapes if hasattr(shape, "text"))
+
+def extract_text_from_pptx(file_path):
+    return join_text_limited(iter_pptx_slides(file_path))
 
-def encode_image_to_base64(file_path):
-    """将图片编码为base64"""
+def encode_image_to_base64(file_path, file_type=None):
+    """将图片编码为base64（按3字节对齐分块编码，避免整块读入再编码）"""
     try:
+        mime_type = mimetypes.guess_type(file_path)[0] or mimetypes.types_map.get(f".{file_type}")
+        parts = []
         with open(file_path, 'rb') as f:
-            image_data = f.read()
-            base64_image = base64.b64encode(image_data).decode('utf-8')
-            mime_type = mimetypes.guess_type(file_path)[0]
-            return f"data:{mime_type};base64,{base64_image}"
+            for chunk in iter(lambda: f.read(3 * 256 * 1024), b''):
+                parts.append(base64.b64encode(chunk).decode('ascii'))
+        return f"data:{mime_type};base64,{''.join(parts)}"
     except Exception as e:
         print(f"[ERROR] 图片编码失败: {e}")
         return None
 
-def process_uploaded_file(file_path, file_type):
-    """处理上传的文件并提取文本内容"""
-    print(f"[FILE] 处理文件: {file_path}, 类型: {file_type}")
-    
+# 上传文件流式落盘（边写边计算哈希、识别文件头）
+FILE_SIGNATURES = [
+    (b'%PDF', 'pdf'),
+    (b'\xff\xd8\xff', 'jpg'),
+    (b'\x89PNG\r\n\x1a\n', 'png'),
+    (b'GIF87a', 'gif'),
+    (b'GIF89a', 'gif'),
+]
+
+def sniff_file_type(head, fallback):
+    """根据文件头识别类型；docx/pptx等zip容器或无法识别时沿用扩展名"""
+    sniffed = None
+    for signature, file_type in FILE_SIGNATURES:
+        if head.startswith(signature):
+            sniffed = file_type
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        sniffed = 'webp'
+    if not sniffed or (sniffed == 'jpg' and fallback == 'jpeg'):
+        return fallback
+    return sniffed
+
+def save_upload_stream(stream, file_path, fallback_type):
+    """分块把上传数据写入暂存文件，同时计算SHA-256并识别文件类型；返回 (内容哈希, 文件类型, 字节数)"""
+    digest = hashlib.sha256()
+    head = b''
+    size = 0
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    with open(file_path, 'wb') as f:
+        for chunk in iter(lambda: stream.read(app.config['UPLOAD_CHUNK_SIZE']), b''):
+            if len(head) < 16:
+                head += chunk[:16 - len(head)]
+            digest.update(chunk)
+            f.write(chunk)
+            size += len(chunk)
+    return digest.hexdigest(), sniff_file_type(head, fallback_type), size
+
+def inspect_saved_file(file_path, fallback_type):
+    """对已落盘的文件计算哈希并识别类型（断点续传完成时使用）"""
+    with open(file_path, 'rb') as f:
+        head = f.read(16)
+    return file_sha256(file_path), sniff_file_type(head, fallback_type)
+
+def extract_file_content(file_path, file_type):
+    """按文件类型提取文本内容（图片返回base64编码）"""
     if file_type in ['jpg', 'jpeg', 'png', 'gif', 'bmp', 'webp']:
-        # 图片文件，返回base64编码
-        return encode_image_to_base64(file_path)
+        # 图片文件，返回预处理后的base64编码
+        return prepare_image_for_ai(encode_image_to_base64(file_path, file_type))
     elif file_type == 'pdf':
         return extract_text_from_pdf(file_path)
     elif file_type in ['docx', 'doc']:
@@ -167,199 +699,2477 @@ def process_uploaded_file(file_path, file_type):
         return extract_text_from_pptx(file_path)
     elif file_type == 'txt':
         with open(file_path, 'r', encoding='utf-8') as f:
-            return f.read()
+            return f.read(app.config['EXTRACT_MAX_CHARS'])
     return ""
 
-# AI助手功能
-def call_ai_api(messages, model_id=None):
-    """调用豆包AI API"""
+def extract_file_content_in_pool(file_path, file_type):
+    """在提取进程池中提取，避免大文档解析占用worker进程（PDF内部已按页码区间分给进程池）"""
+    global _extract_pool
+    if file_type == 'pdf':
+        return extract_file_content(file_path, file_type)
     try:
-        if not model_id:
-            model_id = os.getenv('ARK_MODEL_ID', 'doubao-seed-1-6-250615')
-        
-        print(f"[AI API] 调用模型: {model_id}")
-        print(f"[AI API] 消息数量: {len(messages)}")
-        
-        response = ai_client.chat.completions.create(
-            model=model_id,
-            messages=messages
+        return get_extract_pool().submit(extract_file_content, file_path, file_type).result()
+    except BrokenProcessPool as e:
+        print(f"[ERROR] 提取进程池异常，改为在当前进程提取: {e}")
+        _extract_pool = None
+        return extract_file_content(file_path, file_type)
+
+def process_uploaded_file(file_path, file_type, content_hash=None, in_pool=False):
+    """处理上传的文件并提取文本内容（内容相同的文件直接复用已缓存的提取结果）"""
+    print(f"[FILE] 处理文件: {file_path}, 类型: {file_type}")
+    extract = extract_file_content_in_pool if in_pool else extract_file_content
+    
+    if not app.config['EXTRACT_CACHE_ENABLED']:
+        return extract(file_path, file_type)
+    
+    cache_key = f"{content_hash or file_sha256(file_path)}:{file_type}"
+    if file_type in ['jpg', 'jpeg', 'png', 'gif', 'bmp', 'webp']:
+        cache_key += f":{image_settings_signature()}"
+    try:
+        cached = extract_cache_get(cache_key)
+    except sqlite3.Error as e:
+        print(f"[ERROR] 提取缓存读取失败: {e}")
+        cached = None
+    if cached is not None:
+        print(f"[FILE] 命中提取缓存: {cache_key[:12]}")
+        return cached[0]
+    
+    content = extract(file_path, file_type)
+    if content:
+        try:
+            extract_cache_set(cache_key, content, extraction_metadata(file_path, file_type, content))
+        except sqlite3.Error as e:
+            print(f"[ERROR] 提取缓存写入失败: {e}")
+    return content
+
+# 上传文件存储：按内容SHA-256寻址并按哈希前缀分两级目录，相同文件只存一份，没有笔记引用时回收
+def upload_staging_path():
+    return os.path.join(app.config['UPLOAD_FOLDER'], '.partial', f"{uuid.uuid4().hex}.part")
+
+def upload_blob_path(content_hash):
+    return os.path.join(app.config['UPLOAD_BLOB_DIR'], content_hash[:2], content_hash[2:4], content_hash)
+
+def acquire_upload_blob(content_hash, size):
+    """在当前会话事务中给文件增加一个引用"""
+    stmt = upsert_insert(UploadBlob).values(
+        content_hash=content_hash, size=size, ref_count=1, created_at=datetime.utcnow()
+    )
+    db.session.execute(stmt.on_conflict_do_update(
+        index_elements=['content_hash'], set_={'ref_count': UploadBlob.ref_count + 1}
+    ))
+
+def place_upload_blob(staged_path, content_hash):
+    """引用提交后再把暂存文件移入存储（已有相同文件时覆盖，内容不变），避免与回收并发时丢失文件"""
+    path = upload_blob_path(content_hash)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    os.replace(staged_path, path)
+    return path
+
+def release_upload_blob(content_hash):
+    """在当前会话事务中减少一个引用，提交后调用 collect_upload_blob 回收"""
+    UploadBlob.query.filter_by(content_hash=content_hash).update(
+        {'ref_count': UploadBlob.ref_count - 1}, synchronize_session=False
+    )
+
+def collect_upload_blob(content_hash):
+    """删除没有引用的文件；删除记录与文件在同一事务中完成，并发上传的引用写入会等待该事务"""
+    deleted = UploadBlob.query.filter(
+        UploadBlob.content_hash == content_hash, UploadBlob.ref_count <= 0
+    ).delete(synchronize_session=False)
+    if deleted:
+        try:
+            os.remove(upload_blob_path(content_hash))
+        except OSError:
+            pass
+        print(f"[UPLOAD] 回收无引用文件: {content_hash[:12]}")
+    db.session.commit()
+    return bool(deleted)
+
+def upload_options(data=None):
+    """读取上传处理选项，请求中未指定时使用配置的默认值"""
+    data = data or {}
+    def option(name, default):
+        return request_flag(name, data) if name in data or name in request.values else default
+    return {
+        'background': option('async', app.config['UPLOAD_BACKGROUND']),
+        'auto_enhance': option('auto_enhance', app.config['UPLOAD_AUTO_ENHANCE']),
+        'extract_keywords': option('extract_keywords', app.config['UPLOAD_EXTRACT_KEYWORDS'])
+    }
+
+def create_note_from_file(user_id, staged_path, file_type, content_hash, size, title, category, options):
+    """为暂存文件创建笔记记录并把文件存入共享存储，随后在后台任务或当前请求中处理；返回 (响应数据, 状态码)"""
+    # 检查是否为图片
+    is_image = file_type in ['jpg', 'jpeg', 'png', 'gif', 'bmp', 'webp']
+    
+    try:
+        # 创建笔记记录，内容在处理流水线中填充
+        note = Note(
+            user_id=user_id,
+            title=title,
+            file_path=upload_blob_path(content_hash),
+            file_type=file_type,
+            content_hash=content_hash,
+            status='processing',
+            category=category
         )
         
-        result = response.choices[0].message.content
-        print(f"[AI API] 响应长度: {len(result) if result else 0} 字符")
-        return result
+        db.session.add(note)
+        db.session.flush()
+        index_note(note)
+        adjust_user_note_count(user_id, 1)
+        acquire_upload_blob(content_hash, size)
+        db.session.commit()
+        place_upload_blob(staged_path, content_hash)
+    finally:
+        if os.path.exists(staged_path):
+            os.remove(staged_path)
+    
+    print(f"[UPLOAD] 笔记创建成功，ID: {note.id}, 是否为图片: {is_image}")
+    result = {
+        'message': '文件上传成功', 
+        'note_id': note.id,
+        'is_image': is_image,
+        'file_type': file_type
+    }
+    
+    if options['background']:
+        job = enqueue_job(user_id, 'upload', {
+            'note_id': note.id,
+            'auto_enhance': options['auto_enhance'],
+            'extract_keywords': options['extract_keywords']
+        })
+        return {**result, 'message': '文件上传成功，正在后台处理', 'status': note.status, 'job_id': job.id}, 202
+    
+    try:
+        _, save_id = process_note_upload(note, options)
     except Exception as e:
-        print(f"[ERROR] AI API调用错误: {e}")
-        print(f"[ERROR] 错误类型: {type(e).__name__}")
-        import traceback
-        print(f"[ERROR] 详细错误信息:\n{traceback.format_exc()}")
-        return None
+        print(f"[ERROR] 笔记 {note.id} 处理失败: {e}")
+        mark_note_failed(note.id)
+        return {'error': '文件处理失败', 'note_id': note.id, 'status': 'failed'}, 500
+    if save_id:
+        result['save_id'] = save_id
+    return {**result, 'status': note.status}, 200
 
-def enhance_notes(content, is_image=False):
-    """补全笔记功能"""
-    print(f"[ENHANCE] 开始补全笔记，是否为图片: {is_image}")
+def process_note_upload(note, options, on_stage=None):
+    """上传处理流水线：提取文本，按需补全笔记、提取关键词，完成后笔记状态变为 ready
     
-    if is_image:
-        messages = [
-            {
-                "role": "system",
-                "content": "你是一个专业的学习助手。请分析图片中的内容，提取关键信息，并补全完善相关知识点，使内容更加完整和易于理解。请用Markdown格式输出。"
-            },
-            {
-                "role": "user",
-                "content": [
-                    {
-                        "type": "text",
-                        "text": "请分析这张图片中的内容，提取关键信息并补全相关知识点："
-                    },
-                    {
-                        "type": "image_url",
-                        "image_url": {
-                            "url": content
-                        }
-                    }
-                ]
-            }
-        ]
+    提取失败时抛出异常；补全和关键词是附加步骤，失败只记录日志。返回 (补全内容, 保存ID)
+    """
+    on_stage = on_stage or (lambda stage: None)
+    is_image = note.file_type in ['jpg', 'jpeg', 'png', 'gif', 'bmp', 'webp']
+    
+    on_stage('extracting')
+    note.content = process_uploaded_file(note.file_path, note.file_type, note.content_hash, in_pool=True)
+    index_note(note)
+    db.session.commit()
+    
+    enhanced, save_id = None, None
+    if options.get('auto_enhance') and note.content:
+        on_stage('enhancing')
+        try:
+            enhanced = enhance_notes(note.content, is_image)
+            if enhanced:
+                save_id = save_enhanced_content(note.user_id, note.content, enhanced, 'note', is_image)
+        except Exception as e:
+            print(f"[ERROR] 笔记 {note.id} 自动补全失败: {e}")
+    
+    if options.get('extract_keywords') and note.content and not is_image:
+        on_stage('keywords')
+        try:
+            note.keywords = json.dumps(extract_note_keywords(note.content), ensure_ascii=False)
+        except Exception as e:
+            print(f"[ERROR] 笔记 {note.id} 关键词提取失败: {e}")
+    
+    note.status = 'ready'
+    db.session.commit()
+    print(f"[UPLOAD] 笔记 {note.id} 处理完成")
+    return enhanced, save_id
+
+def mark_note_failed(note_id):
+    db.session.rollback()
+    Note.query.filter_by(id=note_id).update({'status': 'failed'}, synchronize_session=False)
+    db.session.commit()
+
+def note_keywords(note):
+    return json.loads(note.keywords) if note.keywords else []
+
+def upload_session_path(upload):
+    return os.path.join(app.config['UPLOAD_FOLDER'], '.partial', f"{upload.id}.part")
+
+_upload_cleanup_at = 0
+
+def expire_upload_sessions():
+    """清理超过 UPLOAD_SESSION_TTL 没有写入的分块上传会话，以及中断上传遗留的临时文件"""
+    cutoff = time.time() - app.config['UPLOAD_SESSION_TTL']
+    partial_dir = os.path.join(app.config['UPLOAD_FOLDER'], '.partial')
+    stale = set()
+    if os.path.isdir(partial_dir):
+        for name in os.listdir(partial_dir):
+            path = os.path.join(partial_dir, name)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+                    stale.add(name[:-len('.part')])
+            except OSError:
+                pass
+    created_before = datetime.utcnow() - timedelta(seconds=app.config['UPLOAD_SESSION_TTL'])
+    expired = [upload.id for upload in UploadSession.query.filter(UploadSession.created_at < created_before)
+               if upload.id in stale or not os.path.exists(upload_session_path(upload))]
+    if expired:
+        UploadSession.query.filter(UploadSession.id.in_(expired)).delete(synchronize_session=False)
+        db.session.commit()
+    if stale or expired:
+        print(f"[UPLOAD] 清理过期上传: 临时文件 {len(stale)} 个, 会话 {len(expired)} 个")
+
+def maybe_expire_upload_sessions():
+    """创建上传会话时顺带清理，每个进程每小时最多一次"""
+    global _upload_cleanup_at
+    if time.time() - _upload_cleanup_at < 3600:
+        return
+    _upload_cleanup_at = time.time()
+    try:
+        expire_upload_sessions()
+    except Exception as e:
+        db.session.rollback()
+        print(f"[ERROR] 清理过期上传失败: {e}")
+
+def upload_session_status(upload):
+    return {
+        'upload_id': upload.id,
+        'filename': upload.filename,
+        'total_size': upload.total_size,
+        'received': upload.received,
+        'chunk_size': app.config['UPLOAD_CHUNK_SIZE']
+    }
+
+# 文件提取结果缓存（按文件内容SHA-256索引，LRU淘汰）
+EXTRACT_CACHE_SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS extract_cache ('
+    'key TEXT PRIMARY KEY, content TEXT NOT NULL, metadata TEXT, '
+    'size INTEGER NOT NULL, last_access REAL NOT NULL)',
+    'CREATE INDEX IF NOT EXISTS ix_extract_cache_last_access ON extract_cache (last_access)',
+)
+
+def file_sha256(file_path):
+    """分块计算文件内容的SHA-256"""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def extraction_metadata(file_path, file_type, content):
+    metadata = {'file_type': file_type, 'file_size': os.path.getsize(file_path), 'chars': len(content)}
+    if file_type in ['jpg', 'jpeg', 'png', 'gif', 'bmp', 'webp']:
+        try:
+            with Image.open(file_path) as image:
+                metadata.update(width=image.width, height=image.height, format=image.format)
+        except Exception as e:
+            print(f"[ERROR] 读取图片信息失败: {e}")
+    return metadata
+
+def _extract_cache_connect():
+    return sqlite_connect(app.config['EXTRACT_CACHE_PATH'], EXTRACT_CACHE_SCHEMA)
+
+def extract_cache_get(key):
+    """返回 (提取内容, 元数据)，未命中返回 None"""
+    with closing(_extract_cache_connect()) as conn:
+        row = conn.execute('SELECT content, metadata FROM extract_cache WHERE key = ?', (key,)).fetchone()
+        if not row:
+            return None
+        conn.execute('UPDATE extract_cache SET last_access = ? WHERE key = ?', (time.time(), key))
+    return row[0], json.loads(row[1] or '{}')
+
+def extract_cache_set(key, content, metadata):
+    """写入提取结果，超出条目数或总大小上限时淘汰最久未使用的条目"""
+    with closing(_extract_cache_connect()) as conn:
+        conn.execute(
+            'INSERT OR REPLACE INTO extract_cache (key, content, metadata, size, last_access) VALUES (?, ?, ?, ?, ?)',
+            (key, content, json.dumps(metadata, ensure_ascii=False), len(content), time.time())
+        )
+        count, total_size = conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM extract_cache').fetchone()
+        evict = []
+        for old_key, size in conn.execute('SELECT key, size FROM extract_cache ORDER BY last_access'):
+            if count <= app.config['EXTRACT_CACHE_MAX_ENTRIES'] and total_size <= app.config['EXTRACT_CACHE_MAX_BYTES']:
+                break
+            evict.append((old_key,))
+            count -= 1
+            total_size -= size
+        conn.executemany('DELETE FROM extract_cache WHERE key = ?', evict)
+
+# 图片预处理（自动旋转、缩放、重新压缩，减小视觉调用的请求体）
+def image_settings_signature():
+    config = app.config
+    return f"{config['IMAGE_MAX_EDGE']}-{config['IMAGE_FORMAT']}-{config['IMAGE_QUALITY']}-{int(config['IMAGE_GRAYSCALE'])}"
+
+def preprocess_image_bytes(raw):
+    """按EXIF方向旋转、缩放到最长边上限并重新压缩；返回 (图片字节, MIME类型)，处理后没有明显变小时返回 (原图, None)"""
+    image_format = app.config['IMAGE_FORMAT']
+    max_edge = app.config['IMAGE_MAX_EDGE']
+    grayscale = app.config['IMAGE_GRAYSCALE']
+    
+    with Image.open(BytesIO(raw)) as source:
+        image = ImageOps.exif_transpose(source)
+        resized = max(image.size) > max_edge
+        if resized:
+            image.thumbnail((max_edge, max_edge), Image.Resampling.LANCZOS)
+        if grayscale:
+            image = image.convert('L')
+        elif image.mode not in ('RGB', 'L'):
+            # JPEG不支持透明通道，铺白色背景
+            rgba = image.convert('RGBA')
+            image = Image.new('RGB', rgba.size, 'white')
+            image.paste(rgba, mask=rgba.split()[-1])
+        output = BytesIO()
+        image.save(output, format=image_format, quality=app.config['IMAGE_QUALITY'], optimize=True)
+    
+    processed = output.getvalue()
+    if not resized and not grayscale and len(processed) > len(raw) * 0.9:
+        return raw, None
+    return processed, f"image/{image_format.lower()}"
+
+def prepare_image_for_ai(data_url):
+    """视觉调用前预处理base64图片；处理结果按原图内容哈希缓存"""
+    if not data_url or not app.config['IMAGE_PREPROCESS_ENABLED']:
+        return data_url
+    header, _, encoded = data_url.partition(',')
+    if not header.startswith('data:') or ';base64' not in header:
+        return data_url
+    
+    raw = base64.b64decode(encoded)
+    signature = image_settings_signature()
+    cache_key = f"{hashlib.sha256(raw).hexdigest()}:image:{signature}"
+    try:
+        cached = extract_cache_get(cache_key) if app.config['EXTRACT_CACHE_ENABLED'] else None
+    except sqlite3.Error as e:
+        print(f"[ERROR] 图片缓存读取失败: {e}")
+        cached = None
+    if cached is not None:
+        return cached[0]
+    
+    try:
+        processed, mime_type = preprocess_image_bytes(raw)
+    except Exception as e:
+        print(f"[ERROR] 图片预处理失败，使用原图: {e}")
+        return data_url
+    
+    result = data_url
+    if mime_type:
+        result = f"data:{mime_type};base64,{base64.b64encode(processed).decode('ascii')}"
+        saved = len(raw) - len(processed)
+        print(f"[IMAGE] 图片预处理: {len(raw)} → {len(processed)} 字节，节省 {saved} 字节 ({saved * 100 // max(len(raw), 1)}%)")
     else:
-        messages = [
-            {
-                "role": "system",
-                "content": "你是一个专业的学习助手。请帮助用户补全和完善笔记内容，填补知识点间的逻辑关系，使笔记更加完整和易于理解。请用Markdown格式输出，包含适当的标题、列表和重点标记。"
-            },
-            {
-                "role": "user", 
-                "content": f"请帮我补全和完善以下笔记内容，填补缺失的知识点和逻辑关系：\n\n{content}"
-            }
-        ]
-    return call_ai_api(messages)
+        # 处理后没有明显变小，发送的仍是原图
+        processed, saved = raw, 0
+        print(f"[IMAGE] 图片预处理后没有明显变小，使用原图: {len(raw)} 字节")
+    record_image_preprocess(len(raw), len(processed))
+    
+    if app.config['EXTRACT_CACHE_ENABLED']:
+        metadata = {'original_bytes': len(raw), 'processed_bytes': len(processed), 'bytes_saved': saved}
+        try:
+            extract_cache_set(cache_key, result, metadata)
+            # 处理后的图片再次提交（如笔记补全时）直接命中
+            processed_key = f"{hashlib.sha256(processed).hexdigest()}:image:{signature}"
+            extract_cache_set(processed_key, result, metadata)
+        except sqlite3.Error as e:
+            print(f"[ERROR] 图片缓存写入失败: {e}")
+    return result
+
+# Token估算与prompt预算
+_token_encoding = None
+_tokenizer_loaded = False
+
+class PromptBudgetExceeded(Exception):
+    def __init__(self, tokens, limit):
+        super().__init__(f"输入内容过长：约 {tokens} tokens，超过上限 {limit}")
+        self.tokens = tokens
+        self.limit = limit
+
+def _get_token_encoding():
+    """按需加载本地tokenizer（tiktoken为可选依赖，未安装时使用字符估算）"""
+    global _token_encoding, _tokenizer_loaded
+    if not _tokenizer_loaded:
+        _tokenizer_loaded = True
+        try:
+            import tiktoken
+            _token_encoding = tiktoken.get_encoding(app.config['TOKENIZER_ENCODING'])
+        except Exception as e:
+            print(f"[TOKENS] 未启用tiktoken，使用字符估算: {e}")
+    return _token_encoding
+
+def estimate_tokens(text):
+    """估算文本token数：优先用本地tokenizer；否则按中日韩字符约1个token、其余约4个字符1个token估算"""
+    encoding = _get_token_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    cjk = sum(1 for ch in text if '\u2e80' <= ch <= '\u9fff' or '\uac00' <= ch <= '\ud7af')
+    return cjk + (len(text) - cjk + 3) // 4
+
+def count_message_tokens(messages):
+    """估算一组chat消息的prompt token数（含每条消息的格式开销，图片按固定值计）"""
+    total = 0
+    for message in messages:
+        total += 4
+        content = message.get('content')
+        if isinstance(content, str):
+            total += estimate_tokens(content)
+        elif isinstance(content, list):
+            for part in content:
+                if part.get('type') == 'text':
+                    total += estimate_tokens(part['text'])
+                else:
+                    total += app.config['AI_IMAGE_TOKENS']
+    return total
+
+def apply_prompt_budget(messages):
+    """调用前检查prompt大小；超出上限时截断最后一条用户文本消息，或按配置直接拒绝。返回 (消息, 估算token数)"""
+    limit = app.config['AI_MAX_PROMPT_TOKENS']
+    tokens = count_message_tokens(messages)
+    if tokens <= limit:
+        return messages, tokens
+    
+    index = next((i for i in range(len(messages) - 1, -1, -1)
+                  if messages[i].get('role') == 'user' and isinstance(messages[i].get('content'), str)), None)
+    if app.config['AI_BUDGET_POLICY'] != 'trim' or index is None:
+        raise PromptBudgetExceeded(tokens, limit)
+    
+    messages = list(messages)
+    kept = messages[index]['content']
+    for _ in range(5):
+        kept_tokens = estimate_tokens(kept)
+        overflow = tokens - limit
+        if kept_tokens <= overflow:
+            break
+        kept = kept[:int(len(kept) * (kept_tokens - overflow) / kept_tokens * 0.95)]
+        messages[index] = dict(messages[index], content=kept + "\n\n……（内容过长，已截断）")
+        tokens = count_message_tokens(messages)
+        if tokens <= limit:
+            print(f"[TOKENS] prompt超出预算，已截断至约 {tokens} tokens")
+            return messages, tokens
+    raise PromptBudgetExceeded(tokens, limit)
+
+def current_ai_user_id():
+    """当前AI调用所属的用户：后台任务/分块线程中取 g.ai_user_id，请求中取JWT身份"""
+    if 'ai_user_id' in g:
+        return g.ai_user_id
+    if has_request_context():
+        try:
+            identity = get_jwt_identity()
+            return int(identity) if identity else None
+        except Exception:
+            return None
+    return None
+
+def record_token_usage(model_id, estimated_prompt_tokens, usage, started):
+    """记录一次模型调用的token用量（独立事务，不影响调用方的session）"""
+    try:
+        with db.engine.begin() as conn:
+            conn.execute(TokenUsage.__table__.insert().values(
+                user_id=current_ai_user_id(),
+                model_id=model_id,
+                estimated_prompt_tokens=estimated_prompt_tokens,
+                prompt_tokens=getattr(usage, 'prompt_tokens', 0) or 0,
+                completion_tokens=getattr(usage, 'completion_tokens', 0) or 0,
+                total_tokens=getattr(usage, 'total_tokens', 0) or 0,
+                duration_ms=int((time.time() - started) * 1000),
+                created_at=datetime.utcnow()
+            ))
+    except Exception as e:
+        print(f"[ERROR] 记录token用量失败: {e}")
+
+# AI响应缓存（SQLite文件，所有gunicorn worker共享）
+AI_CACHE_SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS ai_cache ('
+    'key TEXT PRIMARY KEY, model_id TEXT, response TEXT NOT NULL, '
+    'created_at REAL NOT NULL, last_access REAL NOT NULL)',
+    'CREATE INDEX IF NOT EXISTS ix_ai_cache_last_access ON ai_cache (last_access)',
+    'CREATE TABLE IF NOT EXISTS ai_cache_stats (name TEXT PRIMARY KEY, value INTEGER NOT NULL)',
+    'CREATE TABLE IF NOT EXISTS ai_breaker ('
+    'model_id TEXT PRIMARY KEY, failures INTEGER NOT NULL, opened_until REAL NOT NULL)',
+    'CREATE TABLE IF NOT EXISTS ai_inflight ('
+    'key TEXT PRIMARY KEY, owner TEXT NOT NULL, started_at REAL NOT NULL, '
+    'finished_at REAL, response TEXT)',
+    'CREATE TABLE IF NOT EXISTS ai_rate_bucket (name TEXT PRIMARY KEY, level REAL NOT NULL, updated_at REAL NOT NULL)',
+    'CREATE TABLE IF NOT EXISTS ai_rate_waiter ('
+    'id INTEGER PRIMARY KEY AUTOINCREMENT, user_id TEXT, lane INTEGER NOT NULL, turn INTEGER NOT NULL, '
+    'enqueued_at REAL NOT NULL, heartbeat REAL NOT NULL)',
+)
+
+def _ai_cache_connect():
+    return sqlite_connect(app.config['AI_CACHE_PATH'], AI_CACHE_SCHEMA)
+
+def _normalize_text(text):
+    """统一换行并去掉行尾空白，避免无意义的差异导致缓存未命中"""
+    lines = text.replace('\r\n', '\n').replace('\r', '\n').split('\n')
+    return '\n'.join(line.rstrip() for line in lines).strip()
+
+def _normalize_messages(messages):
+    normalized = []
+    for message in messages:
+        content = message.get('content')
+        if isinstance(content, str):
+            content = _normalize_text(content)
+        elif isinstance(content, list):
+            content = [
+                {**part, 'text': _normalize_text(part['text'])} if part.get('type') == 'text' else part
+                for part in content
+            ]
+        normalized.append({'role': message.get('role'), 'content': content})
+    return normalized
+
+def make_ai_cache_key(model_id, messages, user_level=None):
+    """根据 (模型ID, 规范化后的消息, 用户水平) 计算缓存键"""
+    payload = json.dumps([model_id, _normalize_messages(messages), user_level],
+                         ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def _bump_ai_cache_stat(conn, name, amount=1):
+    conn.execute(
+        'INSERT INTO ai_cache_stats (name, value) VALUES (?, ?) '
+        'ON CONFLICT(name) DO UPDATE SET value = value + excluded.value',
+        (name, amount)
+    )
+
+def record_image_preprocess(original_bytes, sent_bytes):
+    """累计图片预处理的张数与节省的字节数（随 /api/ai-cache/stats 返回）"""
+    try:
+        with closing(_ai_cache_connect()) as conn:
+            _bump_ai_cache_stat(conn, 'images_preprocessed' if sent_bytes < original_bytes else 'images_unchanged')
+            _bump_ai_cache_stat(conn, 'image_bytes_saved', original_bytes - sent_bytes)
+    except sqlite3.Error as e:
+        print(f"[ERROR] 图片预处理统计写入失败: {e}")
+
+def ai_cache_get(key):
+    """读取缓存，过期视为未命中；同时累计命中/未命中次数"""
+    now = time.time()
+    with closing(_ai_cache_connect()) as conn:
+        row = conn.execute('SELECT response, created_at FROM ai_cache WHERE key = ?', (key,)).fetchone()
+        if row and now - row[1] > app.config['AI_CACHE_TTL']:
+            conn.execute('DELETE FROM ai_cache WHERE key = ?', (key,))
+            row = None
+        if row:
+            conn.execute('UPDATE ai_cache SET last_access = ? WHERE key = ?', (now, key))
+            _bump_ai_cache_stat(conn, 'hits')
+            return row[0]
+        _bump_ai_cache_stat(conn, 'misses')
+        return None
+
+def ai_cache_set(key, model_id, response):
+    """写入缓存，并清理过期条目与超出容量上限的最久未使用条目"""
+    now = time.time()
+    with closing(_ai_cache_connect()) as conn:
+        conn.execute(
+            'INSERT OR REPLACE INTO ai_cache (key, model_id, response, created_at, last_access) '
+            'VALUES (?, ?, ?, ?, ?)',
+            (key, model_id, response, now, now)
+        )
+        conn.execute('DELETE FROM ai_cache WHERE created_at < ?', (now - app.config['AI_CACHE_TTL'],))
+        overflow = conn.execute('SELECT COUNT(*) FROM ai_cache').fetchone()[0] - app.config['AI_CACHE_MAX_ENTRIES']
+        if overflow > 0:
+            conn.execute(
+                'DELETE FROM ai_cache WHERE key IN '
+                '(SELECT key FROM ai_cache ORDER BY last_access LIMIT ?)',
+                (overflow,)
+            )
+
+def ai_cache_stats():
+    with closing(_ai_cache_connect()) as conn:
+        stats = dict(conn.execute('SELECT name, value FROM ai_cache_stats').fetchall())
+        entries = conn.execute('SELECT COUNT(*) FROM ai_cache').fetchone()[0]
+    hits, misses = stats.get('hits', 0), stats.get('misses', 0)
+    return {
+        'enabled': app.config['AI_CACHE_ENABLED'],
+        'entries': entries,
+        'max_entries': app.config['AI_CACHE_MAX_ENTRIES'],
+        'ttl': app.config['AI_CACHE_TTL'],
+        'hits': hits,
+        'misses': misses,
+        'hit_rate': round(hits / (hits + misses), 3) if hits + misses else 0,
+        'image_preprocess': {
+            'images_preprocessed': stats.get('images_preprocessed', 0),
+            'images_unchanged': stats.get('images_unchanged', 0),
+            'bytes_saved': stats.get('image_bytes_saved', 0)
+        }
+    }
+
+def request_flag(name, data=None):
+    """读取布尔型请求开关：优先JSON请求体，其次表单/查询参数"""
+    flag = (data or {}).get(name, request.values.get(name, False))
+    if isinstance(flag, str):
+        flag = flag.lower() in ('1', 'true', 'yes')
+    return bool(flag)
+
+def ai_cache_bypassed(data=None):
+    """请求是否要求跳过缓存读取：no_cache 参数或 Cache-Control: no-cache 请求头"""
+    return request_flag('no_cache', data) or 'no-cache' in request.headers.get('Cache-Control', '')
+
+def stream_requested(data=None):
+    """请求是否要求以SSE流式返回：stream 参数或 Accept: text/event-stream"""
+    return request_flag('stream', data) or 'text/event-stream' in request.headers.get('Accept', '')
+
+def _sse_event(payload, event=None):
+    data = json.dumps(payload, ensure_ascii=False)
+    return f"event: {event}\ndata: {data}\n\n" if event else f"data: {data}\n\n"
+
+def sse_response(chunks, on_complete):
+    """把模型增量输出转为Server-Sent Events；流结束后用完整文本调用 on_complete 保存，并发送 done 事件"""
+    def generate():
+        # 先发一个注释行，让客户端立即收到首字节
+        yield ": stream-open\n\n"
+        parts = []
+        try:
+            for chunk in chunks:
+                # 长文档模式会穿插分块进度（dict）
+                if isinstance(chunk, dict):
+                    yield _sse_event(chunk, event='progress')
+                    continue
+                parts.append(chunk)
+                yield _sse_event({'delta': chunk})
+        except PromptBudgetExceeded as e:
+            # 长文档分块等在推流开始后才检查预算的路径
+            yield _sse_event({'error': str(e), 'tokens': e.tokens, 'limit': e.limit}, event='error')
+            return
+        except Exception:
+            yield _sse_event({'error': 'AI服务暂时不可用'}, event='error')
+            return
+        full_text = ''.join(parts)
+        if not full_text:
+            yield _sse_event({'error': 'AI服务暂时不可用'}, event='error')
+            return
+        save_id = on_complete(full_text)
+        yield _sse_event({'save_id': save_id}, event='done')
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+def _ai_cache_lookup(cache_key):
+    try:
+        cached = ai_cache_get(cache_key)
+    except sqlite3.Error as e:
+        print(f"[ERROR] AI缓存读取失败: {e}")
+        return None
+    if cached is not None:
+        print(f"[AI CACHE] 命中缓存: {cache_key[:12]}")
+    return cached
+
+def _ai_cache_store(cache_key, model_id, result):
+    try:
+        ai_cache_set(cache_key, model_id, result)
+    except sqlite3.Error as e:
+        print(f"[ERROR] AI缓存写入失败: {e}")
+
+# 重试、熔断与备用模型（熔断状态保存在共享SQLite中，所有worker一致）
+RETRYABLE_AI_ERRORS = (RateLimitError, APITimeoutError, APIConnectionError, InternalServerError)
+
+class CircuitOpenError(Exception):
+    pass
+
+def breaker_is_open(model_id):
+    with closing(_ai_cache_connect()) as conn:
+        row = conn.execute('SELECT opened_until FROM ai_breaker WHERE model_id = ?', (model_id,)).fetchone()
+    return bool(row) and row[0] > time.time()
+
+def breaker_record_success(model_id):
+    with closing(_ai_cache_connect()) as conn:
+        conn.execute('UPDATE ai_breaker SET failures = 0, opened_until = 0 WHERE model_id = ?', (model_id,))
+
+def breaker_record_failure(model_id):
+    """累计连续失败；达到阈值后熔断一段时间。熔断结束后的首次失败会立即再次熔断（半开状态）"""
+    threshold = app.config['AI_BREAKER_THRESHOLD']
+    with closing(_ai_cache_connect()) as conn:
+        conn.execute(
+            'INSERT INTO ai_breaker (model_id, failures, opened_until) VALUES (?, 1, 0) '
+            'ON CONFLICT(model_id) DO UPDATE SET failures = failures + 1',
+            (model_id,)
+        )
+        updated = conn.execute(
+            'UPDATE ai_breaker SET opened_until = ?, failures = ? WHERE model_id = ? AND failures >= ?',
+            (time.time() + app.config['AI_BREAKER_COOLDOWN'], threshold - 1, model_id, threshold)
+        ).rowcount
+    if updated:
+        print(f"[AI API] 模型 {model_id} 连续失败，熔断 {app.config['AI_BREAKER_COOLDOWN']} 秒")
+
+def route_model(model_id):
+    """主模型熔断时切换到备用模型；都不可用时快速失败"""
+    if not breaker_is_open(model_id):
+        return model_id
+    fallback = app.config['AI_FALLBACK_MODEL_ID']
+    if fallback and fallback != model_id and not breaker_is_open(fallback):
+        print(f"[AI API] 模型 {model_id} 已熔断，改用备用模型 {fallback}")
+        return fallback
+    raise CircuitOpenError(f"模型 {model_id} 已熔断，暂停调用")
+
+def _retry_delay(error, attempt):
+    """带抖动的指数退避；服务端返回 Retry-After 时优先遵循"""
+    max_delay = app.config['AI_RETRY_MAX_DELAY']
+    response = getattr(error, 'response', None)
+    retry_after = response.headers.get('retry-after') if response is not None else None
+    if retry_after:
+        try:
+            return min(float(retry_after), max_delay)
+        except ValueError:
+            pass
+    return random.uniform(0, min(max_delay, app.config['AI_RETRY_BASE_DELAY'] * 2 ** attempt))
+
+AI_RETRY_MIN_REMAINING = 5  # 截止时间前剩余不足该秒数时不再重试
+
+def call_with_resilience(request, model_id, deadline=None):
+    """执行 request(模型ID)：可重试错误按指数退避重试，主模型限流时立即改用备用模型；到达截止时间后不再重试"""
+    fallback = app.config['AI_FALLBACK_MODEL_ID']
+    attempts = app.config['AI_MAX_RETRIES'] + 1
+    for attempt in range(attempts):
+        if deadline is not None and time.time() >= deadline:
+            raise AIDeadlineExceeded(f"模型调用超过 {app.config['AI_CALL_DEADLINE']:g} 秒时限")
+        current = route_model(model_id)
+        try:
+            result = request(current)
+        except RETRYABLE_AI_ERRORS as e:
+            breaker_record_failure(current)
+            if attempt == attempts - 1:
+                raise
+            delay = 0 if isinstance(e, RateLimitError) and fallback and current != fallback else _retry_delay(e, attempt)
+            if deadline is not None and time.time() + delay > deadline - AI_RETRY_MIN_REMAINING:
+                print(f"[AI API] {type(e).__name__}，剩余时间不足，不再重试")
+                raise
+            if isinstance(e, RateLimitError) and fallback and current != fallback:
+                print(f"[AI API] 模型 {current} 限流，改用备用模型 {fallback} 重试")
+                model_id = fallback
+                continue
+            print(f"[AI API] {type(e).__name__}，{delay:.1f} 秒后第 {attempt + 1} 次重试")
+            time.sleep(delay)
+            continue
+        breaker_record_success(current)
+        return result
+
+# 客户端限流：RPM/TPM令牌桶与等待队列都在共享SQLite中，所有worker共用同一份配额
+class RateLimitTimeout(Exception):
+    pass
+
+RATE_WAITER_STALE_SECONDS = 10
+
+def _rate_buckets():
+    """返回 (桶名, 容量, 每秒补充量)；配额为0的桶不参与限流"""
+    buckets = []
+    if app.config['AI_RATE_LIMIT_RPM'] > 0:
+        buckets.append(('requests', app.config['AI_RATE_LIMIT_RPM'], app.config['AI_RATE_LIMIT_RPM'] / 60))
+    if app.config['AI_RATE_LIMIT_TPM'] > 0:
+        buckets.append(('tokens', app.config['AI_RATE_LIMIT_TPM'], app.config['AI_RATE_LIMIT_TPM'] / 60))
+    return buckets
+
+def _rate_try_take(conn, costs, now):
+    """在事务内补充并扣减令牌；不足时不扣减，返回还需等待的秒数"""
+    levels = {}
+    wait = 0
+    for name, capacity, rate in _rate_buckets():
+        row = conn.execute('SELECT level, updated_at FROM ai_rate_bucket WHERE name = ?', (name,)).fetchone()
+        level = capacity if row is None else min(capacity, row[0] + (now - row[1]) * rate)
+        # 单次消耗超过桶容量时按满桶计，避免永远等不到
+        cost = min(costs[name], capacity)
+        levels[name] = level - cost
+        if level < cost:
+            wait = max(wait, (cost - level) / rate)
+    if wait:
+        return wait
+    for name, level in levels.items():
+        conn.execute(
+            'INSERT OR REPLACE INTO ai_rate_bucket (name, level, updated_at) VALUES (?, ?, ?)',
+            (name, level, now)
+        )
+    return 0
+
+def acquire_rate_limit(estimated_tokens, deadline=None):
+    """调用上游前按配额取令牌，不足时排队等待（不超过 AI_RATE_MAX_WAIT 和调用截止时间）；返回预扣的token数
+    
+    排队顺序：短请求车道优先于长请求车道，但长请求排队超过 AI_RATE_LANE_AGING 秒后按短请求车道对待；
+    同一车道内按各用户的第N个请求轮流，避免单个用户占满配额
+    """
+    if not _rate_buckets():
+        return 0
+    reserved = estimated_tokens + app.config['AI_RATE_COMPLETION_RESERVE']
+    costs = {'requests': 1, 'tokens': reserved}
+    lane = 0 if estimated_tokens <= app.config['AI_RATE_SHORT_TOKENS'] else 1
+    user_id = current_ai_user_id()
+    user_id = str(user_id) if user_id is not None else None
+    poll = app.config['AI_SINGLEFLIGHT_POLL_INTERVAL']
+    max_wait = app.config['AI_RATE_MAX_WAIT']
+    if deadline is not None:
+        max_wait = min(max_wait, deadline - time.time())
+    deadline = time.time() + max_wait
+    waiter_id = None
+    waited = False
+    try:
+        while True:
+            now = time.time()
+            wait = poll
+            with closing(_ai_cache_connect()) as conn:
+                conn.execute('BEGIN IMMEDIATE')
+                try:
+                    conn.execute('DELETE FROM ai_rate_waiter WHERE heartbeat < ?', (now - RATE_WAITER_STALE_SECONDS,))
+                    head = conn.execute(
+                        'SELECT id FROM ai_rate_waiter '
+                        'ORDER BY CASE WHEN enqueued_at < ? THEN 0 ELSE lane END, turn, enqueued_at, id LIMIT 1',
+                        (now - app.config['AI_RATE_LANE_AGING'],)
+                    ).fetchone()
+                    if head is None or head[0] == waiter_id:
+                        wait = _rate_try_take(conn, costs, now)
+                        if not wait:
+                            if waiter_id is not None:
+                                conn.execute('DELETE FROM ai_rate_waiter WHERE id = ?', (waiter_id,))
+                                waiter_id = None
+                            conn.execute('COMMIT')
+                            if waited:
+                                print(f"[AI API] 限流排队结束，估算 {estimated_tokens} tokens")
+                            return reserved
+                    if waiter_id is None or not conn.execute(
+                        'UPDATE ai_rate_waiter SET heartbeat = ? WHERE id = ?', (now, waiter_id)
+                    ).rowcount:
+                        # 轮次按用户递增，不因前面的请求离开而重复；没有排队请求的用户从当前最早的轮次加入
+                        turn = conn.execute(
+                            'SELECT MAX(turn) + 1 FROM ai_rate_waiter WHERE user_id IS ? AND lane = ?', (user_id, lane)
+                        ).fetchone()[0]
+                        if turn is None:
+                            turn = conn.execute(
+                                'SELECT COALESCE(MIN(turn), 0) FROM ai_rate_waiter WHERE lane = ?', (lane,)
+                            ).fetchone()[0]
+                        waiter_id = conn.execute(
+                            'INSERT INTO ai_rate_waiter (user_id, lane, turn, enqueued_at, heartbeat) '
+                            'VALUES (?, ?, ?, ?, ?)',
+                            (user_id, lane, turn, now, now)
+                        ).lastrowid
+                    conn.execute('COMMIT')
+                except BaseException:
+                    conn.execute('ROLLBACK')
+                    raise
+            if now > deadline:
+                raise RateLimitTimeout(f"等待AI调用配额超过 {max(max_wait, 0):.0f} 秒")
+            if not waited:
+                print(f"[AI API] 达到客户端限流配额，排队等待（车道 {lane}）")
+                waited = True
+            time.sleep(min(max(wait, poll), 1.0))
+    finally:
+        if waiter_id is not None:
+            with closing(_ai_cache_connect()) as conn:
+                conn.execute('DELETE FROM ai_rate_waiter WHERE id = ?', (waiter_id,))
+
+def settle_rate_limit(reserved, usage, estimated_total=None):
+    """按实际用量退还（或补扣）预扣的token；没有用量信息时按 estimated_total 结算，两者都没有则不结算"""
+    actual = getattr(usage, 'total_tokens', None)
+    if actual is None:
+        actual = estimated_total
+    if actual is not None:
+        _rate_return_tokens(reserved - actual)
+
+def refund_rate_limit(reserved):
+    """调用没有发出或失败时退还预扣的全部token"""
+    _rate_return_tokens(reserved)
+
+def _rate_return_tokens(amount):
+    if not amount or not app.config['AI_RATE_LIMIT_TPM'] > 0:
+        return
+    with closing(_ai_cache_connect()) as conn:
+        conn.execute(
+            'UPDATE ai_rate_bucket SET level = MIN(?, level + ?) WHERE name = ?',
+            (app.config['AI_RATE_LIMIT_TPM'], amount, 'tokens')
+        )
+
+# 相同请求合并（single-flight）：借助共享SQLite中的 ai_inflight 表跨进程协调
+def _single_flight_stale_before(now):
+    # 执行者的调用（含重试与限流排队）不会超过 AI_CALL_DEADLINE，超出这个时长仍未结束才视为执行者已崩溃
+    return now - app.config['AI_CALL_DEADLINE'] - 30
+
+def _single_flight_join(key, owner):
+    """尝试成为执行者（顺带清理过期记录）；返回 ('leader', None)、('done', 结果) 或 ('waiting', None)"""
+    now = time.time()
+    stale_before = _single_flight_stale_before(now)
+    with closing(_ai_cache_connect()) as conn:
+        conn.execute(
+            'DELETE FROM ai_inflight WHERE (finished_at IS NOT NULL AND finished_at < ?) '
+            'OR (finished_at IS NULL AND started_at < ?)',
+            (now - app.config['AI_SINGLEFLIGHT_LINGER'], stale_before)
+        )
+        try:
+            conn.execute('INSERT INTO ai_inflight (key, owner, started_at) VALUES (?, ?, ?)', (key, owner, now))
+            return 'leader', None
+        except sqlite3.IntegrityError:
+            pass
+        row = conn.execute('SELECT response FROM ai_inflight WHERE key = ?', (key,)).fetchone()
+    if row and row[0] is not None:
+        return 'done', row[0]
+    return 'waiting', None
+
+def _single_flight_poll(key):
+    """等待者只读地查看执行者状态；返回 ('done', 结果)、('waiting', None)，执行者已放弃或崩溃时返回 ('vacant', None)"""
+    with closing(_ai_cache_connect()) as conn:
+        row = conn.execute('SELECT response, started_at FROM ai_inflight WHERE key = ?', (key,)).fetchone()
+    if row and row[0] is not None:
+        return 'done', row[0]
+    if not row or row[1] < _single_flight_stale_before(time.time()):
+        return 'vacant', None
+    return 'waiting', None
+
+def _single_flight_release(key, owner, result):
+    """执行者结束：成功时留下结果供等待者读取，失败时删除记录让等待者重新竞争"""
+    with closing(_ai_cache_connect()) as conn:
+        if result:
+            conn.execute(
+                'UPDATE ai_inflight SET response = ?, finished_at = ? WHERE key = ? AND owner = ?',
+                (result, time.time(), key, owner)
+            )
+        else:
+            conn.execute('DELETE FROM ai_inflight WHERE key = ? AND owner = ?', (key, owner))
+
+def single_flight(key, fn, call_deadline=None):
+    """合并相同key的进行中调用：第一个请求执行 fn，其余请求（含其他进程）等待并共享其结果"""
+    owner = f"{os.getpid()}-{threading.get_ident()}"
+    deadline = time.time() + app.config['AI_SINGLEFLIGHT_WAIT']
+    if call_deadline is not None:
+        deadline = min(deadline, call_deadline)
+    role = 'vacant'
+    while True:
+        try:
+            # 只有记录不存在或已失效时才尝试成为执行者，其余轮询不写库
+            if role == 'vacant':
+                role, response = _single_flight_join(key, owner)
+            else:
+                role, response = _single_flight_poll(key)
+        except sqlite3.Error as e:
+            print(f"[ERROR] single-flight协调失败，直接调用: {e}")
+            return fn()
+        
+        if role == 'leader':
+            result = None
+            try:
+                result = fn()
+                return result
+            finally:
+                try:
+                    _single_flight_release(key, owner, result)
+                except sqlite3.Error as e:
+                    print(f"[ERROR] single-flight释放失败: {e}")
+        if role == 'done':
+            print(f"[AI API] 合并到进行中的相同请求: {key[:12]}")
+            return response
+        if role == 'vacant':
+            continue
+        if time.time() > deadline:
+            print(f"[AI API] 等待相同请求超时，直接调用: {key[:12]}")
+            return fn()
+        time.sleep(app.config['AI_SINGLEFLIGHT_POLL_INTERVAL'])
+
+# AI助手功能
+def call_ai_api(messages, model_id=None, user_level=None, use_cache=True, timeout=None):
+    """调用豆包AI API（相同请求优先命中响应缓存；use_cache=False 时跳过读取但仍刷新缓存）
+    
+    相同的请求同时到达时（包括其他worker进程）只发起一次上游调用并共享结果；
+    prompt超出预算且策略为reject时抛出 PromptBudgetExceeded
+    """
+    messages, estimated_tokens = apply_prompt_budget(messages)
+    try:
+        if not model_id:
+            model_id = os.getenv('ARK_MODEL_ID', 'doubao-seed-1-6-250615')
+        
+        cache_key = make_ai_cache_key(model_id, messages, user_level)
+        if use_cache and app.config['AI_CACHE_ENABLED']:
+            cached = _ai_cache_lookup(cache_key)
+            if cached is not None:
+                return cached
+        deadline = ai_deadline()
+        
+        def create_completion(current_model):
+            print(f"[AI API] 调用模型: {current_model}")
+            print(f"[AI API] 消息数量: {len(messages)}, 估算prompt: {estimated_tokens} tokens")
+            
+            reserved = acquire_rate_limit(estimated_tokens, deadline)
+            started = time.time()
+            try:
+                response = ai_client.chat.completions.create(
+                    model=current_model,
+                    messages=messages,
+                    timeout=ai_call_timeout(timeout, deadline)
+                )
+            except Exception:
+                # 失败的尝试（包括随后会重试的）不占用配额
+                refund_rate_limit(reserved)
+                raise
+            settle_rate_limit(reserved, response.usage)
+            record_token_usage(current_model, estimated_tokens, response.usage, started)
+            return current_model, response.choices[0].message.content
+        
+        def request_completion():
+            used_model, result = call_with_resilience(create_completion, model_id, deadline)
+            print(f"[AI API] 响应长度: {len(result) if result else 0} 字符")
+            # 备用模型的结果是降级输出，不写入主模型的缓存key
+            if result and app.config['AI_CACHE_ENABLED'] and used_model == model_id:
+                _ai_cache_store(cache_key, used_model, result)
+            return result
+        
+        # 显式跳过缓存的请求需要新结果，不与进行中的调用合并
+        if use_cache and app.config['AI_SINGLEFLIGHT_ENABLED']:
+            return single_flight(cache_key, request_completion, deadline)
+        return request_completion()
+    except (CircuitOpenError, RateLimitTimeout, AIDeadlineExceeded) as e:
+        print(f"[ERROR] {e}")
+        return None
+    except Exception as e:
+        print(f"[ERROR] AI API调用错误: {e}")
+        print(f"[ERROR] 错误类型: {type(e).__name__}")
+        import traceback
+        print(f"[ERROR] 详细错误信息:\n{traceback.format_exc()}")
+        return None
+
+def stream_ai_api(messages, model_id=None, user_level=None, use_cache=True, timeout=None):
+    """以流式方式调用豆包AI API，返回逐段产出模型输出的生成器；完整结果同样写入响应缓存
+    
+    prompt预算在返回生成器之前检查，超出上限时直接抛出 PromptBudgetExceeded，路由可以返回413而不是开始推流
+    """
+    messages, estimated_tokens = apply_prompt_budget(messages)
+    if not model_id:
+        model_id = os.getenv('ARK_MODEL_ID', 'doubao-seed-1-6-250615')
+    return _stream_ai_chunks(messages, estimated_tokens, model_id, user_level, use_cache, timeout)
+
+def _stream_ai_chunks(messages, estimated_tokens, model_id, user_level, use_cache, timeout):
+    cache_key = None
+    if app.config['AI_CACHE_ENABLED']:
+        cache_key = make_ai_cache_key(model_id, messages, user_level)
+        cached = _ai_cache_lookup(cache_key) if use_cache else None
+        if cached is not None:
+            yield cached
+            return
+    deadline = ai_deadline()
+    
+    def open_stream(current_model):
+        print(f"[AI API] 流式调用模型: {current_model}")
+        print(f"[AI API] 消息数量: {len(messages)}, 估算prompt: {estimated_tokens} tokens")
+        current_reserved = acquire_rate_limit(estimated_tokens, deadline)
+        try:
+            response = ai_client.chat.completions.create(
+                model=current_model,
+                messages=messages,
+                stream=True,
+                stream_options={'include_usage': True},
+                timeout=ai_call_timeout(timeout, deadline)
+            )
+        except Exception:
+            # 建立流失败的尝试（包括随后会重试的）不占用配额
+            refund_rate_limit(current_reserved)
+            raise
+        reserved.append(current_reserved)
+        return current_model, response
+    
+    parts = []
+    usage = None
+    reserved = []
+    started = time.time()
+    try:
+        # 只在建立流之前重试；开始输出后出错直接结束
+        used_model, response = call_with_resilience(open_stream, model_id, deadline)
+        for chunk in response:
+            # 开启 include_usage 后，最后一个分片携带用量且 choices 为空
+            usage = getattr(chunk, 'usage', None) or usage
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                parts.append(delta)
+                yield delta
+    except (CircuitOpenError, RateLimitTimeout, AIDeadlineExceeded) as e:
+        print(f"[ERROR] {e}")
+        raise
+    except Exception as e:
+        print(f"[ERROR] AI API流式调用错误: {e}")
+        print(f"[ERROR] 错误类型: {type(e).__name__}")
+        import traceback
+        print(f"[ERROR] 详细错误信息:\n{traceback.format_exc()}")
+        raise
+    finally:
+        # 中途出错或客户端断开时收不到用量分片，按prompt和已输出的内容估算
+        if reserved:
+            settle_rate_limit(reserved[-1], usage, estimated_tokens + estimate_tokens(''.join(parts)))
+    
+    record_token_usage(used_model, estimated_tokens, usage, started)
+    result = ''.join(parts)
+    print(f"[AI API] 流式响应长度: {len(result)} 字符")
+    if result and cache_key and used_model == model_id:
+        _ai_cache_store(cache_key, used_model, result)
+
+# 长文档分块处理（按标题/段落切分为token预算内的分块，并发生成后按原顺序合并）
+def is_long_document(text):
+    return (app.config['LONG_DOC_ENABLED'] and isinstance(text, str)
+            and estimate_tokens(text) > app.config['LONG_DOC_THRESHOLD_TOKENS'])
+
+def _split_oversized(block, max_tokens):
+    if estimate_tokens(block) <= max_tokens:
+        return [block]
+    lines = block.split('\n')
+    if len(lines) == 1:
+        # 单行仍超限时按字符硬切（每个字符至多1个token，切分结果一定在预算内）
+        return [block[i:i + max_tokens] for i in range(0, len(block), max_tokens)]
+    return [piece for line in lines for piece in _split_oversized(line, max_tokens)]
+
+def split_document(text, max_tokens):
+    """先按Markdown标题和空行段落切分，再贪心装入不超过token预算的分块"""
+    chunks, current, current_tokens = [], [], 0
+    for block in re.split(r'\n(?=#{1,6}\s)|\n\s*\n', text):
+        block = block.strip()
+        if not block:
+            continue
+        for piece in _split_oversized(block, max_tokens):
+            tokens = estimate_tokens(piece)
+            if current and current_tokens + tokens > max_tokens:
+                chunks.append('\n\n'.join(current))
+                current, current_tokens = [], 0
+            current.append(piece)
+            current_tokens += tokens
+    if current:
+        chunks.append('\n\n'.join(current))
+    return chunks
+
+def _iter_document_parts(chunks, generate_part, concurrency=None):
+    """以有限并发生成各分块，按完成顺序产出 (分块序号, 结果)"""
+    user_id = current_ai_user_id()
+    deadline = g.get('ai_deadline')
+
+    def run(chunk):
+        with app.app_context():
+            g.ai_user_id = user_id
+            # 请求中的分块共用请求的截止时间
+            if deadline is not None:
+                g.ai_deadline = deadline
+            return generate_part(chunk)
+
+    pool = ThreadPoolExecutor(max_workers=concurrency or app.config['LONG_DOC_CONCURRENCY'])
+    futures = {pool.submit(run, chunk): index for index, chunk in enumerate(chunks)}
+    try:
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+def _stream_document_parts(chunks, generate_part):
+    parts = [None] * len(chunks)
+    next_index = 0
+    for done, (index, result) in enumerate(_iter_document_parts(chunks, generate_part), 1):
+        if not result:
+            raise RuntimeError(f"第 {index + 1} 块生成失败")
+        parts[index] = result
+        yield {'done': done, 'total': len(chunks)}
+        # 前面的分块都完成后，按原顺序输出
+        while next_index < len(chunks) and parts[next_index] is not None:
+            yield ('\n\n' if next_index else '') + parts[next_index].strip()
+            next_index += 1
+
+_SECTION_HEADING = re.compile(r'^(#{1,6})\s+(.+?)\s*#*\s*$')
+
+def _section_key(title):
+    # "## 1. 文章导读"、"## **词汇**" 与 "## 文章导读" 视为同一小节
+    return re.sub(r'^[\d一二三四五六七八九十]+\s*[.、．)）]\s*', '', re.sub(r'[*_`]', '', title)).strip()
+
+def merge_sections(parts):
+    """按各部分的顶级标题合并：同名小节只保留一个标题，内容按分块顺序拼接在该标题下"""
+    sections = {}  # 小节key -> [标题行, [各分块的内容]]
+    for part in parts:
+        lines = part.strip().split('\n')
+        levels = [len(match.group(1)) for match in map(_SECTION_HEADING.match, lines) if match]
+        top = min(levels) if levels else None
+        heading, key, body = None, '', []
+        for line in lines + [None]:
+            match = _SECTION_HEADING.match(line) if line is not None else None
+            if line is not None and not (match and len(match.group(1)) == top):
+                body.append(line)
+                continue
+            section = sections.setdefault(key, [heading, []])
+            if '\n'.join(body).strip():
+                section[1].append('\n'.join(body).strip())
+            if line is not None:
+                heading, key, body = line.strip(), _section_key(match.group(2)), []
+    return '\n\n'.join('\n\n'.join(([heading] if heading else []) + bodies)
+                       for heading, bodies in sections.values() if bodies)
+
+def _stream_with_fallback(chunks, fallback):
+    """流式合并调用在输出任何内容之前失败时，改为输出 fallback"""
+    produced = False
+    try:
+        for chunk in chunks:
+            produced = True
+            yield chunk
+    except PromptBudgetExceeded:
+        raise
+    except Exception as e:
+        if produced:
+            raise
+        print(f"[ERROR] 长文档合并调用失败，按小节标题合并: {e}")
+        yield fallback
+
+def _stream_reduced_parts(chunks, generate_part, reduce_parts):
+    parts = [None] * len(chunks)
+    for done, (index, result) in enumerate(_iter_document_parts(chunks, generate_part), 1):
+        if not result:
+            raise RuntimeError(f"第 {index + 1} 块生成失败")
+        parts[index] = result
+        yield {'done': done, 'total': len(chunks)}
+    yield from reduce_parts(parts, True)
+
+def generate_long_document(text, generate_part, stream=False, on_progress=None, reduce_parts=None):
+    """长文档模式：分块并发调用 generate_part 并合并各部分Markdown；任一分块失败时返回None
+    
+    reduce_parts(各部分, stream) 用于各分块输出结构相同、需要整体合并的场景（如英语学习材料的导读/词汇/语法），
+    未提供时按原顺序拼接
+    """
+    # 分块预算不超过长文档阈值，保证每个分块都按普通模式处理
+    max_tokens = min(app.config['LONG_DOC_CHUNK_TOKENS'], app.config['LONG_DOC_THRESHOLD_TOKENS'])
+    chunks = split_document(text, max_tokens)
+    print(f"[LONG DOC] 长文档模式，约 {estimate_tokens(text)} tokens，切分为 {len(chunks)} 块")
+    
+    if stream:
+        if reduce_parts:
+            return _stream_reduced_parts(chunks, generate_part, reduce_parts)
+        return _stream_document_parts(chunks, generate_part)
+    
+    parts = [None] * len(chunks)
+    for done, (index, result) in enumerate(_iter_document_parts(chunks, generate_part), 1):
+        if not result:
+            print(f"[ERROR] 长文档第 {index + 1} 块生成失败")
+            return None
+        parts[index] = result
+        print(f"[LONG DOC] 进度: {done}/{len(chunks)}")
+        if on_progress:
+            on_progress(done, len(chunks))
+    if reduce_parts:
+        return reduce_parts(parts, False)
+    return '\n\n'.join(part.strip() for part in parts)
+
+def enhance_notes(content, is_image=False, use_cache=True, stream=False, on_progress=None):
+    """补全笔记功能（stream=True 时返回增量输出的生成器）"""
+    print(f"[ENHANCE] 开始补全笔记，是否为图片: {is_image}")
+    
+    if not is_image and is_long_document(content):
+        return generate_long_document(
+            content, lambda part: enhance_notes(part, use_cache=use_cache), stream, on_progress
+        )
+    
+    if is_image:
+        content = prepare_image_for_ai(content)
+        messages = [
+            {
+                "role": "system",
+                "content": "你是一个专业的学习助手。请分析图片中的内容，提取关键信息，并补全完善相关知识点，使内容更加完整和易于理解。请用Markdown格式输出。"
+            },
+            {
+                "role": "user",
+                "content": [
+                    {
+                        "type": "text",
+                        "text": "请分析这张图片中的内容，提取关键信息并补全相关知识点："
+                    },
+                    {
+                        "type": "image_url",
+                        "image_url": {
+                            "url": content
+                        }
+                    }
+                ]
+            }
+        ]
+    else:
+        messages = [
+            {
+                "role": "system",
+                "content": "你是一个专业的学习助手。请帮助用户补全和完善笔记内容，填补知识点间的逻辑关系，使笔记更加完整和易于理解。请用Markdown格式输出，包含适当的标题、列表和重点标记。"
+            },
+            {
+                "role": "user", 
+                "content": f"请帮我补全和完善以下笔记内容，填补缺失的知识点和逻辑关系：\n\n{content}"
+            }
+        ]
+    ai_api = stream_ai_api if stream else call_ai_api
+    return ai_api(messages, use_cache=use_cache)
+
+def extract_note_keywords(content, use_cache=True):
+    """让模型提取笔记的关键词，返回关键词列表（模型没有按要求输出JSON数组时返回空列表）"""
+    limit = app.config['NOTE_KEYWORDS_MAX']
+    messages = [
+        {
+            "role": "system",
+            "content": "你是一个专业的学习助手。请从学习资料中提取最能概括其知识点的关键词，只输出JSON字符串数组，例如：[\"二次函数\", \"抛物线\"]。"
+        },
+        {
+            "role": "user",
+            "content": f"请为以下内容提取不超过{limit}个关键词：\n\n{content[:app.config['NOTE_KEYWORDS_SOURCE_CHARS']]}"
+        }
+    ]
+    reply = call_ai_api(messages, use_cache=use_cache)
+    match = re.search(r'\[.*\]', reply or '', re.S)
+    try:
+        keywords = json.loads(match.group(0)) if match else []
+    except ValueError:
+        keywords = []
+    keywords = [str(keyword).strip() for keyword in keywords if str(keyword).strip()]
+    return list(dict.fromkeys(keywords))[:limit]
+
+def generate_problem_analysis(problems, is_image=False, use_cache=True, stream=False):
+    """生成题目详细解析（stream=True 时返回增量输出的生成器）"""
+    print(f"[ANALYSIS] 开始解析题目，是否为图片: {is_image}")
+    
+    if is_image:
+        problems = prepare_image_for_ai(problems)
+        messages = [
+            {
+                "role": "system",
+                "content": "你是一个专业的教学助手。请分析图片中的题目，提供详细的解析，包括解题思路、步骤和知识点说明。请用Markdown格式输出。"
+            },
+            {
+                "role": "user",
+                "content": [
+                    {
+                        "type": "text",
+                        "text": "请分析这张图片中的题目并提供详细解析："
+                    },
+                    {
+                        "type": "image_url",
+                        "image_url": {
+                            "url": problems
+                        }
+                    }
+                ]
+            }
+        ]
+    else:
+        messages = [
+            {
+                "role": "system",
+                "content": "你是一个专业的教学助手。请为用户提供详细的题目解析，包括解题思路、步骤和知识点说明。请用Markdown格式输出。"
+            },
+            {
+                "role": "user",
+                "content": f"请为以下题目生成详细的解析：\n\n{problems}"
+            }
+        ]
+    ai_api = stream_ai_api if stream else call_ai_api
+    return ai_api(messages, use_cache=use_cache)
+
+# 优化内容正文存储：正文可放在数据库（默认）、文件系统或本地对象存储（按内容哈希去重），较大的文本按配置压缩
+_zstd = None
+_zstd_loaded = False
+
+def _get_zstd():
+    """按需加载zstandard（可选依赖，未安装时改用gzip）"""
+    global _zstd, _zstd_loaded
+    if not _zstd_loaded:
+        _zstd_loaded = True
+        try:
+            import zstandard
+            _zstd = zstandard
+        except Exception as e:
+            print(f"[CONTENT] 未安装zstandard，改用gzip压缩: {e}")
+    return _zstd
+
+def _compress_text(text):
+    """按配置压缩文本，返回 (数据, 编码)；编码为空表示未压缩"""
+    raw = text.encode('utf-8')
+    codec = app.config['CONTENT_COMPRESSION']
+    if codec == 'none' or len(raw) < app.config['CONTENT_COMPRESS_MIN_BYTES']:
+        return raw, ''
+    if codec == 'zstd' and _get_zstd() is not None:
+        return _zstd.ZstdCompressor(level=3).compress(raw), 'zst'
+    return gzip.compress(raw, compresslevel=6), 'gz'
+
+def _decompress_text(data, codec):
+    if codec == 'zst':
+        return _get_zstd().ZstdDecompressor().decompress(data).decode('utf-8')
+    if codec == 'gz':
+        return gzip.decompress(data).decode('utf-8')
+    return data.decode('utf-8')
+
+def _object_path(key):
+    """对象存储路径：按哈希前两级分目录，避免单个目录文件过多"""
+    return os.path.join(app.config['CONTENT_OBJECT_DIR'], key[:2], key[2:4], key)
+
+def _write_atomic(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+def _put_db(item, data, codec):
+    if not codec:
+        return None
+    item.content_blob = data
+    return f"db:{codec}"
+
+def _put_filesystem(item, data, codec):
+    # 以记录ID命名，不会与其他记录冲突
+    path = os.path.join(app.config['CONTENT_FILE_DIR'], str(item.user_id),
+                        f"{item.id}.md" + (f".{codec}" if codec else ''))
+    _write_atomic(path, data)
+    return f"file:{path}"
+
+def _put_object(item, data, codec):
+    key = hashlib.sha256(data).hexdigest() + (f".{codec}" if codec else '')
+    path = _object_path(key)
+    if not os.path.exists(path):
+        _write_atomic(path, data)
+    return f"object:{key}"
+
+CONTENT_STORE_BACKENDS = {
+    'db': _put_db,
+    'filesystem': _put_filesystem,
+    'object': _put_object,
+}
+
+def store_enhanced_text(item, text):
+    """按当前配置的存储方式写入正文（item 需已flush获得ID），返回被替换的旧存储位置"""
+    old_ref = item.content_ref
+    data, codec = _compress_text(text)
+    ref = CONTENT_STORE_BACKENDS[app.config['CONTENT_STORE']](item, data, codec)
+    item.content_ref = ref
+    item.enhanced_content = text if ref is None else None
+    if not ref or not ref.startswith('db:'):
+        item.content_blob = None
+    return old_ref if old_ref != ref else None
+
+def enhanced_text(item):
+    """读取优化内容正文（与写入时的存储方式无关）"""
+    ref = item.content_ref
+    if not ref:
+        return item.enhanced_content or ''
+    scheme, _, key = ref.partition(':')
+    if scheme == 'db':
+        return _decompress_text(item.content_blob, key)
+    path = key if scheme == 'file' else _object_path(key)
+    with open(path, 'rb') as f:
+        data = f.read()
+    codec = path.rsplit('.', 1)[-1] if path.endswith(('.gz', '.zst')) else ''
+    return _decompress_text(data, codec)
+
+def release_content_ref(ref):
+    """删除不再使用的外部存储文件（对象存储只在没有其他记录引用时删除）；需在提交后调用"""
+    if not ref or ref.startswith('db:'):
+        return
+    scheme, _, key = ref.partition(':')
+    if scheme == 'object':
+        if EnhancedContent.query.filter_by(content_ref=ref).first():
+            return
+        key = _object_path(key)
+    try:
+        os.remove(key)
+    except OSError:
+        pass
+
+def enhanced_download_name(item):
+    if item.file_path:
+        return os.path.basename(item.file_path)
+    created = item.created_at.replace(tzinfo=timezone.utc).astimezone()
+    return f"{item.content_type}_{created:%Y%m%d_%H%M%S}_{item.id}.md"
+
+def render_enhanced_document(item, text=None):
+    """生成查看/下载用的Markdown文档；用户编辑过的内容原样返回"""
+    text = enhanced_text(item) if text is None else text
+    if item.edited_at:
+        return text
+    created = item.created_at.replace(tzinfo=timezone.utc).astimezone()
+    parts = [
+        f"# {(item.content_type or '').title()} - 优化内容\n\n",
+        f"**创建时间**: {created:%Y-%m-%d %H:%M:%S}\n\n"
+    ]
+    if not item.is_image:
+        parts.append(f"## 原始内容\n\n{item.original_content}\n\n")
+    parts.append(f"## 优化后内容\n\n{text}\n")
+    return ''.join(parts)
+
+def _enhanced_record(user_id, original_content, content_type, is_image):
+    return EnhancedContent(
+        user_id=user_id,
+        original_content=original_content if not is_image else "图片内容",
+        content_type=content_type,
+        is_image=is_image
+    )
+
+def save_enhanced_content(user_id, original_content, enhanced_content, content_type, is_image=False):
+    """保存优化后的内容到数据库（正文按配置的存储方式保存）"""
+    try:
+        enhanced_record = _enhanced_record(user_id, original_content, content_type, is_image)
+        
+        db.session.add(enhanced_record)
+        db.session.flush()
+        store_enhanced_text(enhanced_record, enhanced_content)
+        index_enhanced_contents([enhanced_record], [enhanced_content])
+        db.session.commit()
+        index_similar_contents([enhanced_record])
+        
+        print(f"[SAVE] 优化内容已保存: {enhanced_record.id} ({enhanced_record.content_ref or 'db'})")
+        return enhanced_record.id
+        
+    except Exception as e:
+        db.session.rollback()
+        print(f"[ERROR] 保存优化内容失败: {e}")
+        return None
+
+def save_enhanced_contents(user_id, items, content_type):
+    """批量保存优化内容，所有记录在一个事务中提交
+    
+    items 为 (原始内容, 优化内容, 是否图片) 列表，返回与之对应的记录ID列表
+    """
+    records = []
+    try:
+        for original_content, enhanced_content, is_image in items:
+            records.append(_enhanced_record(user_id, original_content, content_type, is_image))
+        db.session.add_all(records)
+        db.session.flush()
+        texts = [enhanced_content for _, enhanced_content, _ in items]
+        for record, text_value in zip(records, texts):
+            store_enhanced_text(record, text_value)
+        index_enhanced_contents(records, texts)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        print(f"[ERROR] 批量保存优化内容失败: {e}")
+        return [None] * len(items)
+    
+    index_similar_contents(records)
+    print(f"[SAVE] 批量保存优化内容 {len(records)} 条")
+    return [record.id for record in records]
+
+def run_note_batch(user_id, items, use_cache=True, on_progress=None):
+    """批量补全：有限并发调用AI，成功的结果通过 save_enhanced_contents 在一个事务中入库；返回每条的状态
+    
+    items 中已带 status 的条目（如笔记不存在）原样作为失败返回，其余需带 content 和 is_image
+    """
+    def enhance_item(item):
+        try:
+            return enhance_notes(item['content'], item['is_image'], use_cache=use_cache), None
+        except PromptBudgetExceeded as e:
+            return None, str(e)
+    
+    pending = [item for item in items if 'status' not in item]
+    g.ai_user_id = int(user_id)
+    finished = 0
+    for index, (result, error) in _iter_document_parts(pending, enhance_item, app.config['BATCH_CONCURRENCY']):
+        pending[index]['enhanced_content'] = result
+        pending[index]['error'] = error or ('AI服务暂时不可用' if not result else None)
+        finished += 1
+        if on_progress:
+            on_progress(finished, len(pending))
+    
+    succeeded = [item for item in pending if item['enhanced_content']]
+    save_ids = save_enhanced_contents(
+        user_id, [(item['content'], item['enhanced_content'], item['is_image']) for item in succeeded], 'note'
+    )
+    for item, save_id in zip(succeeded, save_ids):
+        item['save_id'] = save_id
+    
+    results = []
+    for item in items:
+        if item.get('enhanced_content') and item.get('save_id'):
+            entry = {'status': 'done', 'enhanced_content': item['enhanced_content'], 'save_id': item['save_id']}
+        else:
+            entry = {'status': 'failed', 'error': item.get('error') or '保存失败'}
+        if 'note_id' in item:
+            entry['note_id'] = item['note_id']
+        results.append(entry)
+    return results
+
+def generate_english_study_material(text, user_level, is_image=False, use_cache=True, stream=False, on_progress=None):
+    """生成英语学习材料（stream=True 时返回增量输出的生成器）"""
+    print(f"[ENGLISH] 生成英语学习材料，用户水平: {user_level}, 是否为图片: {is_image}")
+    
+    level_map = {
+        'primary': '小学',
+        'middle': '初中', 
+        'high_school': '高中',
+        'cet4': '大学四级',
+        'cet6': '大学六级',
+        'ielts_toefl': '雅思托福'
+    }
+    
+    if not is_image and is_long_document(text):
+        def reduce_parts(parts, stream):
+            return _reduce_english_parts(parts, level_map.get(user_level, '高中'), user_level, use_cache, stream)
+        
+        return generate_long_document(
+            text, lambda part: generate_english_study_material(part, user_level, use_cache=use_cache),
+            stream, on_progress, reduce_parts
+        )
+    
+    if is_image:
+        text = prepare_image_for_ai(text)
+        messages = [
+            {
+                "role": "system",
+                "content": f"你是一个专业的英语学习助手。用户的英语水平是{level_map.get(user_level, '高中')}。请分析图片中的英语内容并生成学习材料，用Markdown格式输出。"
+            },
+            {
+                "role": "user",
+                "content": [
+                    {
+                        "type": "text",
+                        "text": f"请分析这张图片中的英语内容，根据我的英语水平({level_map.get(user_level, '高中')})生成学习材料，包括：1.内容导读 2.重点词汇及其释义 3.语法结构分析："
+                    },
+                    {
+                        "type": "image_url",
+                        "image_url": {
+                            "url": text
+                        }
+                    }
+                ]
+            }
+        ]
+    else:
+        messages = [
+            {
+                "role": "system",
+                "content": f"你是一个专业的英语学习助手。用户的英语水平是{level_map.get(user_level, '高中')}。请根据用户水平生成学习材料，用Markdown格式输出。"
+            },
+            {
+                "role": "user",
+                "content": f"请为以下英语文章生成学习材料，包括：1.文章导读 2.超出用户水平的词汇及其英文释义 3.重点语法结构分析：\n\n{text}"
+            }
+        ]
+    ai_api = stream_ai_api if stream else call_ai_api
+    return ai_api(messages, user_level=user_level, use_cache=use_cache)
+
+def _reduce_english_parts(parts, level_name, user_level, use_cache, stream):
+    """长文章各分块的学习材料各有一套导读/词汇/语法，最后再调用一次模型整合为一份；
+    超出prompt预算或调用失败时退回按小节标题去重合并"""
+    merged = merge_sections(parts)
+    messages = [
+        {
+            "role": "system",
+            "content": f"你是一个专业的英语学习助手。用户的英语水平是{level_name}。请用Markdown格式输出。"
+        },
+        {
+            "role": "user",
+            "content": f"以下是一篇长文章分段生成的学习材料，请整合为一份完整的学习材料：1.把各段导读合并为一篇文章导读 2.合并词汇并去掉重复的词 3.合并语法结构分析并去掉重复的条目：\n\n{merged}"
+        }
+    ]
+    if count_message_tokens(messages) > app.config['AI_MAX_PROMPT_TOKENS']:
+        print("[LONG DOC] 合并内容超出prompt预算，按小节标题合并")
+        return iter([merged]) if stream else merged
+    print(f"[LONG DOC] 整合 {len(parts)} 块的学习材料")
+    if stream:
+        return _stream_with_fallback(stream_ai_api(messages, user_level=user_level, use_cache=use_cache), merged)
+    return call_ai_api(messages, user_level=user_level, use_cache=use_cache) or merged
+
+# AI异步任务队列（任务表存放在数据库中，worker线程可在任意进程中运行）
+AI_JOB_HANDLERS = {
+    'note': lambda p, on_progress: enhance_notes(p['content'], p['is_image'], use_cache=p['use_cache'],
+                                                 on_progress=on_progress),
+    'problem': lambda p, on_progress: generate_problem_analysis(p['content'], p['is_image'], use_cache=p['use_cache']),
+    'english': lambda p, on_progress: generate_english_study_material(p['content'], p['user_level'], p['is_image'],
+                                                                      use_cache=p['use_cache'], on_progress=on_progress),
+}
+
+_job_wakeup = threading.Event()
+_job_workers = []
+_job_workers_lock = threading.Lock()
+_job_requeue_at = 0.0  # 本进程下一次检查心跳超时任务的时间
+_job_requeue_lock = threading.Lock()
+
+def enqueue_ai_job(user_id, job_type, content, is_image=False, use_cache=True, user_level=None):
+    """创建排队中的AI任务并唤醒本进程的worker"""
+    return enqueue_job(user_id, job_type, {
+        'content': content,
+        'is_image': is_image,
+        'use_cache': use_cache,
+        'user_level': user_level
+    })
+
+def enqueue_job(user_id, job_type, payload):
+    job = AIJob(
+        user_id=int(user_id),
+        job_type=job_type,
+        payload=json.dumps(payload, ensure_ascii=False)
+    )
+    db.session.add(job)
+    db.session.commit()
+    print(f"[JOB] 任务已入队，ID: {job.id}, 类型: {job_type}")
+    
+    if app.config['JOB_EMBEDDED_WORKERS']:
+        start_job_workers()
+    _job_wakeup.set()
+    return job
+
+def requeue_stale_jobs():
+    """心跳超时的运行中任务重新排队；每个进程最多每 JOB_REQUEUE_INTERVAL 秒执行一次，空闲轮询不会反复写库"""
+    global _job_requeue_at
+    with _job_requeue_lock:
+        if time.time() < _job_requeue_at:
+            return 0
+        _job_requeue_at = time.time() + app.config['JOB_REQUEUE_INTERVAL']
+    stale_before = datetime.utcnow() - timedelta(seconds=app.config['JOB_STALE_SECONDS'])
+    last_seen = db.func.coalesce(AIJob.heartbeat_at, AIJob.started_at)
+    requeued = AIJob.query.filter(AIJob.status == 'running', last_seen < stale_before).update(
+        {'status': 'queued'}, synchronize_session=False
+    )
+    db.session.commit()
+    if requeued:
+        print(f"[JOB] {requeued} 个心跳超时的任务已重新排队")
+    return requeued
+
+def claim_next_job():
+    """原子地领取一个排队中的任务（条件UPDATE保证多个worker不会重复领取）"""
+    requeue_stale_jobs()
+    
+    job = AIJob.query.filter_by(status='queued').order_by(AIJob.id).first()
+    if not job:
+        return None
+    now = datetime.utcnow()
+    claimed = AIJob.query.filter_by(id=job.id, status='queued').update(
+        {'status': 'running', 'started_at': now, 'heartbeat_at': now}, synchronize_session=False
+    )
+    db.session.commit()
+    if not claimed:
+        return None
+    db.session.refresh(job)
+    return job
+
+def _job_heartbeat_loop(job_id, stopped):
+    """任务执行期间在独立线程中定期写入心跳，长任务不会被当成崩溃而重复执行"""
+    while not stopped.wait(app.config['JOB_HEARTBEAT_INTERVAL']):
+        with app.app_context():
+            try:
+                AIJob.query.filter_by(id=job_id, status='running').update(
+                    {'heartbeat_at': datetime.utcnow()}, synchronize_session=False
+                )
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                print(f"[ERROR] 任务 {job_id} 心跳写入失败: {e}")
+
+def run_job_with_heartbeat(job):
+    stopped = threading.Event()
+    threading.Thread(target=_job_heartbeat_loop, args=(job.id, stopped), name=f'job-heartbeat-{job.id}',
+                     daemon=True).start()
+    try:
+        JOB_RUNNERS.get(job.job_type, run_ai_job)(job)
+    finally:
+        stopped.set()
+
+def update_job_progress(job, done, total):
+    """记录长文档任务的分块进度"""
+    job.progress = f"{done}/{total}"
+    db.session.commit()
+
+def update_job_stage(job, stage):
+    """记录上传处理任务当前所处的步骤"""
+    job.progress = stage
+    db.session.commit()
+
+def run_upload_job(job):
+    """执行上传文件的后台处理流水线，失败时笔记标记为 failed"""
+    payload = json.loads(job.payload)
+    g.ai_user_id = job.user_id
+    print(f"[JOB] 开始执行任务 {job.id}, 类型: upload, 笔记: {payload['note_id']}")
+    
+    try:
+        note = db.session.get(Note, payload['note_id'])
+        if not note:
+            raise LookupError('笔记已删除')
+        job.result, job.save_id = process_note_upload(note, payload, lambda stage: update_job_stage(job, stage))
+        job.status = 'done'
+    except Exception as e:
+        # 处理期间笔记被删除等情况会使会话事务失效，先回滚再读写任务记录
+        db.session.rollback()
+        print(f"[ERROR] 任务 {job.id} 执行失败: {e}")
+        mark_note_failed(payload['note_id'])
+        job.error = '文件处理失败'
+        job.status = 'failed'
+    job.finished_at = datetime.utcnow()
+    db.session.commit()
+    print(f"[JOB] 任务 {job.id} 结束，状态: {job.status}")
+
+def run_batch_job(job):
+    """执行批量笔记补全任务，每条的结果以JSON列表保存在任务结果中"""
+    payload = json.loads(job.payload)
+    print(f"[JOB] 开始执行任务 {job.id}, 类型: note_batch, 共 {len(payload['items'])} 条")
+    try:
+        results = run_note_batch(job.user_id, payload['items'], payload['use_cache'],
+                                 lambda done, total: update_job_progress(job, done, total))
+        job.result = json.dumps(results, ensure_ascii=False)
+        job.status = 'done'
+    except Exception as e:
+        db.session.rollback()
+        print(f"[ERROR] 任务 {job.id} 执行失败: {e}")
+        job.error = 'AI服务暂时不可用'
+        job.status = 'failed'
+    job.finished_at = datetime.utcnow()
+    db.session.commit()
+    print(f"[JOB] 任务 {job.id} 结束，状态: {job.status}")
+
+def run_ai_job(job):
+    """执行一个AI任务并保存结果"""
+    payload = json.loads(job.payload)
+    g.ai_user_id = job.user_id
+    print(f"[JOB] 开始执行任务 {job.id}, 类型: {job.job_type}")
+    
+    error = 'AI服务暂时不可用'
+    try:
+        result = AI_JOB_HANDLERS[job.job_type](payload, lambda done, total: update_job_progress(job, done, total))
+    except PromptBudgetExceeded as e:
+        print(f"[ERROR] 任务 {job.id} 执行失败: {e}")
+        result = None
+        error = str(e)
+    except Exception as e:
+        print(f"[ERROR] 任务 {job.id} 执行失败: {e}")
+        result = None
+    
+    if result:
+        job.save_id = save_enhanced_content(job.user_id, payload['content'], result, job.job_type, payload['is_image'])
+        job.result = result
+        job.status = 'done'
+    else:
+        job.error = error
+        job.status = 'failed'
+    job.finished_at = datetime.utcnow()
+    db.session.commit()
+    print(f"[JOB] 任务 {job.id} 结束，状态: {job.status}")
+
+JOB_RUNNERS = {'upload': run_upload_job, 'note_batch': run_batch_job}  # 其余类型由 run_ai_job 按 AI_JOB_HANDLERS 执行
+
+def _job_worker_loop():
+    while True:
+        job = None
+        with app.app_context():
+            try:
+                job = claim_next_job()
+                if job:
+                    run_job_with_heartbeat(job)
+            except Exception as e:
+                print(f"[ERROR] 任务worker异常: {e}")
+                db.session.rollback()
+        if not job:
+            _job_wakeup.wait(app.config['JOB_POLL_INTERVAL'])
+            _job_wakeup.clear()
+
+def start_job_workers(concurrency=None):
+    """启动任务worker线程（每个进程只启动一次）"""
+    concurrency = concurrency or app.config['JOB_WORKER_CONCURRENCY']
+    with _job_workers_lock:
+        if _job_workers:
+            return _job_workers
+        for i in range(concurrency):
+            worker = threading.Thread(target=_job_worker_loop, name=f"ai-job-worker-{i}", daemon=True)
+            worker.start()
+            _job_workers.append(worker)
+    print(f"[JOB] 已启动 {concurrency} 个任务worker")
+    return _job_workers
+
+def job_accepted(job):
+    return jsonify({'job_id': job.id, 'status': job.status}), 202
+
+# 笔记访问计数：进程内累积 (用户, 笔记) 的访问增量，定期或达到阈值时一次性UPSERT写库
+_access_buffer = {}  # (user_id, note_id) -> [增量, 最后访问时间]
+_access_buffer_lock = threading.Lock()
+_access_flusher_pid = None
+
+def upsert_insert(model):
+    """返回带 on_conflict_do_update 的 INSERT 语句构造器（支持SQLite与PostgreSQL）"""
+    if db.engine.dialect.name == 'postgresql':
+        return postgresql_insert(model)
+    return sqlite_insert(model)
+
+def _write_note_accesses(entries):
+    """把 {(用户, 笔记): [增量, 最后访问时间]} 批量UPSERT到 ProgressRecord"""
+    stmt = upsert_insert(ProgressRecord)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['user_id', 'note_id'],
+        set_={
+            'access_count': ProgressRecord.access_count + stmt.excluded.access_count,
+            'last_accessed': stmt.excluded.last_accessed
+        }
+    )
+    with db.engine.begin() as conn:
+        # 跳过缓冲期间已被删除的笔记（可能由其他进程删除）
+        live = {row[0] for row in conn.execute(
+            db.select(Note.id).where(Note.id.in_([note_id for _, note_id in entries]))
+        )}
+        entries = {key: value for key, value in entries.items() if key[1] in live}
+        if not entries:
+            return
+        rows = [{
+            'user_id': user_id, 'note_id': note_id, 'access_count': count,
+            'mastery_level': 0, 'last_accessed': last_accessed
+        } for (user_id, note_id), (count, last_accessed) in entries.items()]
+        by_user = {}
+        for (user_id, note_id), (count, last_accessed) in entries.items():
+            by_user.setdefault(user_id, {})[note_id] = (count, last_accessed)
+        existing = {user_id: _existing_progress_notes(conn, user_id, notes) for user_id, notes in by_user.items()}
+        conn.execute(stmt, rows)
+        for user_id, notes in by_user.items():
+            _apply_accesses_to_stats(conn, user_id, notes, len(notes) - len(existing[user_id]))
+
+def flush_note_accesses():
+    """把缓冲中的访问增量写库；失败时放回缓冲等待下次写入"""
+    with _access_buffer_lock:
+        if not _access_buffer:
+            return 0
+        entries = dict(_access_buffer)
+        _access_buffer.clear()
+    try:
+        _write_note_accesses(entries)
+    except Exception as e:
+        print(f"[ERROR] 写入笔记访问计数失败: {e}")
+        with _access_buffer_lock:
+            for key, (count, last_accessed) in entries.items():
+                pending = _access_buffer.setdefault(key, [0, last_accessed])
+                pending[0] += count
+                pending[1] = max(pending[1], last_accessed)
+        return 0
+    return len(entries)
+
+def _access_flusher_loop():
+    while True:
+        time.sleep(app.config['ACCESS_FLUSH_INTERVAL'])
+        with app.app_context():
+            flush_note_accesses()
+
+def _start_access_flusher():
+    """按需启动定时写库线程（gunicorn fork 后每个worker各自启动一个）"""
+    global _access_flusher_pid
+    with _access_buffer_lock:
+        if _access_flusher_pid == os.getpid():
+            return
+        _access_flusher_pid = os.getpid()
+    threading.Thread(target=_access_flusher_loop, name='note-access-flusher', daemon=True).start()
+
+def record_note_access(user_id, note_id):
+    """记录一次笔记访问（先进入缓冲，不占用数据库写锁）"""
+    key = (int(user_id), int(note_id))
+    now = datetime.utcnow()
+    if not app.config['ACCESS_BUFFER_ENABLED']:
+        _write_note_accesses({key: [1, now]})
+        return
+    
+    _start_access_flusher()
+    with _access_buffer_lock:
+        pending = _access_buffer.setdefault(key, [0, now])
+        pending[0] += 1
+        pending[1] = now
+        full = len(_access_buffer) >= app.config['ACCESS_FLUSH_THRESHOLD']
+    if full:
+        flush_note_accesses()
+
+def discard_note_accesses(user_id, note_id):
+    """丢弃已删除笔记在当前进程中尚未写库的访问增量"""
+    with _access_buffer_lock:
+        _access_buffer.pop((int(user_id), int(note_id)), None)
+
+def pending_note_accesses(user_id):
+    """当前进程中该用户尚未写库的访问增量：{笔记ID: (增量, 最后访问时间)}"""
+    user_id = int(user_id)
+    with _access_buffer_lock:
+        return {note_id: tuple(value) for (uid, note_id), value in _access_buffer.items() if uid == user_id}
+
+@atexit.register
+def _flush_note_accesses_on_exit():
+    if _access_buffer:
+        with app.app_context():
+            flushed = flush_note_accesses()
+        print(f"[DB] 退出前写入 {flushed} 条笔记访问计数")
+
+# 生词记录（依赖 (user_id, word) 唯一索引做UPSERT）
+def upsert_vocabulary(user_id, words):
+    """按 (user_id, word) 唯一键一次性写入 {单词: 是否掌握}"""
+    stmt = upsert_insert(VocabularyRecord)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['user_id', 'word'],
+        set_={'known': stmt.excluded.known}
+    )
+    now = datetime.utcnow()
+    db.session.execute(stmt, [
+        {'user_id': int(user_id), 'word': word, 'known': known, 'created_at': now}
+        for word, known in words.items()
+    ])
+    db.session.commit()
+
+# 学习统计：UserStats 汇总表随笔记创建/访问增量更新，进度接口只需按主键读取一行
+RECENT_NOTES_LIMIT = 5
+_stats_cache = {}  # user_id -> (过期时间, 响应数据)
+_stats_cache_lock = threading.Lock()
+
+def _recent_note_entry(note_id, title, category, access_count, last_accessed):
+    return {
+        'note_id': note_id,
+        'title': title,
+        'category': category,
+        'access_count': access_count,
+        'last_accessed': last_accessed.isoformat()
+    }
+
+def compute_user_stats(user_id):
+    """从原始记录重新计算一个用户的统计数据"""
+    total_notes = Note.query.filter_by(user_id=user_id).count()
+    progress_count, total_access, mastery_sum = db.session.query(
+        db.func.count(ProgressRecord.id),
+        db.func.coalesce(db.func.sum(ProgressRecord.access_count), 0),
+        db.func.coalesce(db.func.sum(ProgressRecord.mastery_level), 0)
+    ).filter(ProgressRecord.user_id == user_id).one()
+    
+    recent_notes = db.session.query(Note, ProgressRecord).join(
+        ProgressRecord, Note.id == ProgressRecord.note_id
+    ).filter(Note.user_id == user_id, ProgressRecord.user_id == user_id).order_by(
+        ProgressRecord.last_accessed.desc()
+    ).limit(RECENT_NOTES_LIMIT).all()
+    
+    return {
+        'total_notes': total_notes,
+        'total_access': total_access,
+        'progress_count': progress_count,
+        'mastery_sum': mastery_sum,
+        'recent_notes': json.dumps([
+            _recent_note_entry(note.id, note.title, note.category, progress.access_count, progress.last_accessed)
+            for note, progress in recent_notes
+        ], ensure_ascii=False)
+    }
+
+def rebuild_user_stats(user_ids=None):
+    """重新计算指定用户（默认全部用户）的统计汇总，返回处理的用户数"""
+    if user_ids is None:
+        user_ids = [row[0] for row in db.session.query(User.id).all()]
+    for user_id in user_ids:
+        db.session.merge(UserStats(user_id=user_id, **compute_user_stats(user_id)))
+    db.session.commit()
+    return len(user_ids)
+
+def get_user_stats(user_id):
+    """读取用户统计汇总；没有汇总行（如升级前注册的用户）时从原始记录生成"""
+    stats = db.session.get(UserStats, user_id)
+    if stats is None:
+        rebuild_user_stats([user_id])
+        stats = db.session.get(UserStats, user_id)
+    return stats
+
+def adjust_user_note_count(user_id, delta):
+    """在当前会话事务中调整笔记数；汇总行不存在时跳过，首次读取时会完整生成"""
+    db.session.execute(
+        db.update(UserStats).where(UserStats.user_id == int(user_id)).values(
+            total_notes=UserStats.total_notes + delta
+        )
+    )
+
+def _existing_progress_notes(conn, user_id, note_ids):
+    rows = conn.execute(db.select(ProgressRecord.note_id).where(
+        ProgressRecord.user_id == user_id, ProgressRecord.note_id.in_(list(note_ids))
+    ))
+    return {row[0] for row in rows}
+
+def _apply_accesses_to_stats(conn, user_id, notes, new_records):
+    """把一批访问增量合并进用户的统计汇总（与进度记录写入在同一事务中）"""
+    row = conn.execute(db.select(UserStats.recent_notes).where(UserStats.user_id == user_id)).first()
+    if row is None:
+        return
+    
+    recent = {entry['note_id']: entry for entry in json.loads(row[0] or '[]')}
+    current = conn.execute(
+        db.select(Note.id, Note.title, Note.category, ProgressRecord.access_count, ProgressRecord.last_accessed)
+        .join(ProgressRecord, Note.id == ProgressRecord.note_id)
+        .where(ProgressRecord.user_id == user_id, Note.id.in_(list(notes)))
+    )
+    for note_id, title, category, access_count, last_accessed in current:
+        recent[note_id] = _recent_note_entry(note_id, title, category, access_count, last_accessed)
+    recent = sorted(recent.values(), key=lambda entry: entry['last_accessed'], reverse=True)[:RECENT_NOTES_LIMIT]
+    
+    conn.execute(db.update(UserStats).where(UserStats.user_id == user_id).values(
+        total_access=UserStats.total_access + sum(count for count, _ in notes.values()),
+        progress_count=UserStats.progress_count + new_records,
+        recent_notes=json.dumps(recent, ensure_ascii=False),
+        updated_at=datetime.utcnow()
+    ))
+
+# 全文搜索：SQLite FTS5 索引笔记和优化内容；中文按重叠二元组切分后交给 unicode61 分词
+SEARCH_IMAGE_TYPES = ['jpg', 'jpeg', 'png', 'gif', 'bmp', 'webp']
+_CJK_RUN = re.compile(r'[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\u3040-\u30ff\uac00-\ud7af]+')
+
+_search_index_ready = False
+
+def search_enabled():
+    """仅SQLite支持；索引表由迁移创建，未执行迁移时跳过索引维护"""
+    global _search_index_ready
+    if not _search_index_ready and db.engine.dialect.name == 'sqlite':
+        _search_index_ready = db.session.execute(
+            text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'search_index'")
+        ).first() is not None
+    return _search_index_ready
+
+def segment_cjk(text):
+    """把连续的中日韩字符拆成重叠的二元组（"函数图像" -> "函数 数图 图像"），其余文本保持不变"""
+    def bigrams(match):
+        run = match.group()
+        if len(run) == 1:
+            return f" {run} "
+        return ' ' + ' '.join(run[i:i + 2] for i in range(len(run) - 1)) + ' '
+    return _CJK_RUN.sub(bigrams, text or '')
+
+def _search_rowid(kind, item_id):
+    # 笔记和优化内容共用一张索引表，用rowid奇偶区分
+    return item_id * 2 + (1 if kind == 'enhanced' else 0)
+
+def _search_document(kind, item_id, user_id, title, body):
+    return {
+        'rowid': _search_rowid(kind, item_id),
+        'owner': f"u{user_id}",
+        'title': segment_cjk(title),
+        'body': segment_cjk(body)
+    }
+
+def _note_search_document(note):
+    # 图片笔记的内容是base64，只索引标题
+    body = '' if (note.file_type or '').lower() in SEARCH_IMAGE_TYPES else note.content
+    return _search_document('note', note.id, note.user_id, note.title, body)
+
+def _enhanced_search_document(item, body=None):
+    body = enhanced_text(item) if body is None else body
+    return _search_document('enhanced', item.id, item.user_id, enhanced_download_name(item), body)
+
+def _write_search_documents(conn, documents):
+    conn.execute(text('DELETE FROM search_index WHERE rowid = :rowid'), [{'rowid': d['rowid']} for d in documents])
+    conn.execute(
+        text('INSERT INTO search_index (rowid, owner, title, body) VALUES (:rowid, :owner, :title, :body)'),
+        documents
+    )
+
+def index_note(note):
+    """在当前会话事务中写入/更新笔记的搜索索引（note 需已flush获得ID）"""
+    if search_enabled():
+        _write_search_documents(db.session, [_note_search_document(note)])
+
+def index_enhanced_contents(items, bodies=None):
+    """在当前会话事务中写入/更新优化内容的搜索索引（bodies 为已知的正文，省去再次读取）"""
+    if search_enabled() and items:
+        bodies = bodies or [None] * len(items)
+        _write_search_documents(db.session, [
+            _enhanced_search_document(item, body) for item, body in zip(items, bodies)
+        ])
+
+def unindex_search_document(kind, item_id):
+    if search_enabled():
+        db.session.execute(text('DELETE FROM search_index WHERE rowid = :rowid'),
+                           {'rowid': _search_rowid(kind, item_id)})
+
+def create_search_index(conn):
+    if conn.dialect.name == 'sqlite':
+        conn.execute(text(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5(owner, title, body, tokenize='unicode61')"
+        ))
+
+def rebuild_search_index(conn):
+    """重建全文搜索索引（非SQLite数据库跳过；早期迁移中执行时表里还没有的正文存储列按空值读取）"""
+    if conn.dialect.name != 'sqlite':
+        return
+    conn.execute(text('DROP TABLE IF EXISTS search_index'))
+    create_search_index(conn)
+    
+    notes = conn.execute(db.select(Note.id, Note.user_id, Note.title, Note.content, Note.file_type))
+    while batch := notes.fetchmany(500):
+        _write_search_documents(conn, [_note_search_document(row) for row in batch])
+    existing = {column['name'] for column in inspect(conn).get_columns('enhanced_content')}
+    storage = [getattr(EnhancedContent, name) if name in existing else db.literal(None).label(name)
+               for name in ('content_ref', 'content_blob')]
+    items = conn.execute(db.select(
+        EnhancedContent.id, EnhancedContent.user_id, EnhancedContent.file_path, EnhancedContent.content_type,
+        EnhancedContent.created_at, EnhancedContent.enhanced_content, *storage
+    ))
+    while batch := items.fetchmany(500):
+        _write_search_documents(conn, [_enhanced_search_document(row) for row in batch])
+
+def build_search_query(user_id, keywords):
+    """把用户输入转换成FTS5查询：每个关键词作为一个短语，最后一个词按前缀匹配；没有可检索的词时返回None"""
+    phrases = []
+    for keyword in keywords.split():
+        tokens = re.findall(r'\w+', segment_cjk(keyword))
+        if tokens:
+            phrases.append('"' + ' '.join(tokens) + '"*')
+    if not phrases:
+        return None
+    return f"owner:u{int(user_id)} AND {{title body}}: ({' AND '.join(phrases)})"
+
+def highlight_snippet(text, keywords, width=None):
+    """截取第一个命中位置附近的文本，并用 <mark> 标出所有关键词"""
+    width = width or app.config['SEARCH_SNIPPET_CHARS']
+    text = text or ''
+    terms = [term for term in keywords.split() if term]
+    lowered = text.lower()
+    hits = [lowered.find(term.lower()) for term in terms]
+    first = min([hit for hit in hits if hit >= 0], default=0)
+    start = max(0, first - width // 4)
+    snippet = text[start:start + width]
+    
+    pattern = re.compile('|'.join(re.escape(term) for term in sorted(terms, key=len, reverse=True)), re.IGNORECASE)
+    parts = []
+    last = 0
+    for match in pattern.finditer(snippet):
+        parts.append(html.escape(snippet[last:match.start()]))
+        parts.append(f"<mark>{html.escape(match.group())}</mark>")
+        last = match.end()
+    parts.append(html.escape(snippet[last:]))
+    return ('…' if start > 0 else '') + ''.join(parts) + ('…' if start + width < len(text) else '')
+
+# 相似内容复用：本地哈希n-gram向量 + 内存映射的NumPy矩阵，暴力计算余弦相似度查找可复用的历史结果
+SIMILAR_CONTENT_TYPES = ('note', 'problem')
+SIMILAR_EXACT_TYPES = ('problem',)  # 这些类型只在原文完全相同时复用
+SIMILAR_SCAN_BLOCK = 8192
+SIMILAR_INDEX_SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS similar_vectors ('
+    'row INTEGER PRIMARY KEY, enhanced_id INTEGER UNIQUE NOT NULL, user_id INTEGER NOT NULL, '
+    'content_type TEXT NOT NULL, deleted INTEGER NOT NULL DEFAULT 0)',
+    'CREATE INDEX IF NOT EXISTS ix_similar_vectors_scope ON similar_vectors (content_type, user_id, deleted)',
+)
+_numpy = None
+_numpy_loaded = False
+
+def _get_numpy():
+    """按需加载NumPy（可选依赖，未安装时不启用相似内容复用）"""
+    global _numpy, _numpy_loaded
+    if not _numpy_loaded:
+        _numpy_loaded = True
+        try:
+            import numpy
+            _numpy = numpy
+        except Exception as e:
+            print(f"[SIMILAR] 未安装numpy，不启用相似内容复用: {e}")
+    return _numpy
+
+def _similar_vectors_path():
+    return os.path.join(app.config['SIMILAR_INDEX_DIR'], 'vectors.f32')
+
+def _similar_connect():
+    os.makedirs(app.config['SIMILAR_INDEX_DIR'], exist_ok=True)
+    return sqlite_connect(os.path.join(app.config['SIMILAR_INDEX_DIR'], 'meta.db'), SIMILAR_INDEX_SCHEMA)
+
+def embed_text(text):
+    """计算本地文本向量：字符二元/三元组带符号哈希到固定维度，按对数词频加权后L2归一化"""
+    np = _get_numpy()
+    dim = app.config['SIMILAR_DIM']
+    text = re.sub(r'\s+', ' ', _normalize_text(text or '')[:app.config['SIMILAR_MAX_CHARS']].lower())
+    vector = np.zeros(dim, dtype=np.float32)
+    grams = [text[i:i + n] for n in (2, 3) for i in range(len(text) - n + 1)]
+    if not grams:
+        return vector
+    hashes = np.fromiter((zlib.crc32(gram.encode('utf-8')) for gram in grams), dtype=np.uint32, count=len(grams))
+    signs = np.where(hashes >> 31, -1.0, 1.0).astype(np.float32)
+    np.add.at(vector, (hashes % dim).astype(np.int64), signs)
+    vector = np.sign(vector) * np.log1p(np.abs(vector))
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+def _similar_entry(item):
+    """EnhancedContent -> (ID, 用户ID, 类型, 原文)；图片和不支持的类型返回None"""
+    if item.is_image or item.content_type not in SIMILAR_CONTENT_TYPES or not item.original_content:
+        return None
+    return item.id, item.user_id, item.content_type, item.original_content
+
+def _append_similar_vectors(entries):
+    """在SQLite写锁内分配行号并写入向量文件，保证多进程追加时行号与文件偏移一致"""
+    np = _get_numpy()
+    row_bytes = app.config['SIMILAR_DIM'] * 4
+    vectors_path = _similar_vectors_path()
+    with closing(_similar_connect()) as conn:
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            mode = 'r+b' if os.path.exists(vectors_path) else 'w+b'
+            with open(vectors_path, mode) as f:
+                for enhanced_id, user_id, content_type, original_content in entries:
+                    cursor = conn.execute(
+                        'INSERT OR IGNORE INTO similar_vectors (enhanced_id, user_id, content_type) VALUES (?, ?, ?)',
+                        (enhanced_id, user_id, content_type)
+                    )
+                    # 插入被忽略时 lastrowid 是本连接上一次插入的行号，需按 enhanced_id 查出已有行
+                    if cursor.rowcount == 1:
+                        row = cursor.lastrowid
+                    else:
+                        row = conn.execute('SELECT row FROM similar_vectors WHERE enhanced_id = ?',
+                                           (enhanced_id,)).fetchone()[0]
+                    f.seek((row - 1) * row_bytes)
+                    f.write(embed_text(original_content).astype(np.float32).tobytes())
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+def index_similar_contents(items):
+    """把新保存的优化内容加入相似索引（失败只记录日志，不影响保存）"""
+    if not app.config['SIMILAR_ENABLED'] or _get_numpy() is None:
+        return
+    entries = [entry for entry in map(_similar_entry, items) if entry]
+    if not entries:
+        return
+    try:
+        _append_similar_vectors(entries)
+    except Exception as e:
+        print(f"[SIMILAR] 写入相似索引失败: {e}")
+
+def forget_similar_content(enhanced_id):
+    if not app.config['SIMILAR_ENABLED'] or _get_numpy() is None:
+        return
+    with closing(_similar_connect()) as conn:
+        conn.execute('UPDATE similar_vectors SET deleted = 1 WHERE enhanced_id = ?', (enhanced_id,))
+
+def rebuild_similar_index(batch_size=500):
+    """清空并按当前 SIMILAR_DIM 重新计算全部历史结果的向量，返回写入条数"""
+    with closing(_similar_connect()) as conn:
+        conn.execute('BEGIN IMMEDIATE')
+        conn.execute('DELETE FROM similar_vectors')
+        open(_similar_vectors_path(), 'wb').close()
+        conn.execute('COMMIT')
+    
+    count = 0
+    query = EnhancedContent.query.filter(
+        EnhancedContent.is_image.is_(False), EnhancedContent.content_type.in_(SIMILAR_CONTENT_TYPES)
+    ).order_by(EnhancedContent.id)
+    last_id = 0
+    while True:
+        items = query.filter(EnhancedContent.id > last_id).limit(batch_size).all()
+        if not items:
+            break
+        entries = [entry for entry in map(_similar_entry, items) if entry]
+        if entries:
+            _append_similar_vectors(entries)
+        count += len(entries)
+        last_id = items[-1].id
+        db.session.expunge_all()
+    return count
+
+def find_similar_result(user_id, content, content_type):
+    """查找原文与 content 高度相似的历史结果，返回 (EnhancedContent, 相似度, 正文) 或 None"""
+    np = _get_numpy()
+    vectors_path = _similar_vectors_path()
+    if np is None or content_type not in SIMILAR_CONTENT_TYPES or not os.path.exists(vectors_path):
+        return None
+    query = embed_text(content)
+    if not query.any():
+        return None
+    
+    sql = 'SELECT row, enhanced_id FROM similar_vectors WHERE content_type = ? AND deleted = 0'
+    params = [content_type]
+    if not app.config['SIMILAR_CROSS_USER']:
+        sql += ' AND user_id = ?'
+        params.append(int(user_id))
+    with closing(_similar_connect()) as conn:
+        rows = np.array(conn.execute(sql, params).fetchall(), dtype=np.int64).reshape(-1, 2)
+    
+    dim = app.config['SIMILAR_DIM']
+    total = os.path.getsize(vectors_path) // (dim * 4)
+    rows = rows[rows[:, 0] <= total]
+    if not len(rows):
+        return None
+    matrix = np.memmap(vectors_path, dtype=np.float32, mode='r', shape=(total, dim))
+    
+    # 分块计算，避免一次把整个矩阵读入内存
+    best_score, best_id = -1.0, None
+    for start in range(0, len(rows), SIMILAR_SCAN_BLOCK):
+        block = rows[start:start + SIMILAR_SCAN_BLOCK]
+        scores = matrix[block[:, 0] - 1] @ query
+        index = int(np.argmax(scores))
+        if scores[index] > best_score:
+            best_score, best_id = float(scores[index]), int(block[index, 1])
+    if best_score < app.config['SIMILAR_THRESHOLD']:
+        return None
+    
+    item = db.session.get(EnhancedContent, best_id, options=[undefer(EnhancedContent.content_blob)])
+    if not item or item.edited_at:
+        return None
+    if content_type in SIMILAR_EXACT_TYPES and _similar_key(item.original_content) != _similar_key(content):
+        return None
+    try:
+        result = enhanced_text(item)
+    except OSError:
+        return None
+    return (item, best_score, result) if result else None
 
-def generate_problem_analysis(problems, is_image=False):
-    """生成题目详细解析"""
-    print(f"[ANALYSIS] 开始解析题目，是否为图片: {is_image}")
-    
-    if is_image:
-        messages = [
-            {
-                "role": "system",
-                "content": "你是一个专业的教学助手。请分析图片中的题目，提供详细的解析，包括解题思路、步骤和知识点说明。请用Markdown格式输出。"
-            },
-            {
-                "role": "user",
-                "content": [
-                    {
-                        "type": "text",
-                        "text": "请分析这张图片中的题目并提供详细解析："
-                    },
-                    {
-                        "type": "image_url",
-                        "image_url": {
-                            "url": problems
-                        }
-                    }
-                ]
-            }
-        ]
-    else:
-        messages = [
-            {
-                "role": "system",
-                "content": "你是一个专业的教学助手。请为用户提供详细的题目解析，包括解题思路、步骤和知识点说明。请用Markdown格式输出。"
-            },
-            {
-                "role": "user",
-                "content": f"请为以下题目生成详细的解析：\n\n{problems}"
-            }
-        ]
-    return call_ai_api(messages)
+def _similar_key(text):
+    """只忽略空白差异的规范化原文，数字和符号必须完全一致"""
+    return re.sub(r'\s+', ' ', _normalize_text(text or ''))
 
-def save_enhanced_content(user_id, original_content, enhanced_content, content_type, is_image=False):
-    """保存优化后的内容到文件和数据库"""
+def similar_prior_result(user_id, content, content_type, is_image, data):
+    """请求级入口：图片、跳过缓存（no_cache）或显式要求重新生成（no_similar）的请求不复用"""
+    if (is_image or not app.config['SIMILAR_ENABLED'] or ai_cache_bypassed(data)
+            or request_flag('no_similar', data)):
+        return None
     try:
-        # 创建保存目录
-        save_dir = os.path.join('enhanced_content', str(user_id))
-        os.makedirs(save_dir, exist_ok=True)
-        
-        # 生成文件名
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        filename = f"{content_type}_{timestamp}.md"
-        file_path = os.path.join(save_dir, filename)
-        
-        # 保存到文件
-        with open(file_path, 'w', encoding='utf-8') as f:
-            f.write(f"# {content_type.title()} - 优化内容\n\n")
-            f.write(f"**创建时间**: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n\n")
-            if not is_image:
-                f.write(f"## 原始内容\n\n{original_content}\n\n")
-            f.write(f"## 优化后内容\n\n{enhanced_content}\n")
-        
-        # 保存到数据库
-        enhanced_record = EnhancedContent(
-            user_id=user_id,
-            original_content=original_content if not is_image else "图片内容",
-            enhanced_content=enhanced_content,
-            content_type=content_type,
-            is_image=is_image,
-            file_path=file_path
-        )
-        
-        db.session.add(enhanced_record)
-        db.session.commit()
-        
-        print(f"[SAVE] 优化内容已保存: {file_path}")
-        return enhanced_record.id
-        
+        return find_similar_result(user_id, content, content_type)
     except Exception as e:
-        print(f"[ERROR] 保存优化内容失败: {e}")
+        print(f"[SIMILAR] 相似检索失败: {e}")
         return None
 
-def generate_english_study_material(text, user_level, is_image=False):
-    """生成英语学习材料"""
-    print(f"[ENGLISH] 生成英语学习材料，用户水平: {user_level}, 是否为图片: {is_image}")
-    
-    level_map = {
-        'primary': '小学',
-        'middle': '初中', 
-        'high_school': '高中',
-        'cet4': '大学四级',
-        'cet6': '大学六级',
-        'ielts_toefl': '雅思托福'
-    }
+def reused_result_response(prior, field, user_id, content, content_type, stream=False):
+    """返回复用的历史结果，并为当前用户保存一条自己的记录（流式请求一次性推送全文）
+
+    响应中的 reused 供前端提示并可选择重新生成；reused_from 只在复用自己的记录时返回
+    """
+    item, score, result = prior
+    print(f"[SIMILAR] 复用历史结果 {item.id}，相似度: {score:.3f}")
+    save = lambda text: save_enhanced_content(int(user_id), content, text, content_type)
+    if stream:
+        return sse_response(iter([result]), save)
+    return jsonify({
+        field: result,
+        'save_id': save(result),
+        'reused': True,
+        'reused_from': item.id if item.user_id == int(user_id) else None,
+        'similarity': round(score, 4)
+    })
+
+# 列表分页：按 (created_at, id) 倒序的游标分页，响应带ETag支持条件请求
+def encode_cursor(created_at, item_id):
+    raw = f"{created_at.isoformat()}|{item_id}"
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor):
+    """解析分页游标，格式错误时抛出 ValueError"""
+    raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('utf-8')
+    created_at, item_id = raw.rsplit('|', 1)
+    return datetime.fromisoformat(created_at), int(item_id)
+
+def paginate_keyset(query, model, default_limit=0):
+    """按请求参数 limit/cursor 取一页，返回 (记录列表, 下一页游标)；未传 limit 时用 default_limit，limit=0 表示全部"""
+    query = query.order_by(model.created_at.desc(), model.id.desc())
+    cursor = request.args.get('cursor')
+    if cursor:
+        created_at, item_id = decode_cursor(cursor)
+        # 先用 created_at <= 游标 限定索引范围，再排除同一时刻已返回的记录
+        query = query.filter(model.created_at <= created_at, or_(
+            model.created_at < created_at, model.id < item_id
+        ))
     
-    if is_image:
-        messages = [
-            {
-                "role": "system",
-                "content": f"你是一个专业的英语学习助手。用户的英语水平是{level_map.get(user_level, '高中')}。请分析图片中的英语内容并生成学习材料，用Markdown格式输出。"
-            },
-            {
-                "role": "user",
-                "content": [
-                    {
-                        "type": "text",
-                        "text": f"请分析这张图片中的英语内容，根据我的英语水平({level_map.get(user_level, '高中')})生成学习材料，包括：1.内容导读 2.重点词汇及其释义 3.语法结构分析："
-                    },
-                    {
-                        "type": "image_url",
-                        "image_url": {
-                            "url": text
-                        }
-                    }
-                ]
-            }
-        ]
-    else:
-        messages = [
-            {
-                "role": "system",
-                "content": f"你是一个专业的英语学习助手。用户的英语水平是{level_map.get(user_level, '高中')}。请根据用户水平生成学习材料，用Markdown格式输出。"
-            },
-            {
-                "role": "user",
-                "content": f"请为以下英语文章生成学习材料，包括：1.文章导读 2.超出用户水平的词汇及其英文释义 3.重点语法结构分析：\n\n{text}"
-            }
-        ]
-    return call_ai_api(messages)
+    limit = request.args.get('limit', type=int)
+    if limit is None:
+        limit = default_limit
+    if not limit:
+        return query.all(), None
+    limit = min(max(limit, 1), app.config['PAGE_MAX_LIMIT'])
+    # 多取一条判断是否还有下一页
+    items = query.limit(limit + 1).all()
+    if len(items) <= limit:
+        return items, None
+    items = items[:limit]
+    return items, encode_cursor(items[-1].created_at, items[-1].id)
+
+def collection_etag(summary_query):
+    """由请求参数和集合摘要（条数、最大ID、最近修改时间）计算ETag，不需要加载记录"""
+    summary = summary_query.one()
+    raw = '|'.join([request.full_path, *(str(value) for value in summary)])
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()[:32]
+
+def not_modified_response(etag):
+    """If-None-Match 命中时直接返回304，未命中返回 None"""
+    if etag not in request.if_none_match:
+        return None
+    response = Response(status=304)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+def paged_json_response(payload, next_cursor, etag):
+    """返回JSON列表，带上事先算好的ETag"""
+    response = jsonify(payload)
+    if next_cursor:
+        response.headers['X-Next-Cursor'] = next_cursor
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.set_etag(etag)
+    return response
 
 # API路由
 @app.route('/api/register', methods=['POST'])
@@ -414,55 +3224,166 @@ def upload_file():
         return jsonify({'error': '没有选择文件'}), 400
     
     filename = secure_filename(file.filename)
-    file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-    file.save(file_path)
+    staged_path = upload_staging_path()
+    # multipart 请求体已由werkzeug缓冲到临时文件，这里只是分块复制并计算哈希；大文件请使用分块上传接口
+    content_hash, file_type, size = save_upload_stream(file.stream, staged_path, filename.split('.')[-1].lower())
     
-    print(f"[UPLOAD] 文件已保存: {file_path}")
+    print(f"[UPLOAD] 文件已接收: {filename}, 大小: {size} 字节, 哈希: {content_hash[:12]}")
     
-    # 确定文件类型
-    file_type = filename.split('.')[-1].lower()
+    result, status_code = create_note_from_file(
+        user_id, staged_path, file_type, content_hash, size,
+        title=request.form.get('title', filename),
+        category=request.form.get('category', '未分类'),
+        options=upload_options()
+    )
+    return jsonify(result), status_code
+
+@app.route('/api/upload/chunked', methods=['POST'])
+@jwt_required()
+def create_chunked_upload():
+    """创建断点续传上传会话"""
+    user_id = get_jwt_identity()
+    data = request.get_json() or {}
     
-    # 检查是否为图片
-    is_image = file_type in ['jpg', 'jpeg', 'png', 'gif', 'bmp', 'webp']
+    if not data.get('filename'):
+        return jsonify({'error': '没有选择文件'}), 400
+    total_size = data.get('total_size')
+    if total_size is not None and (not isinstance(total_size, int) or isinstance(total_size, bool)
+                                   or not 0 <= total_size <= app.config['MAX_CONTENT_LENGTH']):
+        return jsonify({'error': f"total_size 必须是 0 到 {app.config['MAX_CONTENT_LENGTH']} 之间的整数"}), 400
     
-    # 提取文件内容
-    content = process_uploaded_file(file_path, file_type)
+    maybe_expire_upload_sessions()
+    upload = UploadSession(
+        id=uuid.uuid4().hex,
+        user_id=int(user_id),
+        filename=secure_filename(data['filename']),
+        title=data.get('title', data['filename']),
+        category=data.get('category', '未分类'),
+        total_size=total_size
+    )
+    os.makedirs(os.path.dirname(upload_session_path(upload)), exist_ok=True)
+    open(upload_session_path(upload), 'wb').close()
     
-    # 创建笔记记录
-    note = Note(
-        user_id=user_id,
-        title=request.form.get('title', filename),
-        content=content,
-        file_path=file_path,
-        file_type=file_type,
-        category=request.form.get('category', '未分类')
+    db.session.add(upload)
+    db.session.commit()
+    
+    print(f"[UPLOAD] 用户 {user_id} 创建分块上传: {upload.id}, 文件: {upload.filename}")
+    return jsonify(upload_session_status(upload))
+
+@app.route('/api/upload/chunked/<upload_id>', methods=['GET'])
+@jwt_required()
+def get_chunked_upload(upload_id):
+    """查询已接收的字节数，用于断点续传"""
+    user_id = get_jwt_identity()
+    upload = UploadSession.query.filter_by(id=upload_id, user_id=int(user_id)).first()
+    if not upload:
+        return jsonify({'error': '上传不存在'}), 404
+    return jsonify(upload_session_status(upload))
+
+@app.route('/api/upload/chunked/<upload_id>', methods=['PUT'])
+@jwt_required()
+def put_upload_chunk(upload_id):
+    """追加一个分块：请求体为原始字节，offset 参数必须等于已接收的字节数"""
+    user_id = get_jwt_identity()
+    upload = UploadSession.query.filter_by(id=upload_id, user_id=int(user_id)).first()
+    if not upload:
+        return jsonify({'error': '上传不存在'}), 404
+    
+    offset = request.args.get('offset', type=int)
+    if offset is None:
+        offset = request.headers.get('Upload-Offset', type=int)
+    if offset != upload.received:
+        return jsonify({'error': '分块偏移不匹配', **upload_session_status(upload)}), 409
+    
+    limit = app.config['MAX_CONTENT_LENGTH']
+    if upload.total_size is not None and upload.total_size <= limit:
+        limit, oversized = upload.total_size, ({'error': '上传数据超过声明的文件大小'}, 400)
+    else:
+        oversized = ({'error': '文件超过大小上限'}, 413)
+    # 声明了长度的分块在写入前检查
+    if request.content_length is not None and offset + request.content_length > limit:
+        return jsonify({**oversized[0], **upload_session_status(upload)}), oversized[1]
+    
+    # 从offset处覆盖写入并截断，重试同一分块是幂等的
+    with open(upload_session_path(upload), 'r+b') as f:
+        f.seek(offset)
+        received = offset
+        for chunk in iter(lambda: request.stream.read(app.config['UPLOAD_CHUNK_SIZE']), b''):
+            received += len(chunk)
+            if received > limit:
+                # 未声明长度的分块边写边检查，超出时丢弃本分块已写入的部分
+                f.truncate(offset)
+                return jsonify({**oversized[0], **upload_session_status(upload)}), oversized[1]
+            f.write(chunk)
+        f.truncate()
+    
+    updated = UploadSession.query.filter_by(id=upload.id, received=offset).update(
+        {'received': received}, synchronize_session=False
     )
+    db.session.commit()
+    if not updated:
+        db.session.refresh(upload)
+        return jsonify({'error': '分块偏移不匹配', **upload_session_status(upload)}), 409
+    
+    upload.received = received
+    return jsonify(upload_session_status(upload))
+
+@app.route('/api/upload/chunked/<upload_id>/complete', methods=['POST'])
+@jwt_required()
+def complete_chunked_upload(upload_id):
+    """所有分块上传完成后合成文件并创建笔记（请求体可传 async/auto_enhance/extract_keywords）"""
+    user_id = get_jwt_identity()
+    upload = UploadSession.query.filter_by(id=upload_id, user_id=int(user_id)).first()
+    if not upload:
+        return jsonify({'error': '上传不存在'}), 404
+    if upload.total_size is not None and upload.received != upload.total_size:
+        return jsonify({'error': '文件尚未上传完整', **upload_session_status(upload)}), 409
     
-    db.session.add(note)
+    staged_path = upload_session_path(upload)
+    filename, title, category, size = upload.filename, upload.title, upload.category, upload.received
+    # 条件删除上传记录：同时到达的多个 complete 请求只有一个能继续处理暂存文件
+    claimed = UploadSession.query.filter_by(id=upload.id).delete(synchronize_session=False)
     db.session.commit()
+    if not claimed:
+        return jsonify({'error': '上传已完成或正在处理'}), 409
     
-    print(f"[UPLOAD] 笔记创建成功，ID: {note.id}, 是否为图片: {is_image}")
+    content_hash, file_type = inspect_saved_file(staged_path, filename.split('.')[-1].lower())
+    print(f"[UPLOAD] 分块上传完成: {filename}, 大小: {size} 字节")
     
-    return jsonify({
-        'message': '文件上传成功', 
-        'note_id': note.id,
-        'is_image': is_image,
-        'file_type': file_type
-    })
+    result, status_code = create_note_from_file(user_id, staged_path, file_type, content_hash, size,
+                                                title=title, category=category,
+                                                options=upload_options(request.get_json(silent=True)))
+    return jsonify(result), status_code
 
 @app.route('/api/notes', methods=['GET'])
 @jwt_required()
 def get_notes():
+    """列出当前用户的笔记（只加载元数据列；支持 limit/cursor 分页，下一页游标在 X-Next-Cursor 头中）"""
     user_id = get_jwt_identity()
-    notes = Note.query.filter_by(user_id=user_id).all()
+    # 先用聚合查询算出ETag，客户端缓存仍然有效时不加载笔记
+    etag = collection_etag(db.session.query(
+        db.func.count(Note.id), db.func.max(Note.id), db.func.max(Note.updated_at)
+    ).filter(Note.user_id == int(user_id)))
+    cached = not_modified_response(etag)
+    if cached:
+        return cached
+    
+    query = Note.query.filter_by(user_id=user_id).options(
+        load_only(Note.id, Note.title, Note.category, Note.created_at, Note.file_type, Note.status)
+    )
+    try:
+        notes, next_cursor = paginate_keyset(query, Note, app.config['PAGE_DEFAULT_LIMIT'])
+    except ValueError:
+        return jsonify({'error': '无效的分页游标'}), 400
     
-    return jsonify([{
+    return paged_json_response([{
         'id': note.id,
         'title': note.title,
         'category': note.category,
         'created_at': note.created_at.isoformat(),
-        'file_type': note.file_type
-    } for note in notes])
+        'file_type': note.file_type,
+        'status': note.status
+    } for note in notes], next_cursor, etag)
 
 @app.route('/api/notes/<int:note_id>', methods=['GET'])
 @jwt_required()
@@ -473,16 +3394,8 @@ def get_note(note_id):
     if not note:
         return jsonify({'error': '笔记不存在'}), 404
     
-    # 更新访问记录
-    progress = ProgressRecord.query.filter_by(user_id=user_id, note_id=note_id).first()
-    if not progress:
-        progress = ProgressRecord(user_id=user_id, note_id=note_id, access_count=1)
-        db.session.add(progress)
-    else:
-        progress.access_count += 1
-        progress.last_accessed = datetime.utcnow()
-    
-    db.session.commit()
+    # 更新访问记录（写回缓冲，定期批量写库）
+    record_note_access(user_id, note_id)
     
     return jsonify({
         'id': note.id,
@@ -490,9 +3403,87 @@ def get_note(note_id):
         'content': note.content,
         'category': note.category,
         'file_type': note.file_type,
+        'status': note.status,
+        'keywords': note_keywords(note),
         'created_at': note.created_at.isoformat()
     })
 
+def note_status_payload(note):
+    return {'id': note.id, 'status': note.status, 'keywords': note_keywords(note)}
+
+@app.route('/api/notes/<int:note_id>/status', methods=['GET'])
+@jwt_required()
+def get_note_status(note_id):
+    """查询上传笔记的处理状态（processing | ready | failed），供客户端轮询"""
+    user_id = get_jwt_identity()
+    note = Note.query.filter_by(id=note_id, user_id=user_id).options(
+        load_only(Note.id, Note.status, Note.keywords)
+    ).first()
+    if not note:
+        return jsonify({'error': '笔记不存在'}), 404
+    return jsonify(note_status_payload(note))
+
+@app.route('/api/notes/<int:note_id>/events', methods=['GET'])
+@jwt_required()
+def note_status_events(note_id):
+    """以Server-Sent Events推送笔记处理状态：状态变化时发送 status 事件，处理结束后关闭连接
+    
+    每个连接最多保持 NOTE_EVENTS_MAX_SECONDS 秒，避免长时间占用同步worker；仍在处理中时由客户端按 retry 间隔重连
+    """
+    user_id = get_jwt_identity()
+    if not Note.query.filter_by(id=note_id, user_id=user_id).options(load_only(Note.id)).first():
+        return jsonify({'error': '笔记不存在'}), 404
+    
+    def generate():
+        yield f"retry: {int(app.config['JOB_POLL_INTERVAL'] * 1000)}\n\n"
+        last_status = None
+        deadline = time.time() + app.config['NOTE_EVENTS_MAX_SECONDS']
+        while time.time() < deadline:
+            note = Note.query.filter_by(id=note_id).options(load_only(Note.id, Note.status, Note.keywords)).first()
+            payload = note_status_payload(note) if note else None
+            # 结束读事务，下次轮询才能看到任务worker提交的更新
+            db.session.rollback()
+            if not payload:
+                yield _sse_event({'error': '笔记不存在'}, event='error')
+                return
+            if payload['status'] != last_status:
+                last_status = payload['status']
+                yield _sse_event(payload, event='status')
+            if last_status != 'processing':
+                return
+            time.sleep(app.config['JOB_POLL_INTERVAL'])
+    
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+@app.route('/api/notes/<int:note_id>', methods=['DELETE'])
+@jwt_required()
+def delete_note(note_id):
+    """删除笔记及其学习记录；上传文件没有其他笔记引用时一并删除"""
+    user_id = int(get_jwt_identity())
+    note = Note.query.filter_by(id=note_id, user_id=user_id).first()
+    if not note:
+        return jsonify({'error': '笔记不存在'}), 404
+    
+    content_hash = note.content_hash
+    discard_note_accesses(user_id, note_id)
+    ProgressRecord.query.filter_by(note_id=note_id).delete(synchronize_session=False)
+    db.session.delete(note)
+    unindex_search_document('note', note_id)
+    if content_hash:
+        release_upload_blob(content_hash)
+    db.session.flush()
+    # 删除会影响访问次数、掌握度和最近访问列表，直接按剩余记录重算该用户的汇总
+    db.session.merge(UserStats(user_id=user_id, **compute_user_stats(user_id)))
+    db.session.commit()
+    
+    if content_hash:
+        collect_upload_blob(content_hash)
+    return jsonify({'message': '删除成功'})
+
 @app.route('/api/enhance-notes', methods=['POST'])
 @jwt_required()
 def enhance_notes_api():
@@ -506,7 +3497,19 @@ def enhance_notes_api():
     if not content:
         return jsonify({'error': '内容不能为空'}), 400
     
-    enhanced_content = enhance_notes(content, is_image)
+    if request_flag('async', data):
+        return job_accepted(enqueue_ai_job(user_id, 'note', content, is_image, use_cache=not ai_cache_bypassed(data)))
+    
+    # 与历史内容高度相似时直接复用已有结果，跳过模型调用
+    prior = similar_prior_result(user_id, content, 'note', is_image, data)
+    if prior:
+        return reused_result_response(prior, 'enhanced_content', user_id, content, 'note', stream_requested(data))
+    
+    if stream_requested(data):
+        chunks = enhance_notes(content, is_image, use_cache=not ai_cache_bypassed(data), stream=True)
+        return sse_response(chunks, lambda text: save_enhanced_content(user_id, content, text, 'note', is_image))
+    
+    enhanced_content = enhance_notes(content, is_image, use_cache=not ai_cache_bypassed(data))
     
     if enhanced_content:
         # 保存优化后的内容
@@ -519,6 +3522,63 @@ def enhance_notes_api():
     else:
         return jsonify({'error': 'AI服务暂时不可用'}), 500
 
+@app.route('/api/enhance-notes/batch', methods=['POST'])
+@jwt_required()
+def enhance_notes_batch():
+    """批量笔记补全：接受笔记ID列表和/或内容列表，有限并发调用AI，结果一次性入库；条数较多或 async 时整批入队返回任务ID"""
+    user_id = get_jwt_identity()
+    data = request.get_json() or {}
+    note_ids = data.get('note_ids') or []
+    contents = data.get('contents') or []
+    
+    if not isinstance(note_ids, list) or not isinstance(contents, list):
+        return jsonify({'error': 'note_ids 和 contents 必须是列表'}), 400
+    if any(not isinstance(i, int) or isinstance(i, bool) for i in note_ids):
+        return jsonify({'error': 'note_ids 必须是整数列表'}), 400
+    if not note_ids and not contents:
+        return jsonify({'error': '内容不能为空'}), 400
+    if len(note_ids) + len(contents) > app.config['BATCH_MAX_ITEMS']:
+        return jsonify({'error': f"单次最多处理 {app.config['BATCH_MAX_ITEMS']} 条"}), 400
+    
+    print(f"[API] 用户 {user_id} 请求批量笔记补全，笔记 {len(note_ids)} 条，内容 {len(contents)} 条")
+    
+    items = []
+    notes = {}
+    if note_ids:
+        notes = {note.id: note for note in Note.query.filter(
+            Note.user_id == int(user_id), Note.id.in_(note_ids)
+        )}
+    for note_id in note_ids:
+        note = notes.get(note_id)
+        if not note:
+            items.append({'note_id': note_id, 'status': 'failed', 'error': '笔记不存在'})
+        elif not note.content:
+            items.append({'note_id': note_id, 'status': 'failed', 'error': '没有内容可以补全'})
+        else:
+            is_image = (note.file_type or '').lower() in ['jpg', 'jpeg', 'png', 'gif', 'bmp', 'webp']
+            items.append({'note_id': note_id, 'content': note.content, 'is_image': is_image})
+    for entry in contents:
+        if isinstance(entry, str):
+            entry = {'content': entry}
+        if not isinstance(entry, dict) or not entry.get('content'):
+            items.append({'status': 'failed', 'error': '内容不能为空'})
+        else:
+            items.append({'content': entry['content'], 'is_image': bool(entry.get('is_image', False))})
+    
+    use_cache = not ai_cache_bypassed(data)
+    pending = sum(1 for item in items if 'status' not in item)
+    if request_flag('async', data) or pending > app.config['BATCH_SYNC_MAX_ITEMS']:
+        # 同步执行放不进一个请求的时限，整批作为一个任务入队，由worker执行后一次性入库
+        job = enqueue_job(user_id, 'note_batch', {'items': items, 'use_cache': use_cache})
+        print(f"[API] 批量笔记补全已入队，任务ID: {job.id}，待处理 {pending} 条")
+        return jsonify({'job_id': job.id, 'status': job.status, 'queued': pending,
+                        'failed': len(items) - pending}), 202
+    
+    results = run_note_batch(user_id, items, use_cache)
+    done = sum(1 for entry in results if entry['status'] == 'done')
+    print(f"[API] 批量笔记补全完成: 成功 {done}/{len(results)}")
+    return jsonify({'results': results, 'succeeded': done, 'failed': len(results) - done})
+
 @app.route('/api/analyze-problems', methods=['POST'])
 @jwt_required()
 def analyze_problems():
@@ -532,7 +3592,19 @@ def analyze_problems():
     if not problems:
         return jsonify({'error': '题目内容不能为空'}), 400
     
-    analysis = generate_problem_analysis(problems, is_image)
+    if request_flag('async', data):
+        return job_accepted(enqueue_ai_job(user_id, 'problem', problems, is_image,
+                                           use_cache=not ai_cache_bypassed(data)))
+    
+    prior = similar_prior_result(user_id, problems, 'problem', is_image, data)
+    if prior:
+        return reused_result_response(prior, 'analysis', user_id, problems, 'problem', stream_requested(data))
+    
+    if stream_requested(data):
+        chunks = generate_problem_analysis(problems, is_image, use_cache=not ai_cache_bypassed(data), stream=True)
+        return sse_response(chunks, lambda text: save_enhanced_content(user_id, problems, text, 'problem', is_image))
+    
+    analysis = generate_problem_analysis(problems, is_image, use_cache=not ai_cache_bypassed(data))
     
     if analysis:
         # 保存优化后的内容
@@ -560,7 +3632,17 @@ def english_study():
     if not text:
         return jsonify({'error': '文章内容不能为空'}), 400
     
-    study_material = generate_english_study_material(text, user.english_level, is_image)
+    if request_flag('async', data):
+        return job_accepted(enqueue_ai_job(user_id, 'english', text, is_image,
+                                           use_cache=not ai_cache_bypassed(data), user_level=user.english_level))
+    
+    if stream_requested(data):
+        chunks = generate_english_study_material(text, user.english_level, is_image,
+                                                 use_cache=not ai_cache_bypassed(data), stream=True)
+        return sse_response(chunks, lambda material: save_enhanced_content(user_id, text, material, 'english', is_image))
+    
+    study_material = generate_english_study_material(text, user.english_level, is_image,
+                                                     use_cache=not ai_cache_bypassed(data))
     
     if study_material:
         # 保存优化后的内容
@@ -588,19 +3670,30 @@ def english_study_upload():
         return jsonify({'error': '没有选择文件'}), 400
 
     filename = secure_filename(file.filename)
-    file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-    file.save(file_path)
-
-    file_type = filename.split('.')[-1].lower()
-    is_image = file_type in ['jpg', 'jpeg', 'png', 'gif', 'bmp', 'webp']
+    file_path = upload_staging_path()
+    try:
+        content_hash, file_type, _ = save_upload_stream(file.stream, file_path, filename.split('.')[-1].lower())
+        is_image = file_type in ['jpg', 'jpeg', 'png', 'gif', 'bmp', 'webp']
 
-    # 提取为可用于AI的文本或图片base64
-    extracted = process_uploaded_file(file_path, file_type)
+        # 提取为可用于AI的文本或图片base64（文件不关联笔记，用完即删）
+        extracted = process_uploaded_file(file_path, file_type, content_hash)
+    finally:
+        os.remove(file_path)
 
     if not extracted:
         return jsonify({'error': '无法从文件中提取内容'}), 400
 
-    study_material = generate_english_study_material(extracted, user.english_level, is_image)
+    if request_flag('async'):
+        return job_accepted(enqueue_ai_job(user_id, 'english', extracted, is_image,
+                                           use_cache=not ai_cache_bypassed(), user_level=user.english_level))
+
+    if stream_requested():
+        chunks = generate_english_study_material(extracted, user.english_level, is_image,
+                                                 use_cache=not ai_cache_bypassed(), stream=True)
+        return sse_response(chunks, lambda material: save_enhanced_content(int(user_id), extracted, material, 'english', is_image))
+
+    study_material = generate_english_study_material(extracted, user.english_level, is_image,
+                                                     use_cache=not ai_cache_bypassed())
 
     if study_material:
         save_id = save_enhanced_content(int(user_id), extracted, study_material, 'english', is_image)
@@ -620,64 +3713,107 @@ def record_vocabulary():
     word = data.get('word')
     known = data.get('known', False)
     
-    # 检查是否已有记录
-    existing = VocabularyRecord.query.filter_by(user_id=user_id, word=word).first()
-    if existing:
-        existing.known = known
-    else:
-        record = VocabularyRecord(user_id=user_id, word=word, known=known)
-        db.session.add(record)
+    if not word:
+        return jsonify({'error': '单词不能为空'}), 400
     
-    db.session.commit()
+    # 已有记录时更新掌握状态
+    upsert_vocabulary(user_id, {word: bool(known)})
     return jsonify({'message': '记录已保存'})
 
+@app.route('/api/vocabulary/bulk', methods=['POST'])
+@jwt_required()
+def record_vocabulary_bulk():
+    """批量同步生词状态：[{word, known}, ...] 一次UPSERT写入"""
+    user_id = get_jwt_identity()
+    data = request.get_json() or {}
+    entries = data.get('words')
+    
+    if not isinstance(entries, list) or not entries:
+        return jsonify({'error': 'words 必须是非空列表'}), 400
+    if len(entries) > app.config['VOCABULARY_BULK_MAX']:
+        return jsonify({'error': f"单次最多提交 {app.config['VOCABULARY_BULK_MAX']} 个单词"}), 400
+    
+    # 同一单词出现多次时以最后一次为准
+    words = {}
+    for entry in entries:
+        word = entry.get('word') if isinstance(entry, dict) else None
+        if not isinstance(word, str) or not word.strip() or len(word.strip()) > 100:
+            return jsonify({'error': '单词格式不正确'}), 400
+        words[word.strip()] = bool(entry.get('known', False))
+    
+    upsert_vocabulary(user_id, words)
+    return jsonify({'message': '记录已保存', 'saved': len(words)})
+
+@app.route('/api/vocabulary/known', methods=['GET'])
+@jwt_required()
+def list_known_words():
+    """返回已掌握的单词列表（只读单词列，供前端过滤生词；支持If-None-Match）"""
+    user_id = int(get_jwt_identity())
+    words = [row[0] for row in db.session.query(VocabularyRecord.word).filter(
+        VocabularyRecord.user_id == user_id, VocabularyRecord.known.is_(True)
+    ).order_by(VocabularyRecord.word)]
+    
+    response = jsonify({'count': len(words), 'words': words})
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.add_etag()
+    return response.make_conditional(request)
+
 @app.route('/api/history', methods=['GET'])
 @jwt_required()
 def list_history():
-    """列出当前用户保存的优化内容（支持按类型过滤）"""
+    """列出当前用户保存的优化内容（支持按类型过滤与 limit/cursor 分页）"""
     user_id = get_jwt_identity()
     content_type = request.args.get('type')  # note | problem | english | None
 
-    q = EnhancedContent.query.filter_by(user_id=int(user_id)).order_by(EnhancedContent.created_at.desc())
+    etag = collection_etag(db.session.query(
+        db.func.count(EnhancedContent.id), db.func.max(EnhancedContent.id), db.func.max(EnhancedContent.edited_at)
+    ).filter(EnhancedContent.user_id == int(user_id)))
+    cached = not_modified_response(etag)
+    if cached:
+        return cached
+
+    q = EnhancedContent.query.filter_by(user_id=int(user_id)).options(load_only(
+        EnhancedContent.id, EnhancedContent.content_type, EnhancedContent.file_path,
+        EnhancedContent.is_image, EnhancedContent.created_at
+    ))
     if content_type:
         q = q.filter_by(content_type=content_type)
 
-    items = q.all()
+    try:
+        items, next_cursor = paginate_keyset(q, EnhancedContent)
+    except ValueError:
+        return jsonify({'error': '无效的分页游标'}), 400
     result = [{
         'id': item.id,
         'content_type': item.content_type,
-        'filename': os.path.basename(item.file_path) if item.file_path else None,
+        'filename': enhanced_download_name(item),
         'file_path': item.file_path,
         'is_image': item.is_image,
         'created_at': item.created_at.isoformat()
     } for item in items]
 
-    return jsonify(result)
+    return paged_json_response(result, next_cursor, etag)
 
 @app.route('/api/history/<int:item_id>', methods=['GET'])
 @jwt_required()
 def get_history_item(item_id: int):
     """获取单条优化内容，返回Markdown文本与元数据"""
     user_id = get_jwt_identity()
-    item = EnhancedContent.query.filter_by(id=item_id, user_id=int(user_id)).first()
+    item = EnhancedContent.query.filter_by(id=item_id, user_id=int(user_id)).options(
+        undefer(EnhancedContent.content_blob)
+    ).first()
     if not item:
         return jsonify({'error': '记录不存在'}), 404
 
-    content_text = None
-    if item.file_path and os.path.exists(item.file_path):
-        try:
-            with open(item.file_path, 'r', encoding='utf-8') as f:
-                content_text = f.read()
-        except Exception as e:
-            return jsonify({'error': f'读取文件失败: {e}'}), 500
-    else:
-        # 兜底：直接返回数据库中的文本
-        content_text = item.enhanced_content or ''
+    try:
+        content_text = render_enhanced_document(item)
+    except OSError as e:
+        return jsonify({'error': f'读取文件失败: {e}'}), 500
 
     return jsonify({
         'id': item.id,
         'content_type': item.content_type,
-        'filename': os.path.basename(item.file_path) if item.file_path else None,
+        'filename': enhanced_download_name(item),
         'created_at': item.created_at.isoformat(),
         'content': content_text
     })
@@ -685,12 +3821,19 @@ def get_history_item(item_id: int):
 @app.route('/api/history/<int:item_id>/download', methods=['GET'])
 @jwt_required()
 def download_history_item(item_id: int):
-    """下载保存的Markdown文件"""
+    """下载保存的Markdown文件（按需从存储的正文生成）"""
     user_id = get_jwt_identity()
-    item = EnhancedContent.query.filter_by(id=item_id, user_id=int(user_id)).first()
-    if not item or not item.file_path or not os.path.exists(item.file_path):
+    item = EnhancedContent.query.filter_by(id=item_id, user_id=int(user_id)).options(
+        undefer(EnhancedContent.content_blob)
+    ).first()
+    if not item:
         return jsonify({'error': '文件不存在'}), 404
-    return send_file(item.file_path, as_attachment=True, download_name=os.path.basename(item.file_path))
+    try:
+        document = render_enhanced_document(item)
+    except OSError:
+        return jsonify({'error': '文件不存在'}), 404
+    return send_file(BytesIO(document.encode('utf-8')), as_attachment=True,
+                     download_name=enhanced_download_name(item), mimetype='text/markdown')
 
 @app.route('/api/history/<int:item_id>', methods=['PUT'])
 @jwt_required()
@@ -706,17 +3849,16 @@ def update_history_item(item_id: int):
     if new_content is None:
         return jsonify({'error': '内容不能为空'}), 400
 
-    # 更新数据库
-    item.enhanced_content = new_content
-    db.session.commit()
-
-    # 同步更新磁盘文件
+    # 编辑后的内容即为完整文档，之后查看/下载时原样返回
     try:
-        if item.file_path:
-            with open(item.file_path, 'w', encoding='utf-8') as f:
-                f.write(new_content)
-    except Exception as e:
+        old_ref = store_enhanced_text(item, new_content)
+    except OSError as e:
+        db.session.rollback()
         return jsonify({'error': f'写入文件失败: {e}'}), 500
+    item.edited_at = datetime.utcnow()
+    index_enhanced_contents([item], [new_content])
+    db.session.commit()
+    release_content_ref(old_ref)
 
     return jsonify({'message': '更新成功'})
 
@@ -725,53 +3867,219 @@ def update_history_item(item_id: int):
 def delete_history_item(item_id: int):
     """删除记录及其文件"""
     user_id = get_jwt_identity()
-    item = EnhancedContent.query.filter_by(id=item_id, user_id=int(user_id)).first()
+    item = EnhancedContent.query.filter_by(id=item_id, user_id=int(user_id)).options(
+        load_only(EnhancedContent.id, EnhancedContent.file_path, EnhancedContent.content_ref)
+    ).first()
     if not item:
         return jsonify({'error': '记录不存在'}), 404
 
-    # 删除文件
+    # 删除旧版本保存的文件
     try:
         if item.file_path and os.path.exists(item.file_path):
             os.remove(item.file_path)
     except Exception:
         pass
 
+    content_ref = item.content_ref
     db.session.delete(item)
+    unindex_search_document('enhanced', item.id)
     db.session.commit()
+    release_content_ref(content_ref)
+    forget_similar_content(item.id)
     return jsonify({'message': '删除成功'})
 
+@app.route('/api/search', methods=['GET'])
+@jwt_required()
+def search():
+    """全文搜索笔记和优化内容：?q=关键词&type=note|enhanced&page=1&limit=20，按相关度排序并高亮片段"""
+    user_id = int(get_jwt_identity())
+    keywords = (request.args.get('q') or '').strip()
+    kind = request.args.get('type')
+    page = max(request.args.get('page', 1, type=int), 1)
+    limit = min(max(request.args.get('limit', app.config['SEARCH_PAGE_SIZE'], type=int), 1),
+                app.config['SEARCH_MAX_PAGE_SIZE'])
+    
+    if not search_enabled():
+        return jsonify({'error': '当前数据库不支持全文搜索'}), 501
+    match = build_search_query(user_id, keywords)
+    if not match:
+        return jsonify({'error': '搜索关键词不能为空'}), 400
+    
+    parity = {'note': 0, 'enhanced': 1}.get(kind)
+    sql = 'SELECT rowid, bm25(search_index, 0.0, 5.0, 1.0) AS score FROM search_index WHERE search_index MATCH :match'
+    if parity is not None:
+        sql += ' AND rowid % 2 = :parity'
+    # 多取一条判断是否还有下一页
+    sql += ' ORDER BY score LIMIT :limit OFFSET :offset'
+    rows = db.session.execute(text(sql), {
+        'match': match, 'parity': parity, 'limit': limit + 1, 'offset': (page - 1) * limit
+    }).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    
+    note_ids = [rowid // 2 for rowid, _ in rows if rowid % 2 == 0]
+    item_ids = [rowid // 2 for rowid, _ in rows if rowid % 2 == 1]
+    notes = {note.id: note for note in Note.query.filter(Note.user_id == user_id, Note.id.in_(note_ids))} if note_ids else {}
+    items = {item.id: item for item in EnhancedContent.query.filter(
+        EnhancedContent.user_id == user_id, EnhancedContent.id.in_(item_ids)
+    ).options(load_only(EnhancedContent.id, EnhancedContent.content_type, EnhancedContent.file_path,
+                        EnhancedContent.enhanced_content, EnhancedContent.content_ref,
+                        EnhancedContent.content_blob, EnhancedContent.created_at))} if item_ids else {}
+    
+    results = []
+    for rowid, score in rows:
+        if rowid % 2 == 0 and rowid // 2 in notes:
+            note = notes[rowid // 2]
+            is_image = (note.file_type or '').lower() in SEARCH_IMAGE_TYPES
+            results.append({
+                'type': 'note',
+                'id': note.id,
+                'title': note.title,
+                'category': note.category,
+                'snippet': '' if is_image else highlight_snippet(note.content, keywords),
+                'title_highlight': highlight_snippet(note.title, keywords),
+                'score': round(-score, 4),
+                'created_at': note.created_at.isoformat()
+            })
+        elif rowid % 2 == 1 and rowid // 2 in items:
+            item = items[rowid // 2]
+            results.append({
+                'type': 'enhanced',
+                'id': item.id,
+                'content_type': item.content_type,
+                'filename': enhanced_download_name(item),
+                'snippet': highlight_snippet(enhanced_text(item), keywords),
+                'score': round(-score, 4),
+                'created_at': item.created_at.isoformat()
+            })
+    
+    return jsonify({'results': results, 'page': page, 'limit': limit, 'has_more': has_more})
+
+@app.route('/api/jobs/<int:job_id>', methods=['GET'])
+@jwt_required()
+def get_job(job_id: int):
+    """查询AI任务状态，完成后返回结果"""
+    user_id = get_jwt_identity()
+    job = AIJob.query.filter_by(id=job_id, user_id=int(user_id)).first()
+    if not job:
+        return jsonify({'error': '任务不存在'}), 404
+
+    result = {
+        'id': job.id,
+        'job_type': job.job_type,
+        'status': job.status,
+        'progress': job.progress,
+        'created_at': job.created_at.isoformat(),
+        'started_at': job.started_at.isoformat() if job.started_at else None,
+        'finished_at': job.finished_at.isoformat() if job.finished_at else None
+    }
+    if job.status == 'done' and job.job_type == 'note_batch':
+        result['results'] = json.loads(job.result)
+    elif job.status == 'done':
+        result['result'] = job.result
+        result['save_id'] = job.save_id
+    elif job.status == 'failed':
+        result['error'] = job.error
+    return jsonify(result)
+
+@app.route('/api/usage', methods=['GET'])
+@jwt_required()
+def get_token_usage():
+    """当前用户的token用量汇总（总计及按模型统计）"""
+    user_id = int(get_jwt_identity())
+    columns = (
+        db.func.count(TokenUsage.id),
+        db.func.coalesce(db.func.sum(TokenUsage.prompt_tokens), 0),
+        db.func.coalesce(db.func.sum(TokenUsage.completion_tokens), 0),
+        db.func.coalesce(db.func.sum(TokenUsage.total_tokens), 0),
+        db.func.coalesce(db.func.avg(TokenUsage.duration_ms), 0)
+    )
+    calls, prompt_tokens, completion_tokens, total_tokens, avg_ms = db.session.query(*columns).filter(
+        TokenUsage.user_id == user_id
+    ).one()
+    by_model = db.session.query(TokenUsage.model_id, *columns).filter(
+        TokenUsage.user_id == user_id
+    ).group_by(TokenUsage.model_id).all()
+
+    return jsonify({
+        'calls': calls,
+        'prompt_tokens': prompt_tokens,
+        'completion_tokens': completion_tokens,
+        'total_tokens': total_tokens,
+        'average_duration_ms': round(avg_ms),
+        'by_model': [{
+            'model_id': row[0],
+            'calls': row[1],
+            'prompt_tokens': row[2],
+            'completion_tokens': row[3],
+            'total_tokens': row[4],
+            'average_duration_ms': round(row[5])
+        } for row in by_model]
+    })
+
+@app.errorhandler(PromptBudgetExceeded)
+def handle_prompt_budget_exceeded(e):
+    return jsonify({'error': str(e), 'tokens': e.tokens, 'limit': e.limit}), 413
+
+@app.route('/api/ai-cache/stats', methods=['GET'])
+@jwt_required()
+def get_ai_cache_stats():
+    """AI响应缓存的命中/未命中统计"""
+    return jsonify(ai_cache_stats())
+
 @app.route('/api/progress', methods=['GET'])
 @jwt_required()
 def get_progress():
-    user_id = get_jwt_identity()
+    user_id = int(get_jwt_identity())
     
-    # 获取学习统计数据
-    total_notes = Note.query.filter_by(user_id=user_id).count()
-    total_access = db.session.query(db.func.sum(ProgressRecord.access_count)).filter_by(user_id=user_id).scalar() or 0
-    avg_mastery = db.session.query(db.func.avg(ProgressRecord.mastery_level)).filter_by(user_id=user_id).scalar() or 0
+    ttl = app.config['STATS_CACHE_TTL']
+    if ttl > 0:
+        with _stats_cache_lock:
+            cached = _stats_cache.get(user_id)
+        if cached and cached[0] > time.time():
+            return jsonify(cached[1])
     
-    # 最近访问的笔记
-    recent_notes = db.session.query(Note, ProgressRecord).join(
-        ProgressRecord, Note.id == ProgressRecord.note_id
-    ).filter(Note.user_id == user_id).order_by(
-        ProgressRecord.last_accessed.desc()
-    ).limit(5).all()
+    # 获取学习统计数据（按主键读取汇总行）
+    stats = get_user_stats(user_id)
+    recent = {entry['note_id']: entry for entry in json.loads(stats.recent_notes or '[]')}
+    total_access = stats.total_access
     
-    recent_list = [{
-        'title': note.title,
-        'category': note.category,
-        'access_count': progress.access_count,
-        'last_accessed': progress.last_accessed.isoformat()
-    } for note, progress in recent_notes]
+    # 合并本进程中尚未写库的访问增量
+    pending = pending_note_accesses(user_id)
+    if pending:
+        total_access += sum(count for count, _ in pending.values())
+        missing = [note_id for note_id in pending if note_id not in recent]
+        if missing:
+            saved_counts = dict(db.session.query(ProgressRecord.note_id, ProgressRecord.access_count).filter(
+                ProgressRecord.user_id == user_id, ProgressRecord.note_id.in_(missing)
+            ).all())
+            for note in Note.query.filter(Note.user_id == user_id, Note.id.in_(missing)).options(
+                load_only(Note.id, Note.title, Note.category)
+            ):
+                recent[note.id] = _recent_note_entry(note.id, note.title, note.category,
+                                                     saved_counts.get(note.id) or 0, datetime.min)
+        for note_id, (count, last_accessed) in pending.items():
+            if note_id in recent:
+                recent[note_id] = {**recent[note_id], 'access_count': recent[note_id]['access_count'] + count,
+                                   'last_accessed': last_accessed.isoformat()}
+    recent_list = sorted(recent.values(), key=lambda entry: entry['last_accessed'], reverse=True)[:RECENT_NOTES_LIMIT]
     
-    return jsonify({
-        'total_notes': total_notes,
+    avg_mastery = stats.mastery_sum / stats.progress_count if stats.progress_count else 0
+    payload = {
+        'total_notes': stats.total_notes,
         'total_access': total_access,
         'average_mastery': round(avg_mastery, 1),
         'recent_notes': recent_list
-    })
+    }
+    if ttl > 0:
+        with _stats_cache_lock:
+            _stats_cache[user_id] = (time.time() + ttl, payload)
+    return jsonify(payload)
 
 if __name__ == '__main__':
     with app.app_context():
-        db.create_all()
+        init_database()
+    # 重启前已入队的任务不等新请求到来就开始执行
+    if app.config['JOB_EMBEDDED_WORKERS']:
+        start_job_workers()
     app.run(debug=True, host='0.0.0.0', port=5001, use_reloader=False)
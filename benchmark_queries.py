@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+"""
+查询性能检查脚本
+
+在独立的临时SQLite数据库中生成大量模拟数据，通过测试客户端直接调用各接口，
+逐条打印接口实际执行的SQL的 EXPLAIN QUERY PLAN 和接口平均耗时，用于确认热点查询命中索引：
+    python benchmark_queries.py [用户数] [每个用户的笔记数]
+
+查询来自路由本身，不在脚本里另写一份，接口改动后无需同步修改本脚本。
+"""
+
+import sys
+import os
+import random
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+# 必须在导入应用之前指定数据库，避免写入真实数据
+DB_PATH = os.path.join(tempfile.gettempdir(), 'learning_assistant_benchmark.db')
+os.environ['DATABASE_URL'] = f'sqlite:///{DB_PATH}'
+os.environ['JOB_EMBEDDED_WORKERS'] = 'false'
+# 计时期间不让后台线程写库，也不让进程内缓存跳过查询
+os.environ['ACCESS_FLUSH_INTERVAL'] = '3600'
+os.environ['STATS_CACHE_TTL'] = '0'
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from sqlalchemy import event, insert
+from werkzeug.security import generate_password_hash
+from flask_jwt_extended import create_access_token
+from app import (app, db, init_database, User, Note, ProgressRecord, VocabularyRecord,
+                 EnhancedContent, TokenUsage, AIJob, rebuild_search_index, rebuild_user_stats,
+                 claim_next_job)
+
+REPEAT = 50
+BENCH_PASSWORD = 'bench-password'
+
+def seed(users, notes_per_user):
+    """批量写入模拟数据"""
+    start = datetime(2024, 1, 1)
+    # 所有用户共用一个密码哈希，避免生成数据时逐个计算
+    password_hash = generate_password_hash(BENCH_PASSWORD)
+    db.session.execute(insert(User), [{
+        'id': u, 'username': f'bench{u}', 'email': f'bench{u}@example.com', 'password_hash': password_hash
+    } for u in range(1, users + 1)])
+    
+    note_id = 0
+    notes, progress, vocabulary, enhanced, usage, jobs = [], [], [], [], [], []
+    for u in range(1, users + 1):
+        for i in range(notes_per_user):
+            note_id += 1
+            created = start + timedelta(minutes=note_id)
+            notes.append({'id': note_id, 'user_id': u, 'title': f'笔记{note_id}', 'content': '内容' * 200,
+                          'file_type': 'txt', 'category': random.choice(['数学', '英语', '物理']),
+                          'created_at': created, 'updated_at': created})
+            if i % 2 == 0:
+                progress.append({'user_id': u, 'note_id': note_id, 'access_count': random.randint(1, 20),
+                                 'mastery_level': random.randint(0, 100), 'last_accessed': created})
+            vocabulary.append({'user_id': u, 'word': f'word{i}', 'known': i % 3 == 0, 'created_at': created})
+            enhanced.append({'user_id': u, 'original_content': '原文' * 200, 'enhanced_content': '优化' * 400,
+                             'content_type': random.choice(['note', 'problem', 'english']), 'is_image': False,
+                             'created_at': created})
+            usage.append({'user_id': u, 'model_id': 'doubao-seed-1-6-250615', 'estimated_prompt_tokens': 100,
+                          'prompt_tokens': 100, 'completion_tokens': 50, 'total_tokens': 150,
+                          'duration_ms': 800, 'created_at': created})
+            # 大部分任务已结束，少量排队中的任务供worker领取
+            status = 'queued' if i < 2 else 'done'
+            jobs.append({'user_id': u, 'job_type': 'note', 'payload': '{}', 'status': status, 'created_at': created,
+                         'finished_at': created if status == 'done' else None})
+    for model, rows in [(Note, notes), (ProgressRecord, progress), (VocabularyRecord, vocabulary),
+                        (EnhancedContent, enhanced), (TokenUsage, usage), (AIJob, jobs)]:
+        db.session.execute(insert(model), rows)
+    db.session.commit()
+    
+    rebuild_user_stats()
+    with db.engine.begin() as conn:
+        rebuild_search_index(conn)
+    db.session.execute(db.text('ANALYZE'))
+    return note_id
+
+def route_requests(client, user_id, note_id):
+    """各接口的一次调用（直接走应用路由，统计的就是路由实际执行的SQL）"""
+    headers = {'Authorization': f'Bearer {create_access_token(identity=str(user_id))}'}
+    first_page = client.get('/api/notes', headers=headers)
+    cursor = first_page.headers.get('X-Next-Cursor', '')
+    etag = first_page.headers.get('ETag', '')
+    job_id = db.session.query(AIJob.id).filter_by(user_id=user_id).order_by(AIJob.id.desc()).limit(1).scalar()
+    
+    def get(path, **extra):
+        return lambda: client.get(path, headers={**headers, **extra})
+    
+    return [
+        ('POST /api/login', lambda: client.post('/api/login', json={
+            'username': f'bench{user_id}', 'password': BENCH_PASSWORD})),
+        ('GET /api/notes', get('/api/notes')),
+        ('GET /api/notes?cursor=', get(f'/api/notes?cursor={cursor}')),
+        ('GET /api/notes (If-None-Match)', get('/api/notes', **{'If-None-Match': etag})),
+        ('GET /api/notes/<id>', get(f'/api/notes/{note_id}')),
+        ('POST /api/vocabulary', lambda: client.post('/api/vocabulary', headers=headers,
+                                                     json={'word': 'word7', 'known': True})),
+        ('GET /api/vocabulary/known', get('/api/vocabulary/known')),
+        ('GET /api/history', get('/api/history')),
+        ('GET /api/history?type=', get('/api/history?type=note')),
+        ('GET /api/progress', get('/api/progress')),
+        ('GET /api/search', get('/api/search?q=内容')),
+        ('GET /api/search?type=', get('/api/search?q=优化&type=enhanced')),
+        ('GET /api/jobs/<id>', get(f'/api/jobs/{job_id}')),
+        ('GET /api/usage', get('/api/usage')),
+        ('任务worker领取任务', claim_next_job),
+    ]
+
+def main():
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    notes_per_user = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(DB_PATH + suffix):
+            os.remove(DB_PATH + suffix)
+    
+    with app.app_context():
+        init_database()
+        started = time.time()
+        total_notes = seed(users, notes_per_user)
+        print(f"📦 已生成 {users} 个用户、{total_notes} 条笔记，用时 {time.time() - started:.1f} 秒")
+        print(f"数据库: {DB_PATH}\n")
+    
+        client = app.test_client()
+        user_id = users // 2 or 1
+        note_id = (user_id - 1) * notes_per_user + 1
+        requests = route_requests(client, user_id, note_id)
+    
+        statements = []
+    
+        @event.listens_for(db.engine, 'before_cursor_execute')
+        def capture(conn, cursor, statement, parameters, context, executemany):
+            if not executemany:
+                statements.append((statement, parameters))
+    
+        for name, run in requests:
+            statements.clear()
+            run()
+            # 同一条SQL只分析第一次执行时的参数
+            executed = {}
+            for statement, parameters in statements:
+                executed.setdefault(statement, parameters)
+            started = time.perf_counter()
+            for _ in range(REPEAT):
+                run()
+            elapsed_ms = (time.perf_counter() - started) * 1000 / REPEAT
+            db.session.rollback()
+    
+            print(f"=== {name}  平均 {elapsed_ms:.2f} ms，{len(executed)} 条SQL")
+            for statement, parameters in executed.items():
+                print(f"  {' '.join(statement.split())[:100]}")
+                plan = db.session.connection().exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters)
+                for row in plan:
+                    print(f"      {row[-1]}")
+                db.session.rollback()
+        event.remove(db.engine, 'before_cursor_execute', capture)
+
+if __name__ == '__main__':
+    main()
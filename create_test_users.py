@@ -7,7 +7,7 @@ import sys
 import os
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
-from app import app, db, User
+from app import app, db, User, init_database
 from werkzeug.security import generate_password_hash
 
 def create_test_users():
@@ -46,8 +46,8 @@ def create_test_users():
     ]
     
     with app.app_context():
-        # 确保数据库表存在
-        db.create_all()
+        # 确保数据库表存在且迁移已应用
+        init_database()
         
         created_count = 0
         for user_data in test_users:
@@ -1,17 +1,34 @@
 # Gunicorn 生产环境配置文件
 import multiprocessing
+import os
+
+# 工作进程类型：sync（默认）或 gevent（协作式，单进程可同时挂起上百个AI调用）
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'sync')
+
+if worker_class == 'gevent':
+    # preload_app 会在 master 进程中提前导入应用，需在导入前完成 monkey patch
+    from gevent import monkey
+    monkey.patch_all()
+    # gevent 下各组件的情况：
+    # - 模型调用（httpx）、长文档分块与批量补全的线程池、访问计数/心跳线程都会变成greenlet，可以安全使用
+    # - 缓存、限流、single-flight 使用的 sqlite3 是C扩展，调用期间会阻塞本进程的所有greenlet，
+    #   这些语句都很短（等待写锁最多 10 秒的 busy timeout），可以接受
+    # - 文档提取进程池（ProcessPoolExecutor）的管理线程与管道在 monkey patch 后不可靠，强制改为在本进程内提取
+    # - 内嵌的任务worker会在greenlet中执行PDF提取等CPU密集的处理，期间阻塞所有请求，
+    #   因此关闭，需另外运行 python job_worker.py 执行异步任务
+    os.environ['EXTRACT_PROCESSES'] = '1'
+    if os.getenv('JOB_EMBEDDED_WORKERS', 'true').lower() == 'true':
+        print("[GUNICORN] gevent 模式下不启动内嵌任务worker，请单独运行 python job_worker.py")
+    os.environ['JOB_EMBEDDED_WORKERS'] = 'false'
 
 # 服务器绑定地址
 bind = "0.0.0.0:5001"
 
 # 工作进程数（推荐 CPU 核心数 * 2 + 1）
-workers = 4
-
-# 工作进程类型
-worker_class = "sync"
+workers = int(os.getenv('GUNICORN_WORKERS', 4))
 
-# 每个工作进程的最大连接数
-worker_connections = 1000
+# 每个工作进程的最大连接数（仅对 gevent 等异步worker生效）
+worker_connections = int(os.getenv('GUNICORN_WORKER_CONNECTIONS', 1000))
 
 # 超时设置
 timeout = 120
@@ -35,3 +52,16 @@ proc_name = "learning_assistant_api"
 # 用户和组（如果需要）
 # user = "www-data"
 # group = "www-data"
+
+def post_fork(server, worker):
+    """在每个worker进程中启动内嵌的任务worker线程（preload_app 下主进程的线程不会带到子进程），
+    重启前已入队的任务无需等待新的入队请求即可继续执行"""
+    from app import app, start_job_workers
+    if app.config['JOB_EMBEDDED_WORKERS']:
+        start_job_workers()
+
+def worker_exit(server, worker):
+    """worker退出前写入缓冲中的笔记访问计数"""
+    from app import app, flush_note_accesses
+    with app.app_context():
+        flush_note_accesses()
@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+"""
+独立运行的AI任务worker进程
+
+生产环境中可设置 JOB_EMBEDDED_WORKERS=false，让gunicorn只负责处理请求，
+由本脚本专门执行AI生成任务和上传文件的后台处理（文本提取、自动补全、关键词提取）：
+    python job_worker.py [并发数]
+"""
+
+import sys
+import os
+import threading
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from app import app, init_database, start_job_workers
+
+def main():
+    concurrency = int(sys.argv[1]) if len(sys.argv) > 1 else app.config['JOB_WORKER_CONCURRENCY']
+
+    with app.app_context():
+        # 确保数据库表存在且迁移已应用
+        init_database()
+
+    start_job_workers(concurrency)
+    print(f"✅ AI任务worker已启动，并发数: {concurrency}，按 Ctrl+C 停止")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        print("\n👋 AI任务worker已停止")
+
+if __name__ == '__main__':
+    main()
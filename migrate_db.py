@@ -0,0 +1,25 @@
+#!/usr/bin/env python3
+"""
+数据库迁移脚本
+
+建表并执行尚未应用的迁移（补充索引、唯一约束等），部署或升级后运行一次：
+    python migrate_db.py
+"""
+
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from app import app, db, run_migrations
+
+def main():
+    with app.app_context():
+        db.create_all()
+        applied = run_migrations()
+    if applied:
+        print(f"✅ 已应用迁移: {', '.join(str(v) for v in applied)}")
+    else:
+        print("✅ 数据库已是最新版本")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,26 @@
+#!/usr/bin/env python3
+"""
+重建相似内容索引
+
+按当前 SIMILAR_DIM 重新计算所有历史优化结果的向量（修改维度或索引文件损坏后运行）：
+    python rebuild_similar_index.py
+"""
+
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from app import app, init_database, rebuild_similar_index, _get_numpy
+
+def main():
+    if _get_numpy() is None:
+        print("❌ 需要先安装 numpy: pip install numpy")
+        sys.exit(1)
+
+    with app.app_context():
+        init_database()
+        count = rebuild_similar_index()
+    print(f"✅ 相似内容索引已重建，共 {count} 条")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,25 @@
+#!/usr/bin/env python3
+"""
+重建学习统计汇总
+
+从笔记和进度记录重新计算 UserStats（汇总数据与原始记录不一致时运行）：
+    python rebuild_stats.py [用户ID ...]
+"""
+
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from app import app, init_database, flush_note_accesses, rebuild_user_stats
+
+def main():
+    user_ids = [int(arg) for arg in sys.argv[1:]] or None
+
+    with app.app_context():
+        init_database()
+        flush_note_accesses()
+        count = rebuild_user_stats(user_ids)
+    print(f"✅ 已重建 {count} 个用户的学习统计")
+
+if __name__ == '__main__':
+    main()
@@ -11,7 +11,8 @@ import {
   Typography,
   Spin,
   Tag,
-  Alert
+  Alert,
+  Checkbox
 } from 'antd'
 import { 
   UploadOutlined, 
@@ -30,24 +31,38 @@ const { Title, Paragraph } = Typography
 const { TextArea } = Input
 const { Option } = Select
 
+const NOTES_PAGE_SIZE = 20
+
 function Notes() {
   const [notes, setNotes] = useState([])
+  const [nextCursor, setNextCursor] = useState(null)
   const [loading, setLoading] = useState(true)
+  const [loadingMore, setLoadingMore] = useState(false)
   const [uploading, setUploading] = useState(false)
   const [selectedNote, setSelectedNote] = useState(null)
   const [noteModalVisible, setNoteModalVisible] = useState(false)
   const [enhanceModalVisible, setEnhanceModalVisible] = useState(false)
   const [enhancedContent, setEnhancedContent] = useState('')
   const [enhancing, setEnhancing] = useState(false)
+  const [selectedIds, setSelectedIds] = useState([])
+  const [batchEnhancing, setBatchEnhancing] = useState(false)
 
   useEffect(() => {
     loadNotes()
   }, [])
 
+  // 有笔记正在后台处理时定期刷新列表，直到全部处理完成
+  useEffect(() => {
+    if (!notes.some(note => note.status === 'processing')) return
+    const timer = setTimeout(loadNotes, 3000)
+    return () => clearTimeout(timer)
+  }, [notes])
+
   const loadNotes = async () => {
     try {
-      const response = await api.getNotes()
+      const response = await api.getNotes({ limit: NOTES_PAGE_SIZE })
       setNotes(response.data)
+      setNextCursor(response.headers['x-next-cursor'] || null)
     } catch (error) {
       message.error('加载笔记失败')
     } finally {
@@ -55,6 +70,19 @@ function Notes() {
     }
   }
 
+  const loadMoreNotes = async () => {
+    setLoadingMore(true)
+    try {
+      const response = await api.getNotes({ limit: NOTES_PAGE_SIZE, cursor: nextCursor })
+      setNotes(prev => [...prev, ...response.data])
+      setNextCursor(response.headers['x-next-cursor'] || null)
+    } catch (error) {
+      message.error('加载笔记失败')
+    } finally {
+      setLoadingMore(false)
+    }
+  }
+
   const handleUpload = async ({ file, onSuccess, onError }) => {
     setUploading(true)
     const formData = new FormData()
@@ -63,8 +91,8 @@ function Notes() {
     formData.append('category', '未分类')
 
     try {
-      await api.uploadFile(formData)
-      message.success('文件上传成功')
+      const response = await api.uploadFile(formData)
+      message.success(response.data.status === 'processing' ? '文件上传成功，正在后台处理' : '文件上传成功')
       onSuccess()
       loadNotes()
     } catch (error) {
@@ -108,6 +136,36 @@ function Notes() {
     }
   }
 
+  const toggleSelected = (noteId, checked) => {
+    setSelectedIds(prev => checked ? [...prev, noteId] : prev.filter(id => id !== noteId))
+  }
+
+  // 批量补全：条数较多时服务端整批入队，轮询任务直到完成
+  const handleBatchEnhance = async () => {
+    setBatchEnhancing(true)
+    try {
+      const response = await api.enhanceNotesBatch(selectedIds)
+      let results = response.data.results
+      if (response.status === 202) {
+        message.info('批量补全已开始，正在后台处理')
+        let job = response.data
+        while (job.status === 'queued' || job.status === 'running') {
+          await new Promise(resolve => setTimeout(resolve, 3000))
+          job = (await api.getJob(response.data.job_id)).data
+        }
+        if (job.status !== 'done') throw new Error(job.error)
+        results = job.results
+      }
+      const succeeded = results.filter(item => item.status === 'done').length
+      message.success(`批量补全完成：成功 ${succeeded}/${results.length} 条，结果已保存到服务器`)
+      setSelectedIds([])
+    } catch (error) {
+      message.error('批量补全失败')
+    } finally {
+      setBatchEnhancing(false)
+    }
+  }
+
   const getFileIcon = (fileType) => {
     switch (fileType?.toLowerCase()) {
       case 'pdf':
@@ -143,6 +201,15 @@ function Notes() {
         <div style={{ display: 'flex', justifyContent: 'space-between', alignItems: 'center', marginBottom: 24 }}>
           <Title level={2}>笔记管理</Title>
           <div>
+            <Button
+              style={{ marginRight: 8 }}
+              icon={<EditOutlined />}
+              disabled={!selectedIds.length}
+              loading={batchEnhancing}
+              onClick={handleBatchEnhance}
+            >
+              批量补全{selectedIds.length ? ` (${selectedIds.length})` : ''}
+            </Button>
             <Upload {...uploadProps}>
               <Button 
                 type="primary" 
@@ -167,9 +234,21 @@ function Notes() {
           <List
             loading={loading}
             dataSource={notes}
+            loadMore={nextCursor && (
+              <div style={{ textAlign: 'center', marginTop: 16 }}>
+                <Button onClick={loadMoreNotes} loading={loadingMore}>加载更多</Button>
+              </div>
+            )}
             renderItem={note => (
               <List.Item
                 actions={[
+                  <Checkbox
+                    checked={selectedIds.includes(note.id)}
+                    disabled={note.status !== 'ready'}
+                    onChange={e => toggleSelected(note.id, e.target.checked)}
+                  >
+                    选择
+                  </Checkbox>,
                   <Button 
                     type="link" 
                     onClick={() => handleNoteClick(note.id)}
@@ -184,6 +263,8 @@ function Notes() {
                   description={
                     <div>
                       <Tag color="blue">{note.category}</Tag>
+                      {note.status === 'processing' && <Tag color="orange">处理中</Tag>}
+                      {note.status === 'failed' && <Tag color="red">处理失败</Tag>}
                       <span style={{ marginLeft: 8, color: '#666' }}>
                         {new Date(note.created_at).toLocaleDateString()}
                       </span>
@@ -215,6 +296,11 @@ function Notes() {
               <Paragraph>
                 <strong>分类:</strong> {selectedNote.category}
               </Paragraph>
+              {selectedNote.keywords?.length > 0 && (
+                <Paragraph>
+                  <strong>关键词:</strong> {selectedNote.keywords.map(keyword => <Tag key={keyword}>{keyword}</Tag>)}
+                </Paragraph>
+              )}
               <Paragraph>
                 <strong>创建时间:</strong> {new Date(selectedNote.created_at).toLocaleString()}
               </Paragraph>
@@ -42,12 +42,19 @@ export const api = {
     }),
 
   // 笔记相关
-  getNotes: () => axios.get('/api/notes'),
+  getNotes: (params) => axios.get('/api/notes', { params }),
   getNote: (id) => axios.get(`/api/notes/${id}`),
+  deleteNote: (id) => axios.delete(`/api/notes/${id}`),
+  getNoteStatus: (id) => axios.get(`/api/notes/${id}/status`),
   
   // AI功能
   enhanceNotes: (content, isImage = false) => 
     axios.post('/api/enhance-notes', { content, is_image: isImage }),
+
+  enhanceNotesBatch: (noteIds = [], contents = []) =>
+    axios.post('/api/enhance-notes/batch', { note_ids: noteIds, contents }),
+
+  getJob: (id) => axios.get(`/api/jobs/${id}`),
   
   analyzeProblems: (problems, isImage = false) => 
     axios.post('/api/analyze-problems', { problems, is_image: isImage }),
@@ -63,6 +70,14 @@ export const api = {
   
   recordVocabulary: (word, known) => 
     axios.post('/api/vocabulary', { word, known }),
+
+  recordVocabularyBulk: (words) =>
+    axios.post('/api/vocabulary/bulk', { words }),
+
+  getKnownWords: () => axios.get('/api/vocabulary/known'),
+  
+  // 全文搜索
+  search: (q, params = {}) => axios.get('/api/search', { params: { q, ...params } }),
   
   // 学习进度
   getProgress: () => axios.get('/api/progress')
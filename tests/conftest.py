@@ -0,0 +1,81 @@
+"""
+测试公共配置（不需要启动服务，也不会调用真实的AI接口）：
+    python -m pytest -q tests
+"""
+
+import os
+import sys
+import tempfile
+import types
+import uuid
+
+import pytest
+
+# 必须在导入应用之前指定数据库与各缓存目录，避免读写真实数据
+TMP_DIR = tempfile.mkdtemp(prefix='learning_assistant_test_')
+os.environ.update({
+    'DATABASE_URL': f"sqlite:///{os.path.join(TMP_DIR, 'test.db')}",
+    'AI_CACHE_PATH': os.path.join(TMP_DIR, 'ai_cache.db'),
+    'EXTRACT_CACHE_PATH': os.path.join(TMP_DIR, 'extract_cache.db'),
+    'SIMILAR_INDEX_DIR': os.path.join(TMP_DIR, 'similar'),
+    'CONTENT_OBJECT_DIR': os.path.join(TMP_DIR, 'objects'),
+    'UPLOAD_BLOB_DIR': os.path.join(TMP_DIR, 'blobs'),
+    'JOB_EMBEDDED_WORKERS': 'false',
+    # 访问计数只在测试显式调用时写库
+    'ACCESS_FLUSH_INTERVAL': '3600',
+    'ARK_API_KEY': os.getenv('ARK_API_KEY', 'test'),
+})
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as learning_app
+from app import app, db, init_database, User
+from flask_jwt_extended import create_access_token
+
+@pytest.fixture(scope='session', autouse=True)
+def app_context():
+    app.config['UPLOAD_FOLDER'] = os.path.join(TMP_DIR, 'uploads')
+    with app.app_context():
+        init_database()
+        if not db.session.get(User, 1):
+            db.session.add(User(id=1, username='tester', email='tester@example.com', password_hash='x'))
+            db.session.commit()
+        yield
+
+@pytest.fixture
+def client():
+    return app.test_client()
+
+@pytest.fixture
+def auth_headers():
+    with app.test_request_context():
+        return {'Authorization': f"Bearer {create_access_token(identity='1')}"}
+
+@pytest.fixture
+def new_user():
+    """创建一个独立的用户，返回 (用户ID, 请求头)，避免各测试的数据互相影响"""
+    user = User(username=f'tester-{uuid.uuid4().hex[:12]}', email=f'{uuid.uuid4().hex[:12]}@example.com',
+                password_hash='x')
+    db.session.add(user)
+    db.session.commit()
+    with app.test_request_context():
+        return user.id, {'Authorization': f"Bearer {create_access_token(identity=str(user.id))}"}
+
+@pytest.fixture
+def fake_ai(monkeypatch):
+    """替换AI客户端：返回 "RESULT for <最后一条消息>"，并记录每次调用的 (模型, 消息)"""
+    calls = []
+
+    def create(model, messages, timeout=None, stream=False, stream_options=None):
+        calls.append((model, messages))
+        text = f"RESULT for {messages[-1]['content']}"
+        usage = types.SimpleNamespace(prompt_tokens=10, completion_tokens=5, total_tokens=15)
+        if stream:
+            chunks = [types.SimpleNamespace(choices=[types.SimpleNamespace(delta=types.SimpleNamespace(content=text[i:i + 8]))],
+                                            usage=None) for i in range(0, len(text), 8)]
+            return iter(chunks + [types.SimpleNamespace(choices=[], usage=usage)])
+        return types.SimpleNamespace(choices=[types.SimpleNamespace(message=types.SimpleNamespace(content=text))],
+                                     usage=usage)
+
+    client = types.SimpleNamespace(chat=types.SimpleNamespace(completions=types.SimpleNamespace(create=create)))
+    monkeypatch.setattr(learning_app, 'ai_client', client)
+    return calls
@@ -0,0 +1,45 @@
+"""AI响应缓存：缓存键的规范化，以及相同请求命中缓存时不再调用上游"""
+
+from app import app, call_ai_api, make_ai_cache_key, ai_cache_stats
+
+def test_cache_key_ignores_line_ending_and_trailing_whitespace():
+    messages = [{'role': 'user', 'content': '第一行\r\n第二行  \n'}]
+    same = [{'role': 'user', 'content': '第一行\n第二行'}]
+    assert make_ai_cache_key('model-a', messages) == make_ai_cache_key('model-a', same)
+
+def test_cache_key_separates_model_level_and_content():
+    messages = [{'role': 'user', 'content': '求解 x + 1 = 2'}]
+    key = make_ai_cache_key('model-a', messages, 'B1')
+    assert key != make_ai_cache_key('model-b', messages, 'B1')
+    assert key != make_ai_cache_key('model-a', messages, 'C1')
+    assert key != make_ai_cache_key('model-a', [{'role': 'user', 'content': '求解 x + 1 = 3'}], 'B1')
+    assert key != make_ai_cache_key('model-a', [{'role': 'system', 'content': '求解 x + 1 = 2'}], 'B1')
+
+def test_cache_key_normalizes_text_parts_only():
+    image = {'type': 'image_url', 'image_url': {'url': 'data:image/png;base64,AAAA'}}
+    messages = [{'role': 'user', 'content': [image, {'type': 'text', 'text': '分析这道题 \r\n'}]}]
+    same = [{'role': 'user', 'content': [image, {'type': 'text', 'text': '分析这道题'}]}]
+    other_image = [{'role': 'user', 'content': [
+        {'type': 'image_url', 'image_url': {'url': 'data:image/png;base64,BBBB'}},
+        {'type': 'text', 'text': '分析这道题'}
+    ]}]
+    assert make_ai_cache_key('model-a', messages) == make_ai_cache_key('model-a', same)
+    assert make_ai_cache_key('model-a', messages) != make_ai_cache_key('model-a', other_image)
+
+def test_repeated_call_is_served_from_cache(fake_ai):
+    messages = [{'role': 'user', 'content': '缓存测试：勾股定理'}]
+    hits = ai_cache_stats()['hits']
+    with app.test_request_context():
+        first = call_ai_api(messages, model_id='test-cache')
+        second = call_ai_api([{'role': 'user', 'content': '缓存测试：勾股定理\r\n'}], model_id='test-cache')
+    assert first == second == 'RESULT for 缓存测试：勾股定理'
+    assert len(fake_ai) == 1
+    assert ai_cache_stats()['hits'] == hits + 1
+
+def test_no_cache_skips_lookup_but_refreshes_entry(fake_ai):
+    messages = [{'role': 'user', 'content': '缓存测试：牛顿第二定律'}]
+    with app.test_request_context():
+        call_ai_api(messages, model_id='test-cache')
+        call_ai_api(messages, model_id='test-cache', use_cache=False)
+        call_ai_api(messages, model_id='test-cache')
+    assert len(fake_ai) == 2
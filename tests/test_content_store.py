@@ -0,0 +1,107 @@
+"""优化内容正文存储：三种存储方式压缩后读写一致，编辑后原样返回并释放旧对象，对象存储按内容去重，下载时生成文档"""
+
+import os
+
+import pytest
+
+from app import app, db, EnhancedContent, save_enhanced_content, _object_path
+
+def _long_text(user_id):
+    # 对象存储按内容去重，每个用例用不同的正文，避免引用到其他用例保存的对象
+    return f'# 用户{user_id}\n' + '## 导数的应用\n利用导数判断函数的单调性与极值。\n' * 400
+
+@pytest.fixture(autouse=True)
+def content_dirs(monkeypatch, tmp_path):
+    monkeypatch.setitem(app.config, 'CONTENT_FILE_DIR', str(tmp_path / 'files'))
+    monkeypatch.setitem(app.config, 'CONTENT_OBJECT_DIR', str(tmp_path / 'objects'))
+    monkeypatch.setitem(app.config, 'CONTENT_COMPRESSION', 'gzip')
+
+def _stored_path(ref):
+    scheme, _, key = ref.partition(':')
+    return key if scheme == 'file' else _object_path(key)
+
+def _history(client, headers, item_id):
+    response = client.get(f'/api/history/{item_id}', headers=headers)
+    assert response.status_code == 200
+    return response.get_json()['content']
+
+@pytest.mark.parametrize('store, scheme', [('db', 'db:gz'), ('filesystem', 'file:'), ('object', 'object:')])
+def test_compressed_text_round_trips(client, new_user, monkeypatch, store, scheme):
+    user_id, headers = new_user
+    text = _long_text(user_id)
+    monkeypatch.setitem(app.config, 'CONTENT_STORE', store)
+    save_id = save_enhanced_content(user_id, '导数', text, 'note')
+
+    item = db.session.get(EnhancedContent, save_id)
+    assert item.content_ref.startswith(scheme)
+    assert item.enhanced_content is None
+    if store != 'db':
+        assert _stored_path(item.content_ref).endswith('.gz')
+    assert _history(client, headers, save_id).endswith(f"## 优化后内容\n\n{text}\n")
+
+def test_short_text_stays_inline(new_user):
+    user_id, _ = new_user
+    save_id = save_enhanced_content(user_id, '导数', '## 极值', 'note')
+    item = db.session.get(EnhancedContent, save_id)
+    assert item.content_ref is None
+    assert item.enhanced_content == '## 极值'
+
+def _edit(client, headers, item_id, text):
+    response = client.put(f'/api/history/{item_id}', headers=headers, json={'content': text})
+    assert response.status_code == 200
+    db.session.expire_all()
+    return _stored_path(db.session.get(EnhancedContent, item_id).content_ref)
+
+def test_filesystem_edit_rewrites_record_file(client, new_user, monkeypatch):
+    user_id, headers = new_user
+    text = _long_text(user_id)
+    monkeypatch.setitem(app.config, 'CONTENT_STORE', 'filesystem')
+    save_id = save_enhanced_content(user_id, '导数', text, 'note')
+    path = _stored_path(db.session.get(EnhancedContent, save_id).content_ref)
+
+    edited = text + '## 补充\n洛必达法则'
+    assert _edit(client, headers, save_id, edited) == path
+    # 编辑过的内容即完整文档，原样返回
+    assert _history(client, headers, save_id) == edited
+
+def test_object_edit_releases_old_object(client, new_user, monkeypatch):
+    user_id, headers = new_user
+    text = _long_text(user_id)
+    monkeypatch.setitem(app.config, 'CONTENT_STORE', 'object')
+    save_id = save_enhanced_content(user_id, '导数', text, 'note')
+    old_path = _stored_path(db.session.get(EnhancedContent, save_id).content_ref)
+
+    edited = text + '## 补充\n洛必达法则'
+    new_path = _edit(client, headers, save_id, edited)
+    assert new_path != old_path
+    assert not os.path.exists(old_path)
+    assert _history(client, headers, save_id) == edited
+
+def test_object_store_shares_identical_text(client, new_user, monkeypatch):
+    user_id, headers = new_user
+    text = _long_text(user_id)
+    monkeypatch.setitem(app.config, 'CONTENT_STORE', 'object')
+    first = save_enhanced_content(user_id, '导数', text, 'note')
+    second = save_enhanced_content(user_id, '导数（复习）', text, 'note')
+    ref = db.session.get(EnhancedContent, first).content_ref
+    assert db.session.get(EnhancedContent, second).content_ref == ref
+
+    assert client.delete(f'/api/history/{first}', headers=headers).status_code == 200
+    assert os.path.exists(_stored_path(ref))
+    assert client.delete(f'/api/history/{second}', headers=headers).status_code == 200
+    assert not os.path.exists(_stored_path(ref))
+
+def test_download_renders_document(client, new_user, monkeypatch):
+    user_id, headers = new_user
+    text = _long_text(user_id)
+    monkeypatch.setitem(app.config, 'CONTENT_STORE', 'filesystem')
+    save_id = save_enhanced_content(user_id, '求函数的极值', text, 'problem')
+
+    response = client.get(f'/api/history/{save_id}/download', headers=headers)
+    assert response.status_code == 200
+    assert response.mimetype == 'text/markdown'
+    assert f'_{save_id}.md' in response.headers['Content-Disposition']
+    document = response.get_data(as_text=True)
+    assert document.startswith('# Problem - 优化内容')
+    assert '## 原始内容\n\n求函数的极值' in document
+    assert document.endswith(f"## 优化后内容\n\n{text}\n")
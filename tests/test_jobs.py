@@ -0,0 +1,90 @@
+"""AI任务队列：入队、原子领取、执行后保存结果，心跳超时的任务重新排队"""
+
+from datetime import datetime, timedelta
+
+import pytest
+
+import app as learning_app
+from app import app, db, AIJob, claim_next_job, run_job_with_heartbeat, requeue_stale_jobs
+
+@pytest.fixture(autouse=True)
+def empty_queue(monkeypatch):
+    """其他测试留下的排队任务不参与领取"""
+    AIJob.query.filter(AIJob.status.in_(['queued', 'running'])).update({'status': 'failed'}, synchronize_session=False)
+    db.session.commit()
+    monkeypatch.setattr(learning_app, '_job_requeue_at', 0.0)
+
+def _run_next_job():
+    with app.app_context():
+        job = claim_next_job()
+        assert job is not None
+        run_job_with_heartbeat(job)
+        return job.id
+
+def test_async_request_is_queued_then_run_by_a_worker(client, new_user, fake_ai):
+    _, headers = new_user
+    response = client.post('/api/enhance-notes', headers=headers,
+                           json={'content': '任务测试：细胞分裂', 'async': True, 'no_cache': True})
+    assert response.status_code == 202
+    job_id = response.get_json()['job_id']
+    assert client.get(f'/api/jobs/{job_id}', headers=headers).get_json()['status'] == 'queued'
+    assert fake_ai == []
+
+    assert _run_next_job() == job_id
+    job = client.get(f'/api/jobs/{job_id}', headers=headers).get_json()
+    assert job['status'] == 'done'
+    assert job['result'] == f"RESULT for {fake_ai[0][1][-1]['content']}"
+    assert job['save_id']
+
+def test_job_is_claimed_only_once(new_user):
+    user_id, _ = new_user
+    db.session.add(AIJob(user_id=user_id, job_type='note', payload='{}'))
+    db.session.commit()
+    assert claim_next_job() is not None
+    assert claim_next_job() is None
+
+def test_job_without_recent_heartbeat_is_requeued(new_user, monkeypatch):
+    user_id, _ = new_user
+    monkeypatch.setitem(app.config, 'JOB_STALE_SECONDS', 60)
+    now = datetime.utcnow()
+    stale = AIJob(user_id=user_id, job_type='note', payload='{}', status='running',
+                  started_at=now - timedelta(minutes=30), heartbeat_at=now - timedelta(minutes=5))
+    alive = AIJob(user_id=user_id, job_type='note', payload='{}', status='running',
+                  started_at=now - timedelta(minutes=30), heartbeat_at=now)
+    db.session.add_all([stale, alive])
+    db.session.commit()
+
+    assert requeue_stale_jobs() == 1
+    db.session.expire_all()
+    assert stale.status == 'queued'
+    assert alive.status == 'running'
+
+def test_requeue_check_runs_once_per_interval(new_user, monkeypatch):
+    user_id, _ = new_user
+    monkeypatch.setitem(app.config, 'JOB_REQUEUE_INTERVAL', 60)
+    assert requeue_stale_jobs() == 0
+    db.session.add(AIJob(user_id=user_id, job_type='note', payload='{}', status='running',
+                         started_at=datetime.utcnow() - timedelta(hours=1)))
+    db.session.commit()
+    # 间隔内的再次检查不执行UPDATE
+    assert requeue_stale_jobs() == 0
+
+def test_running_job_writes_heartbeats(new_user, monkeypatch):
+    user_id, _ = new_user
+    monkeypatch.setitem(app.config, 'JOB_HEARTBEAT_INTERVAL', 0.05)
+    beats = []
+
+    def slow_handler(payload, on_progress):
+        with app.app_context():
+            for _ in range(4):
+                learning_app.time.sleep(0.05)
+                beats.append(db.session.get(AIJob, job_id).heartbeat_at)
+        return None
+    monkeypatch.setitem(learning_app.AI_JOB_HANDLERS, 'note', slow_handler)
+    job = AIJob(user_id=user_id, job_type='note', payload='{"content": "x", "is_image": false}')
+    db.session.add(job)
+    db.session.commit()
+    job_id = job.id
+
+    _run_next_job()
+    assert len(set(beats)) > 1
@@ -0,0 +1,73 @@
+"""笔记访问计数写回缓冲：访问先进入进程内缓冲，批量UPSERT写库，写库失败时放回缓冲"""
+
+import pytest
+
+import app as learning_app
+from app import (app, db, Note, ProgressRecord, flush_note_accesses, pending_note_accesses,
+                 record_note_access)
+
+@pytest.fixture(autouse=True)
+def empty_buffer(monkeypatch):
+    monkeypatch.setitem(app.config, 'ACCESS_BUFFER_ENABLED', True)
+    monkeypatch.setitem(app.config, 'ACCESS_FLUSH_THRESHOLD', 500)
+    flush_note_accesses()
+
+def _note(user_id):
+    note = Note(user_id=user_id, title='访问计数', content='内容', file_type='txt')
+    db.session.add(note)
+    db.session.commit()
+    return note.id
+
+def _access_count(user_id, note_id):
+    db.session.expire_all()
+    record = ProgressRecord.query.filter_by(user_id=user_id, note_id=note_id).first()
+    return record.access_count if record else None
+
+def test_accesses_are_buffered_then_written_in_one_flush(client, new_user):
+    user_id, headers = new_user
+    note_id = _note(user_id)
+    for _ in range(3):
+        assert client.get(f'/api/notes/{note_id}', headers=headers).status_code == 200
+    assert _access_count(user_id, note_id) is None
+    assert pending_note_accesses(user_id)[note_id][0] == 3
+    # 尚未写库的访问也计入进度统计
+    assert client.get('/api/progress', headers=headers).get_json()['total_access'] == 3
+
+    assert flush_note_accesses() == 1
+    assert _access_count(user_id, note_id) == 3
+    assert pending_note_accesses(user_id) == {}
+
+    record_note_access(user_id, note_id)
+    flush_note_accesses()
+    assert _access_count(user_id, note_id) == 4
+
+def test_buffer_flushes_when_threshold_is_reached(new_user, monkeypatch):
+    user_id, _ = new_user
+    monkeypatch.setitem(app.config, 'ACCESS_FLUSH_THRESHOLD', 2)
+    first, second = _note(user_id), _note(user_id)
+    record_note_access(user_id, first)
+    assert _access_count(user_id, first) is None
+    record_note_access(user_id, second)
+    assert _access_count(user_id, first) == _access_count(user_id, second) == 1
+
+def test_failed_flush_keeps_accesses_for_the_next_attempt(new_user, monkeypatch):
+    user_id, _ = new_user
+    note_id = _note(user_id)
+    record_note_access(user_id, note_id)
+
+    def broken(entries):
+        raise RuntimeError('database is locked')
+    with monkeypatch.context() as patch:
+        patch.setattr(learning_app, '_write_note_accesses', broken)
+        assert flush_note_accesses() == 0
+    record_note_access(user_id, note_id)
+    assert pending_note_accesses(user_id)[note_id][0] == 2
+    flush_note_accesses()
+    assert _access_count(user_id, note_id) == 2
+
+def test_deleting_a_note_discards_its_pending_accesses(client, new_user):
+    user_id, headers = new_user
+    note_id = _note(user_id)
+    client.get(f'/api/notes/{note_id}', headers=headers)
+    assert client.delete(f'/api/notes/{note_id}', headers=headers).status_code == 200
+    assert note_id not in pending_note_accesses(user_id)
@@ -0,0 +1,92 @@
+"""列表游标分页：游标编解码、分页不重不漏、/api/notes 与 /api/history 的分页参数和ETag"""
+
+from datetime import datetime, timedelta
+
+import pytest
+
+from app import app, db, Note, EnhancedContent, encode_cursor, decode_cursor, paginate_keyset
+
+def test_cursor_round_trip():
+    created_at = datetime(2024, 5, 6, 7, 8, 9, 123456)
+    assert decode_cursor(encode_cursor(created_at, 42)) == (created_at, 42)
+
+@pytest.mark.parametrize('cursor', ['not-a-cursor', encode_cursor(datetime(2024, 1, 1), 1)[:-4]])
+def test_invalid_cursor_raises_value_error(cursor):
+    with pytest.raises(ValueError):
+        decode_cursor(cursor)
+
+def test_keyset_pages_cover_every_row_once_with_equal_timestamps():
+    Note.query.filter_by(user_id=1).delete()
+    same_time = datetime(2024, 3, 1, 12, 0, 0)
+    # 一半笔记的创建时间相同，检验同一时刻的记录不会跨页重复或遗漏
+    db.session.add_all([
+        Note(user_id=1, title=f'笔记{i}', content='内容', file_type='txt',
+             created_at=same_time if i % 2 else datetime(2024, 3, 1, 12, 0, i))
+        for i in range(23)
+    ])
+    db.session.commit()
+
+    seen, cursor = [], None
+    while True:
+        url = '/api/notes?limit=5' + (f'&cursor={cursor}' if cursor else '')
+        with app.test_request_context(url):
+            page, cursor = paginate_keyset(Note.query.filter_by(user_id=1), Note)
+        assert len(page) <= 5
+        seen.extend((note.created_at, note.id) for note in page)
+        if not cursor:
+            break
+    assert len(seen) == 23
+    assert len(set(seen)) == 23
+    assert seen == sorted(seen, reverse=True)
+
+def _add_notes(user_id, count):
+    start = datetime(2024, 4, 1)
+    db.session.add_all([Note(user_id=user_id, title=f'笔记{i}', content='内容', file_type='txt',
+                             created_at=start + timedelta(minutes=i)) for i in range(count)])
+    db.session.commit()
+
+def test_notes_route_follows_next_cursor_header(client, new_user):
+    user_id, headers = new_user
+    _add_notes(user_id, 12)
+    ids, url = [], '/api/notes?limit=5'
+    while url:
+        response = client.get(url, headers=headers)
+        assert response.status_code == 200
+        ids.extend(note['id'] for note in response.get_json())
+        cursor = response.headers.get('X-Next-Cursor')
+        url = f'/api/notes?limit=5&cursor={cursor}' if cursor else None
+    assert len(ids) == len(set(ids)) == 12
+
+    assert len(client.get('/api/notes?limit=0', headers=headers).get_json()) == 12
+    assert client.get('/api/notes?cursor=broken', headers=headers).status_code == 400
+
+def test_notes_default_page_size(client, new_user, monkeypatch):
+    user_id, headers = new_user
+    _add_notes(user_id, 7)
+    monkeypatch.setitem(app.config, 'PAGE_DEFAULT_LIMIT', 3)
+    response = client.get('/api/notes', headers=headers)
+    assert len(response.get_json()) == 3
+    assert response.headers.get('X-Next-Cursor')
+
+def test_notes_etag_returns_304_until_list_changes(client, new_user):
+    user_id, headers = new_user
+    _add_notes(user_id, 2)
+    etag = client.get('/api/notes', headers=headers).headers['ETag']
+    assert client.get('/api/notes', headers={**headers, 'If-None-Match': etag}).status_code == 304
+    _add_notes(user_id, 1)
+    assert client.get('/api/notes', headers={**headers, 'If-None-Match': etag}).status_code == 200
+
+def test_history_is_unpaginated_unless_limit_is_given(client, new_user, monkeypatch):
+    user_id, headers = new_user
+    monkeypatch.setitem(app.config, 'PAGE_DEFAULT_LIMIT', 5)
+    db.session.add_all([EnhancedContent(user_id=user_id, original_content='原文', enhanced_content='优化',
+                                        content_type='note') for _ in range(8)])
+    db.session.commit()
+
+    response = client.get('/api/history', headers=headers)
+    assert len(response.get_json()) == 8
+    assert 'X-Next-Cursor' not in response.headers
+    assert len(client.get('/api/history?limit=0', headers=headers).get_json()) == 8
+    page = client.get('/api/history?limit=3', headers=headers)
+    assert len(page.get_json()) == 3
+    assert page.headers.get('X-Next-Cursor')
@@ -0,0 +1,51 @@
+"""学习统计：汇总行随笔记创建、访问和删除增量更新，结果与从原始记录重算一致"""
+
+import io
+
+from app import app, db, UserStats, compute_user_stats, flush_note_accesses, rebuild_user_stats
+
+def _upload(client, headers, text, title):
+    response = client.post('/api/upload', headers=headers, content_type='multipart/form-data', data={
+        'file': (io.BytesIO(text.encode('utf-8')), f'{title}.txt'), 'title': title, 'category': '数学',
+        'async': 'false', 'auto_enhance': 'false', 'extract_keywords': 'false'
+    })
+    assert response.status_code == 200
+    return response.get_json()['note_id']
+
+def _stored_stats(user_id):
+    db.session.expire_all()
+    stats = db.session.get(UserStats, user_id)
+    return {column: getattr(stats, column)
+            for column in ('total_notes', 'total_access', 'progress_count', 'mastery_sum', 'recent_notes')}
+
+def test_incremental_stats_match_a_full_rebuild(client, new_user):
+    user_id, headers = new_user
+    assert client.get('/api/progress', headers=headers).get_json()['total_notes'] == 0
+
+    first = _upload(client, headers, '统计测试：极限的定义', '极限')
+    second = _upload(client, headers, '统计测试：导数的定义', '导数')
+    for note_id in (first, first, second):
+        client.get(f'/api/notes/{note_id}', headers=headers)
+    with app.app_context():
+        flush_note_accesses()
+
+    progress = client.get('/api/progress', headers=headers).get_json()
+    assert progress['total_notes'] == 2
+    assert progress['total_access'] == 3
+    assert [(entry['note_id'], entry['access_count']) for entry in progress['recent_notes']] == [(second, 1), (first, 2)]
+    assert _stored_stats(user_id) == compute_user_stats(user_id)
+
+    client.delete(f'/api/notes/{first}', headers=headers)
+    progress = client.get('/api/progress', headers=headers).get_json()
+    assert progress['total_notes'] == 1
+    assert progress['total_access'] == 1
+    assert _stored_stats(user_id) == compute_user_stats(user_id)
+
+def test_missing_stats_row_is_built_on_first_read(client, new_user):
+    user_id, headers = new_user
+    _upload(client, headers, '统计测试：积分', '积分')
+    UserStats.query.filter_by(user_id=user_id).delete()
+    db.session.commit()
+    assert client.get('/api/progress', headers=headers).get_json()['total_notes'] == 1
+    assert rebuild_user_stats([user_id]) == 1
+    assert _stored_stats(user_id)['total_notes'] == 1
@@ -0,0 +1,95 @@
+"""客户端限流：令牌预扣与按用量结算、失败调用退还配额、排队车道与轮次"""
+
+import time
+from contextlib import closing
+
+import pytest
+
+import app as learning_app
+from app import (app, g, acquire_rate_limit, settle_rate_limit, call_ai_api, RateLimitTimeout,
+                 _ai_cache_connect)
+
+@pytest.fixture(autouse=True)
+def rate_limit(monkeypatch):
+    monkeypatch.setitem(app.config, 'AI_RATE_LIMIT_TPM', 100000)
+    monkeypatch.setitem(app.config, 'AI_RATE_COMPLETION_RESERVE', 1000)
+    monkeypatch.setitem(app.config, 'AI_RATE_SHORT_TOKENS', 2000)
+    monkeypatch.setitem(app.config, 'AI_RATE_MAX_WAIT', 0.3)
+    monkeypatch.setitem(app.config, 'AI_RATE_LANE_AGING', 10)
+    with closing(_ai_cache_connect()) as conn:
+        conn.execute('DELETE FROM ai_rate_bucket')
+        conn.execute('DELETE FROM ai_rate_waiter')
+
+def _token_level():
+    with closing(_ai_cache_connect()) as conn:
+        return conn.execute("SELECT level FROM ai_rate_bucket WHERE name = 'tokens'").fetchone()[0]
+
+def _add_waiter(user_id, lane, turn, waited=0):
+    now = time.time()
+    with closing(_ai_cache_connect()) as conn:
+        conn.execute(
+            'INSERT INTO ai_rate_waiter (user_id, lane, turn, enqueued_at, heartbeat) VALUES (?, ?, ?, ?, ?)',
+            (user_id, lane, turn, now - waited, now + 60)
+        )
+
+def _as_user(user_id):
+    ctx = app.app_context()
+    ctx.push()
+    g.ai_user_id = user_id
+    return ctx
+
+def test_reservation_is_settled_to_actual_usage():
+    reserved = acquire_rate_limit(500)
+    assert reserved == 1500
+    assert _token_level() == pytest.approx(100000 - 1500, abs=5)
+    settle_rate_limit(reserved, type('Usage', (), {'total_tokens': 600})())
+    assert _token_level() == pytest.approx(100000 - 600, abs=5)
+
+def test_failed_attempts_refund_their_reservation(monkeypatch, fake_ai):
+    monkeypatch.setitem(app.config, 'AI_MAX_RETRIES', 0)
+
+    def broken(*args, **kwargs):
+        raise ValueError('upstream down')
+    monkeypatch.setattr(learning_app.ai_client.chat.completions, 'create', broken)
+    with app.test_request_context():
+        assert call_ai_api([{'role': 'user', 'content': '限流测试'}], model_id='test-rate', use_cache=False) is None
+    assert _token_level() == pytest.approx(100000, abs=5)
+
+def test_waits_behind_queue_head_until_timeout():
+    _add_waiter('other', 0, 0)
+    with pytest.raises(RateLimitTimeout):
+        acquire_rate_limit(100)
+
+def test_short_lane_goes_before_fresh_long_waiter():
+    _add_waiter('other', 1, 0)
+    assert acquire_rate_limit(100) == 1100
+
+def test_long_waiter_past_aging_is_not_overtaken():
+    _add_waiter('other', 1, 0, waited=30)
+    with pytest.raises(RateLimitTimeout):
+        acquire_rate_limit(100)
+
+def test_turns_increase_per_user_and_new_users_join_current_round(monkeypatch):
+    # 桶已空，请求只能排队；在等待时记录自己被分配的轮次
+    with closing(_ai_cache_connect()) as conn:
+        conn.execute("INSERT INTO ai_rate_bucket (name, level, updated_at) VALUES ('tokens', 0, ?)", (time.time() + 600,))
+    _add_waiter('7', 0, 2)
+    _add_waiter('7', 0, 3)
+    _add_waiter('8', 0, 5)
+    turns = {}
+    real_sleep = time.sleep
+
+    def record_turn(seconds):
+        with closing(_ai_cache_connect()) as conn:
+            turns[g.ai_user_id] = conn.execute('SELECT turn FROM ai_rate_waiter ORDER BY id DESC LIMIT 1').fetchone()[0]
+        real_sleep(seconds)
+    monkeypatch.setattr(learning_app.time, 'sleep', record_turn)
+
+    for user_id in ('7', '9'):
+        ctx = _as_user(user_id)
+        try:
+            with pytest.raises(RateLimitTimeout):
+                acquire_rate_limit(100)
+        finally:
+            ctx.pop()
+    assert turns == {'7': 4, '9': 2}
@@ -0,0 +1,106 @@
+"""重试分类、退避、截止时间、熔断与备用模型路由"""
+
+import httpx
+import pytest
+
+from openai import APITimeoutError, BadRequestError, RateLimitError
+import app as learning_app
+from app import (app, call_with_resilience, _retry_delay, AIDeadlineExceeded, CircuitOpenError,
+                 breaker_record_failure, breaker_record_success, route_model)
+
+@pytest.fixture
+def no_sleep(monkeypatch):
+    """重试时不真正等待，记录每次的退避秒数"""
+    delays = []
+    monkeypatch.setattr(learning_app.time, 'sleep', delays.append)
+    monkeypatch.setitem(app.config, 'AI_FALLBACK_MODEL_ID', None)
+    monkeypatch.setitem(app.config, 'AI_MAX_RETRIES', 2)
+    return delays
+
+def _api_request():
+    return httpx.Request('POST', 'https://ark.example.com/api/v3/chat/completions')
+
+def _status_error(error_class, status_code, headers=None):
+    response = httpx.Response(status_code, headers=headers, request=_api_request())
+    return error_class('error', response=response, body=None)
+
+def _failing(errors, result='ok'):
+    """依次抛出给定的异常，之后返回 (模型ID, 结果)，并记录每次调用使用的模型"""
+    calls = []
+
+    def request(model_id):
+        calls.append(model_id)
+        if len(calls) <= len(errors):
+            raise errors[len(calls) - 1]
+        return model_id, result
+    return request, calls
+
+def test_retries_timeouts_until_success(no_sleep):
+    request, calls = _failing([APITimeoutError(request=_api_request())] * 2)
+    assert call_with_resilience(request, 'test-retry-ok') == ('test-retry-ok', 'ok')
+    assert calls == ['test-retry-ok'] * 3
+    assert len(no_sleep) == 2
+
+def test_gives_up_after_max_retries(no_sleep):
+    request, calls = _failing([APITimeoutError(request=_api_request())] * 3)
+    with pytest.raises(APITimeoutError):
+        call_with_resilience(request, 'test-retry-exhausted')
+    assert len(calls) == 3
+
+def test_client_errors_are_not_retried(no_sleep):
+    request, calls = _failing([_status_error(BadRequestError, 400)])
+    with pytest.raises(BadRequestError):
+        call_with_resilience(request, 'test-no-retry')
+    assert len(calls) == 1
+    assert no_sleep == []
+
+def test_rate_limit_switches_to_fallback_without_waiting(no_sleep, monkeypatch):
+    monkeypatch.setitem(app.config, 'AI_FALLBACK_MODEL_ID', 'test-fallback')
+    request, calls = _failing([_status_error(RateLimitError, 429)])
+    assert call_with_resilience(request, 'test-primary') == ('test-fallback', 'ok')
+    assert calls == ['test-primary', 'test-fallback']
+    assert no_sleep == []
+
+def test_retry_delay_follows_retry_after_with_cap(monkeypatch):
+    monkeypatch.setitem(app.config, 'AI_RETRY_MAX_DELAY', 8)
+    assert _retry_delay(_status_error(RateLimitError, 429, {'retry-after': '3'}), 0) == 3
+    assert _retry_delay(_status_error(RateLimitError, 429, {'retry-after': '120'}), 0) == 8
+    monkeypatch.setitem(app.config, 'AI_RETRY_BASE_DELAY', 0.5)
+    for attempt in range(6):
+        assert 0 <= _retry_delay(APITimeoutError(request=_api_request()), attempt) <= min(8, 0.5 * 2 ** attempt)
+
+def test_no_retry_when_deadline_is_near(no_sleep):
+    request, calls = _failing([APITimeoutError(request=_api_request())])
+    deadline = learning_app.time.time() + 1
+    with pytest.raises(APITimeoutError):
+        call_with_resilience(request, 'test-deadline-near', deadline)
+    assert len(calls) == 1
+
+def test_expired_deadline_fails_before_calling(no_sleep):
+    request, calls = _failing([])
+    with pytest.raises(AIDeadlineExceeded):
+        call_with_resilience(request, 'test-deadline-passed', learning_app.time.time() - 1)
+    assert calls == []
+
+# 熔断
+def test_breaker_opens_after_threshold_and_routes_to_fallback(monkeypatch):
+    monkeypatch.setitem(app.config, 'AI_BREAKER_THRESHOLD', 2)
+    monkeypatch.setitem(app.config, 'AI_FALLBACK_MODEL_ID', 'test-breaker-fallback')
+    breaker_record_failure('test-breaker-primary')
+    assert route_model('test-breaker-primary') == 'test-breaker-primary'
+    breaker_record_failure('test-breaker-primary')
+    assert route_model('test-breaker-primary') == 'test-breaker-fallback'
+
+    monkeypatch.setitem(app.config, 'AI_FALLBACK_MODEL_ID', None)
+    with pytest.raises(CircuitOpenError):
+        route_model('test-breaker-primary')
+    breaker_record_success('test-breaker-primary')
+    assert route_model('test-breaker-primary') == 'test-breaker-primary'
+
+def test_open_breaker_fails_fast_without_calling(monkeypatch, no_sleep):
+    monkeypatch.setitem(app.config, 'AI_BREAKER_THRESHOLD', 1)
+    breaker_record_failure('test-breaker-open')
+    request, calls = _failing([])
+    with pytest.raises(CircuitOpenError):
+        call_with_resilience(request, 'test-breaker-open')
+    assert calls == []
@@ -0,0 +1,55 @@
+"""全文搜索：中文按二元组检索、只返回本人的内容、按类型过滤，删除后不再命中"""
+
+from app import db, Note, segment_cjk, index_note, save_enhanced_content
+
+def test_cjk_text_is_split_into_overlapping_bigrams():
+    assert segment_cjk('函数图像').split() == ['函数', '数图', '图像']
+    assert segment_cjk('sin 函数').split() == ['sin', '函数']
+
+def _add_note(user_id, title, content):
+    note = Note(user_id=user_id, title=title, content=content, file_type='txt')
+    db.session.add(note)
+    db.session.flush()
+    index_note(note)
+    db.session.commit()
+    return note
+
+def _search(client, headers, query):
+    response = client.get(f'/api/search?{query}', headers=headers)
+    assert response.status_code == 200
+    return response.get_json()['results']
+
+def test_chinese_phrase_matches_and_is_highlighted(client, new_user):
+    user_id, headers = new_user
+    note = _add_note(user_id, '数学笔记', '二次函数图像的对称轴与顶点')
+    _add_note(user_id, '物理笔记', '匀变速直线运动')
+
+    results = _search(client, headers, 'q=函数图像')
+    assert [(result['type'], result['id']) for result in results] == [('note', note.id)]
+    assert '<mark>函数图像</mark>' in results[0]['snippet']
+    assert _search(client, headers, 'q=图像函数') == []
+
+def test_results_are_limited_to_the_current_user(client, new_user):
+    user_id, headers = new_user
+    _add_note(user_id + 1000, '别人的笔记', '光合作用的暗反应')
+    assert _search(client, headers, 'q=暗反应') == []
+
+def test_type_filter_and_enhanced_content(client, new_user):
+    user_id, headers = new_user
+    _add_note(user_id, '生物笔记', '细胞呼吸与有氧代谢')
+    save_id = save_enhanced_content(user_id, '原文', '## 细胞呼吸\n有氧代谢的三个阶段', 'note')
+
+    assert {result['type'] for result in _search(client, headers, 'q=有氧代谢')} == {'note', 'enhanced'}
+    enhanced = _search(client, headers, 'q=有氧代谢&type=enhanced')
+    assert [(result['type'], result['id']) for result in enhanced] == [('enhanced', save_id)]
+
+def test_deleted_note_is_removed_from_index(client, new_user):
+    user_id, headers = new_user
+    note = _add_note(user_id, '待删除', '洛必达法则')
+    assert len(_search(client, headers, 'q=洛必达')) == 1
+    assert client.delete(f'/api/notes/{note.id}', headers=headers).status_code == 200
+    assert _search(client, headers, 'q=洛必达') == []
+
+def test_empty_query_is_rejected(client, new_user):
+    _, headers = new_user
+    assert client.get('/api/search?q=%20', headers=headers).status_code == 400
@@ -0,0 +1,72 @@
+"""相似内容复用：近似原文直接复用本人的历史结果，no_similar、他人记录、题目数字不同和已删除记录不复用"""
+
+import pytest
+
+from app import app
+
+pytest.importorskip('numpy')
+
+def _note(topic):
+    # 每个用例用不同的主题，避免命中其他用例留下的AI响应缓存
+    return (f'{topic}：一切物体在没有受到外力作用的时候，总保持静止状态或匀速直线运动状态。'
+            '惯性是物体保持原有运动状态不变的性质，质量是惯性大小的唯一量度。') * 3
+
+@pytest.fixture(autouse=True)
+def similar_enabled(monkeypatch, tmp_path):
+    monkeypatch.setitem(app.config, 'SIMILAR_ENABLED', True)
+    monkeypatch.setitem(app.config, 'SIMILAR_INDEX_DIR', str(tmp_path / 'similar_index'))
+
+def _enhance(client, headers, content, **extra):
+    response = client.post('/api/enhance-notes', headers=headers, json={'content': content, **extra})
+    assert response.status_code == 200
+    return response.get_json()
+
+def test_near_duplicate_reuses_own_result(client, new_user, fake_ai):
+    _, headers = new_user
+    note = _note('牛顿第一定律0')
+    first = _enhance(client, headers, note)
+    assert len(fake_ai) == 1
+
+    reused = _enhance(client, headers, note + '\n（复习）')
+    assert len(fake_ai) == 1
+    assert reused['reused'] is True
+    assert reused['reused_from'] == first['save_id']
+    assert reused['enhanced_content'] == first['enhanced_content']
+    assert reused['save_id'] != first['save_id']
+
+def test_no_similar_forces_fresh_generation(client, new_user, fake_ai):
+    _, headers = new_user
+    note = _note('牛顿第一定律1')
+    _enhance(client, headers, note)
+    fresh = _enhance(client, headers, note + '\n（复习）', no_similar=True)
+    assert len(fake_ai) == 2
+    assert 'reused' not in fresh
+
+def test_other_users_results_are_not_reused(client, new_user, auth_headers, fake_ai):
+    _, headers = new_user
+    note = _note('牛顿第一定律2')
+    _enhance(client, auth_headers, note + '\n（他人）')
+    assert 'reused' not in _enhance(client, headers, note + '\n（本人）')
+    assert len(fake_ai) == 2
+
+def test_problem_with_different_numbers_is_not_reused(client, new_user, fake_ai):
+    _, headers = new_user
+    problem = '已知二次函数 y = x^2 - 4x + 3，求函数的顶点坐标、对称轴以及与x轴的交点坐标。' * 2
+
+    def analyze(text):
+        response = client.post('/api/analyze-problems', headers=headers, json={'problems': text})
+        assert response.status_code == 200
+        return response.get_json()
+
+    analyze(problem)
+    assert analyze(problem + '  ')['reused'] is True
+    assert 'reused' not in analyze(problem.replace('+ 3', '+ 5'))
+    assert len(fake_ai) == 2
+
+def test_deleted_result_is_not_reused(client, new_user, fake_ai):
+    _, headers = new_user
+    note = _note('牛顿第一定律4')
+    first = _enhance(client, headers, note)
+    assert client.delete(f"/api/history/{first['save_id']}", headers=headers).status_code == 200
+    assert 'reused' not in _enhance(client, headers, note + '\n（复习）')
+    assert len(fake_ai) == 2
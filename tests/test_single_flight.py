@@ -0,0 +1,71 @@
+"""相同请求合并：同时到达的相同调用只请求一次上游，执行者失败时由等待者接手"""
+
+import threading
+import time
+
+import pytest
+
+import app as learning_app
+from app import app, call_ai_api
+
+@pytest.fixture(autouse=True)
+def fast_poll(monkeypatch):
+    monkeypatch.setitem(app.config, 'AI_SINGLEFLIGHT_ENABLED', True)
+    monkeypatch.setitem(app.config, 'AI_SINGLEFLIGHT_POLL_INTERVAL', 0.02)
+    monkeypatch.setitem(app.config, 'AI_MAX_RETRIES', 0)
+
+def _slow_upstream(monkeypatch, fail_first=False):
+    create = learning_app.ai_client.chat.completions.create
+    upstream = []
+
+    def slow(*args, **kwargs):
+        upstream.append(1)
+        time.sleep(0.3)
+        if fail_first and len(upstream) == 1:
+            raise ValueError('upstream down')
+        return create(*args, **kwargs)
+    monkeypatch.setattr(learning_app.ai_client.chat.completions, 'create', slow)
+    return upstream
+
+def _call_concurrently(content, count=3):
+    results = []
+
+    def call():
+        with app.test_request_context():
+            results.append(call_ai_api([{'role': 'user', 'content': content}], model_id='test-single-flight'))
+    threads = [threading.Thread(target=call) for _ in range(count)]
+    for thread in threads:
+        thread.start()
+        time.sleep(0.02)
+    for thread in threads:
+        thread.join()
+    return results
+
+def test_identical_concurrent_calls_share_one_upstream_call(monkeypatch, fake_ai):
+    upstream = _slow_upstream(monkeypatch)
+    results = _call_concurrently('合并测试：三角函数')
+    assert len(upstream) == 1
+    assert results == ['RESULT for 合并测试：三角函数'] * 3
+
+def test_waiter_takes_over_when_leader_fails(monkeypatch, fake_ai):
+    upstream = _slow_upstream(monkeypatch, fail_first=True)
+    results = _call_concurrently('合并测试：执行者失败', count=2)
+    assert len(upstream) == 2
+    assert sorted(results, key=str) == [None, 'RESULT for 合并测试：执行者失败']
+
+def test_waiters_poll_without_writing(monkeypatch, fake_ai):
+    _slow_upstream(monkeypatch)
+    statements = []
+    connect = learning_app._ai_cache_connect
+
+    def traced():
+        conn = connect()
+        conn.set_trace_callback(statements.append)
+        return conn
+    monkeypatch.setattr(learning_app, '_ai_cache_connect', traced)
+    _call_concurrently('合并测试：只读轮询')
+    polls = [s for s in statements if s.startswith('SELECT response, started_at FROM ai_inflight')]
+    deletes = [s for s in statements if s.startswith('DELETE FROM ai_inflight')]
+    assert len(polls) > 3
+    # 每个调用方只在尝试成为执行者时清理一次
+    assert len(deletes) == 3
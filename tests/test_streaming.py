@@ -0,0 +1,52 @@
+"""SSE流式响应：增量输出拼接为完整结果并保存，上游失败时发送 error 事件且不保存"""
+
+import json
+
+import app as learning_app
+from app import db, EnhancedContent, enhanced_text
+
+def _events(response):
+    """把SSE响应体解析为 [(事件名, 数据)]，注释行忽略"""
+    events = []
+    for block in response.get_data(as_text=True).split('\n\n'):
+        lines = [line for line in block.split('\n') if line and not line.startswith(':')]
+        if not lines:
+            continue
+        fields = dict(line.split(': ', 1) for line in lines)
+        events.append((fields.get('event', 'message'), json.loads(fields['data'])))
+    return events
+
+def test_stream_sends_deltas_then_done_with_saved_id(client, new_user, fake_ai):
+    _, headers = new_user
+    response = client.post('/api/enhance-notes', headers=headers,
+                           json={'content': '流式测试：光合作用', 'stream': True, 'no_cache': True})
+    assert response.status_code == 200
+    assert response.mimetype == 'text/event-stream'
+
+    events = _events(response)
+    deltas = [data['delta'] for name, data in events if name == 'message']
+    assert len(deltas) > 1
+    assert ''.join(deltas) == f"RESULT for {fake_ai[-1][1][-1]['content']}"
+    name, data = events[-1]
+    assert name == 'done'
+    saved = db.session.get(EnhancedContent, data['save_id'])
+    assert enhanced_text(saved) == ''.join(deltas)
+
+def test_accept_header_requests_a_stream(client, new_user, fake_ai):
+    _, headers = new_user
+    response = client.post('/api/analyze-problems', headers={**headers, 'Accept': 'text/event-stream'},
+                           json={'problems': '流式测试：1 + 1 = ?', 'no_cache': True})
+    assert response.mimetype == 'text/event-stream'
+    assert _events(response)[-1][0] == 'done'
+
+def test_upstream_failure_sends_error_event_and_saves_nothing(client, new_user, fake_ai, monkeypatch):
+    user_id, headers = new_user
+
+    def broken(*args, **kwargs):
+        raise ValueError('upstream down')
+    monkeypatch.setattr(learning_app.ai_client.chat.completions, 'create', broken)
+    response = client.post('/api/english-study', headers=headers,
+                           json={'text': 'Streaming test.', 'stream': True, 'no_cache': True})
+    events = _events(response)
+    assert events[-1] == ('error', {'error': 'AI服务暂时不可用'})
+    assert EnhancedContent.query.filter_by(user_id=user_id).count() == 0
@@ -0,0 +1,69 @@
+"""上传文件的内容寻址存储：相同内容只存一份，按引用计数回收"""
+
+import hashlib
+import io
+import os
+
+from app import (db, Note, UploadBlob, acquire_upload_blob, place_upload_blob, release_upload_blob,
+                 collect_upload_blob, upload_blob_path)
+
+def _store_blob(tmp_path, content_hash, data=b'blob-data'):
+    staged = os.path.join(tmp_path, f'{content_hash}.part')
+    with open(staged, 'wb') as f:
+        f.write(data)
+    acquire_upload_blob(content_hash, len(data))
+    db.session.commit()
+    return place_upload_blob(staged, content_hash)
+
+def test_blob_is_kept_until_last_reference_is_released(tmp_path):
+    content_hash = 'a1' * 32
+    path = _store_blob(tmp_path, content_hash)
+    _store_blob(tmp_path, content_hash)
+    assert path == upload_blob_path(content_hash)
+    assert db.session.get(UploadBlob, content_hash).ref_count == 2
+
+    release_upload_blob(content_hash)
+    db.session.commit()
+    assert collect_upload_blob(content_hash) is False
+    assert os.path.exists(path)
+
+    release_upload_blob(content_hash)
+    db.session.commit()
+    assert collect_upload_blob(content_hash) is True
+    assert not os.path.exists(path)
+    assert db.session.get(UploadBlob, content_hash) is None
+
+def test_reacquired_blob_is_not_collected(tmp_path):
+    content_hash = 'b2' * 32
+    path = _store_blob(tmp_path, content_hash)
+    release_upload_blob(content_hash)
+    # 回收之前又有新上传引用了同一文件
+    _store_blob(tmp_path, content_hash)
+    assert collect_upload_blob(content_hash) is False
+    assert os.path.exists(path)
+    assert db.session.get(UploadBlob, content_hash).ref_count == 1
+
+def _upload(client, headers, data, filename='notes.txt'):
+    return client.post('/api/upload', headers=headers, content_type='multipart/form-data', data={
+        'file': (io.BytesIO(data), filename), 'async': 'false', 'auto_enhance': 'false', 'extract_keywords': 'false'
+    })
+
+def test_identical_uploads_share_one_blob_until_both_notes_are_deleted(client, new_user):
+    _, headers = new_user
+    data = '同一份讲义的内容'.encode('utf-8')
+    content_hash = hashlib.sha256(data).hexdigest()
+    first = _upload(client, headers, data)
+    second = _upload(client, headers, data, 'copy.txt')
+    assert first.status_code == second.status_code == 200
+
+    notes = [db.session.get(Note, response.get_json()['note_id']) for response in (first, second)]
+    assert notes[0].file_path == notes[1].file_path == upload_blob_path(content_hash)
+    assert notes[0].content == '同一份讲义的内容'
+    assert db.session.get(UploadBlob, content_hash).ref_count == 2
+
+    assert client.delete(f'/api/notes/{notes[0].id}', headers=headers).status_code == 200
+    assert os.path.exists(upload_blob_path(content_hash))
+    assert client.delete(f'/api/notes/{notes[1].id}', headers=headers).status_code == 200
+    assert not os.path.exists(upload_blob_path(content_hash))
+    db.session.expire_all()
+    assert db.session.get(UploadBlob, content_hash) is None
@@ -0,0 +1,40 @@
+"""生词批量同步：UPSERT不产生重复记录，同一单词以最后一次为准，已掌握列表支持ETag"""
+
+import pytest
+
+from app import app, VocabularyRecord
+
+def _bulk(client, headers, words):
+    return client.post('/api/vocabulary/bulk', headers=headers, json={'words': words})
+
+def test_bulk_upsert_updates_existing_words_without_duplicates(client, new_user):
+    user_id, headers = new_user
+    response = _bulk(client, headers, [{'word': 'apple', 'known': True}, {'word': 'banana'}])
+    assert response.get_json()['saved'] == 2
+    response = _bulk(client, headers, [{'word': 'apple', 'known': False}, {'word': 'cherry', 'known': True},
+                                       {'word': ' cherry ', 'known': False}, {'word': 'banana', 'known': True}])
+    assert response.get_json()['saved'] == 3
+
+    records = {record.word: record.known for record in VocabularyRecord.query.filter_by(user_id=user_id)}
+    assert records == {'apple': False, 'banana': True, 'cherry': False}
+
+def test_known_words_list_and_etag(client, new_user):
+    _, headers = new_user
+    _bulk(client, headers, [{'word': 'zebra', 'known': True}, {'word': 'ant', 'known': True}, {'word': 'bee'}])
+    response = client.get('/api/vocabulary/known', headers=headers)
+    assert response.get_json() == {'count': 2, 'words': ['ant', 'zebra']}
+
+    etag = response.headers['ETag']
+    assert client.get('/api/vocabulary/known', headers={**headers, 'If-None-Match': etag}).status_code == 304
+    client.post('/api/vocabulary', headers=headers, json={'word': 'bee', 'known': True})
+    assert client.get('/api/vocabulary/known', headers={**headers, 'If-None-Match': etag}).status_code == 200
+
+@pytest.mark.parametrize('words', [[], 'apple', [{'word': ''}], [{'word': 'x' * 101}], ['apple']])
+def test_invalid_bulk_payload_is_rejected(client, new_user, words):
+    _, headers = new_user
+    assert _bulk(client, headers, words).status_code == 400
+
+def test_bulk_size_limit(client, new_user, monkeypatch):
+    _, headers = new_user
+    monkeypatch.setitem(app.config, 'VOCABULARY_BULK_MAX', 2)
+    assert _bulk(client, headers, [{'word': w} for w in ('a', 'b', 'c')]).status_code == 400